@@ -42,13 +42,68 @@ DATABASE_ECHO_SQL = os.getenv('DATABASE_ECHO_SQL') == '1'
 SLOW_SQL_MS = int_env('SLOW_SQL_MS', 1000)
 
 max_content_size = 64 << 10  # cost 2.5 min when parsing large pdf
+# Article downloads are truncated at these sizes, instead of being held fully in memory
+max_download_bytes = {
+    'pdf': int_env('MAX_PDF_BYTES', 32 << 20),
+    'html': int_env('MAX_HTML_BYTES', 8 << 20),
+    'text': max_content_size * 4,  # utf-8 takes at most 4 bytes per char
+}
+# Pdfs are read up to this many pages, and for at most this many seconds. On the home page they are downloaded
+# and read within the fetch stage, whose budget (FETCH_BUDGET) wins, so the timeout is kept well below it:
+# a slow pdf keeps the pages read so far, instead of timing out the stage and losing them all.
+max_pdf_pages = int_env('MAX_PDF_PAGES', 100)
+pdf_timeout = int_env('PDF_TIMEOUT', 30)
 summary_size = 400
 summary_ttl = int_env('SUMMARY_TTL_DAYS', 60) * 24 * 60 * 60
 updatable_within_days = int_env('UPDATABLE_WITHIN_DAYS', 3)
 assert updatable_within_days < summary_ttl / (24 * 60 * 60)
+# Summaries not final yet are retried with the same content after 10m, 20m, 40m..., at most a day apart
+summary_retry_backoff = int_env('SUMMARY_RETRY_MINUTES', 10) * 60
+max_summary_retry_backoff = 24 * 60 * 60
+# Extracted contents are kept as long as their summaries may be updated, see db/extraction.py
+extraction_ttl = updatable_within_days * 24 * 60 * 60
 
 sites_for_users = ('github.com', 'medium.com', 'twitter.com')
 
+# Conditional-GET cache of articles, images and algolia pages
+disable_http_cache = os.getenv('DISABLE_HTTP_CACHE') == '1'
+http_cache_dir = os.getenv('HTTP_CACHE_DIR') or os.path.join(os.path.dirname(__file__), '.cache/http/')
+http_cache_size = int_env('HTTP_CACHE_SIZE_MB', 256) << 20
+http_cache_max_entry_size = 16 << 20
+
+# Circuit breaker of bad hosts, see db/host.py
+circuit_failure_threshold = int_env('CIRCUIT_FAILURE_THRESHOLD', 3)
+circuit_cooldown = int_env('CIRCUIT_COOLDOWN_MINUTES', 6 * 60) * 60
+slow_host_ms = int_env('SLOW_HOST_MS', 20 * 1000)
+
+# How many news items are pulled at the same time, and how many of them may hit the same host
+pull_concurrency = int_env('PULL_CONCURRENCY', 8)
+pull_concurrency_per_host = int_env('PULL_CONCURRENCY_PER_HOST', 2)
+# How many candidate images of a page are checked at the same time
+illustration_fan_out = int_env('ILLUSTRATION_FAN_OUT', 4)
+# How long to remember whether an image url makes a feature image
+image_verdict_ttl = int_env('IMAGE_VERDICT_TTL_DAYS', 7) * 24 * 60 * 60
+# Widths of the smaller copies made for feature images, 220px is what the list and feed show
+image_derivative_widths = (220, 440)
+# Huge pages, e.g. generated logs, are cut before parsing, at this many chars or before this many tags.
+# Normal pages are far below them, and only lose their tails when they are not.
+max_parse_size = int_env('MAX_PARSE_SIZE', 4 << 20)
+max_parse_nodes = int_env('MAX_PARSE_NODES', 100_000)
+# Engine of HtmlContentExtractor, bs4 or lxml, both give the same results, lxml is faster
+html_engine = os.getenv('HTML_ENGINE', 'bs4')
+# Worker processes for CPU bound jobs like image encoding, 0 to run them in the calling thread
+worker_processes = int_env('WORKER_PROCESSES', min(os.cpu_count() or 1, 4))
+
+# Time budget of a home page round (cron runs every 20 minutes), and of each stage of an item, in seconds.
+# Items running out of their budget fall back to the cached summary, see hacker_news/deadline.py.
+# The fetch stage covers both downloading and parsing, html or pdf, which happen together in `parser_factory`
+round_timeout = int_env('ROUND_TIMEOUT_MINUTES', 15) * 60
+stage_budget = {
+    'fetch': int_env('FETCH_BUDGET', 60),
+    'summarize': int_env('SUMMARIZE_BUDGET', 180),
+    'image': int_env('IMAGE_BUDGET', 60),
+}
+
 disable_ads = os.getenv('DISABLE_ADS') == '1'
 disable_summary_cache = os.getenv('DISABLE_SUMMARY_CACHE') == '1'
 disable_translation_cache = os.getenv('DISABLE_TRANSLATION_CACHE') == '1'
@@ -65,6 +120,10 @@ logger.info(f'Use openai api key #{openai_key_index}')
 openai_model = os.getenv('OPENAI_MODEL') or 'gpt-3.5-turbo'
 openai_score_threshold = int_env('OPENAI_SCORE_THRESHOLD', 10)
 local_llm_score_threshold = 5
+# Quota of the openai compatible api, requests and tokens per minute, 0 for no limit, see hacker_news/llm/dispatcher.py.
+# Groq's free tier allows 6000 tokens per minute.
+openai_rpm = int_env('OPENAI_RPM', 0)
+openai_tpm = int_env('OPENAI_TPM', 6000 if 'groq' in (openai.api_base or '') else 0)
 logger.info(f'Use openai model {openai_model}')
 
 disable_translation = os.getenv('DISABLE_TRANSLATION') == '1'
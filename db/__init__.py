@@ -1,9 +1,42 @@
+import logging
+
+from sqlalchemy import inspect, text
+
 from db.engine import engine, Base
+from db.host import HostHealth
 from db.summary import Summary
 from db.translation import Translation
+from db.image import StoredImage
+from db.verdict import ImageVerdict
+from db.extraction import Extraction
+
+logger = logging.getLogger(__name__)
 
 
 def init_db():
     Base.metadata.create_all(engine, checkfirst=True)
+    add_missing_columns(engine)
     translation.add('Hacker News Summary', 'Hacker News 摘要', 'zh')
     translation.add('Translate', '翻译', 'zh')
+
+
+def add_missing_columns(bind):
+    """
+    `create_all` leaves existing tables as they are, so columns added to the models later,
+    e.g. `Summary.content_hash` or `StoredImage.checked_at` with its index, are added here. They must be nullable, defaults are filled by the models.
+    """
+    inspector = inspect(bind)
+    quote = bind.dialect.identifier_preparer.quote
+    with bind.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            missing = [column for column in table.columns if column.name not in existing]
+            for column in missing:
+                logger.info(f'adding column {table.name}.{column.name}')
+                conn.execute(text(f'ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} '
+                                  f'{column.type.compile(dialect=bind.dialect)}'))
+            for index in table.indexes:
+                if any(column in missing for column in index.columns):
+                    index.create(conn, checkfirst=True)
@@ -3,13 +3,14 @@ import logging
 import time
 from contextlib import contextmanager
 from sqlalchemy import create_engine, TIMESTAMP, event, Engine
-from sqlalchemy.orm import DeclarativeBase, mapped_column, Session
+from sqlalchemy.orm import DeclarativeBase, mapped_column, Session, scoped_session, sessionmaker
 import config
 
 logger = logging.getLogger(__name__)
 engine = create_engine(config.DATABASE_URL, echo=config.DATABASE_ECHO_SQL)  # lazy connection
 
-session = Session(engine)
+# Sessions are not thread-safe, news items are pulled concurrently, so each thread gets its own one
+session = scoped_session(sessionmaker(engine))
 
 
 @contextmanager
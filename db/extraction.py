@@ -0,0 +1,64 @@
+import logging
+import time
+import zlib
+from datetime import datetime, timedelta
+from hashlib import sha256
+
+from sqlalchemy import String, LargeBinary, TIMESTAMP, delete
+from sqlalchemy.orm import mapped_column
+
+import config
+from db.engine import Base, session_scope
+
+logger = logging.getLogger(__name__)
+
+
+class Extraction(Base):
+    """
+    What is extracted from a response body, in json, so summarizing the same page again,
+    e.g. after the openai key recovers, does not parse it again.
+    Entries expire by birth, once their summaries are no longer updated, so reading them writes nothing.
+    """
+    __tablename__ = 'extraction'
+
+    digest = mapped_column(String(64), primary_key=True)  # see `digest_of`
+    data = mapped_column(LargeBinary)  # zlib compressed
+    birth = mapped_column(TIMESTAMP, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<{self.digest} - {len(self.data)} bytes - {self.birth}>'
+
+    def is_expired(self):
+        return self.birth < datetime.utcnow() - timedelta(seconds=config.extraction_ttl)
+
+
+def digest_of(url, body: bytes) -> str:
+    # Relative links are resolved against the url, so it is part of the key
+    return sha256(url.encode('utf-8', errors='replace') + b'\0' + body).hexdigest()
+
+
+def get(digest) -> str:
+    if config.disable_summary_cache:
+        return None
+    with session_scope(defer_commit=True) as session:
+        extraction = session.get(Extraction, digest)
+        if extraction is None or extraction.is_expired():
+            return None
+        return zlib.decompress(extraction.data).decode('utf-8')
+
+
+def put(digest, json_str):
+    extraction = Extraction(digest=digest, data=zlib.compress(json_str.encode('utf-8')), birth=datetime.utcnow())
+    with session_scope() as session:
+        session.merge(extraction)
+
+
+def expire():
+    start = time.time()
+    stmt = delete(Extraction).where(
+        Extraction.birth < datetime.utcnow() - timedelta(seconds=config.extraction_ttl))
+    with session_scope() as session:
+        result = session.execute(stmt)
+    cost = (time.time() - start) * 1000
+    logger.info(f'evicted {result.rowcount} extractions, cost(ms): {cost:.2f}')
+    return result.rowcount
@@ -0,0 +1,150 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import String, Integer, TIMESTAMP, delete
+from sqlalchemy.orm import mapped_column
+
+import config
+from db.engine import Base, session_scope
+
+logger = logging.getLogger(__name__)
+MAX_LATENCY_SAMPLES = 20
+
+
+class HostHealth(Base):
+    """
+    Health record of a host, used as a circuit breaker so one bad host does not cost timeouts on every round
+    """
+    __tablename__ = 'host_health'
+
+    host = mapped_column(String(255), primary_key=True)
+    requests = mapped_column(Integer, default=0)
+    timeouts = mapped_column(Integer, default=0)
+    errors = mapped_column(Integer, default=0)  # connection errors
+    client_errors = mapped_column(Integer, default=0)  # 4xx
+    server_errors = mapped_column(Integer, default=0)  # 5xx
+    consecutive_failures = mapped_column(Integer, default=0)
+    latencies = mapped_column(String(1024), default='')  # recent latencies in ms, comma separated
+    opened_at = mapped_column(TIMESTAMP, nullable=True)  # when the circuit was opened, None if closed
+
+    def __init__(self, host, **kw):
+        super().__init__(**kw)
+        self.host = host
+        self.requests = self.timeouts = self.errors = self.client_errors = self.server_errors = 0
+        self.consecutive_failures = 0
+        self.latencies = ''
+
+    def __repr__(self):
+        return (f'<{self.host} - requests {self.requests} - timeouts {self.timeouts} - errors {self.errors} - '
+                f'4xx {self.client_errors} - 5xx {self.server_errors} - p50 {self.latency_percentile(50)}ms - '
+                f'p90 {self.latency_percentile(90)}ms - opened at {self.opened_at}>')
+
+    def latency_samples(self) -> list[int]:
+        return [int(ms) for ms in self.latencies.split(',') if ms]
+
+    def latency_percentile(self, percent) -> int:
+        samples = sorted(self.latency_samples())
+        if not samples:
+            return 0
+        return samples[min(len(samples) * percent // 100, len(samples) - 1)]
+
+    def is_slow(self):
+        return (len(self.latency_samples()) >= 5
+                and self.latency_percentile(90) > config.slow_host_ms)
+
+    def is_open(self):
+        return self.opened_at is not None
+
+
+_hosts: dict[str, HostHealth] = {}
+_probing = set()  # half-open hosts that already let one request through
+_dirty = set()
+_lock = threading.Lock()
+
+
+def get(host) -> HostHealth:
+    with _lock:
+        if host in _hosts:
+            return _hosts[host]
+    with session_scope() as session:
+        health = session.get(HostHealth, host)
+        if health:
+            session.expunge(health)  # only written back on flush
+    with _lock:
+        return _hosts.setdefault(host, health or HostHealth(host))
+
+
+def allow(host) -> bool:
+    """Whether we should send requests to this host, i.e. its circuit is closed or half-open"""
+    if not host:
+        return True
+    health = get(host)
+    with _lock:
+        if not health.is_open():
+            return True
+        if datetime.utcnow() - health.opened_at < timedelta(seconds=config.circuit_cooldown):
+            return False
+        if host in _probing:
+            return False
+        # Cool-down is over, let one request through to see if it recovers
+        logger.info('Circuit of %s is half-open, probing', host)
+        _probing.add(host)
+        return True
+
+
+def record(host, latency_ms, status_code=None, timeout=False, error=False):
+    if not host:
+        return
+    health = get(host)
+    # 403 is left to the caller: sites like science.org forbid bots, but still serve meta descriptions and images
+    failed = timeout or error or (status_code or 0) >= 500 or status_code == 429
+    with _lock:
+        health.requests += 1
+        health.timeouts += timeout
+        health.errors += error
+        health.client_errors += 400 <= (status_code or 0) < 500
+        health.server_errors += (status_code or 0) >= 500
+        samples = health.latency_samples()[-MAX_LATENCY_SAMPLES + 1:] + [int(latency_ms)]
+        was_probing = host in _probing
+        _probing.discard(host)
+        if failed:
+            health.consecutive_failures += 1
+        else:
+            health.consecutive_failures = 0
+            if was_probing:
+                samples = [int(latency_ms)]  # forget about the slow history
+                health.opened_at = None
+                logger.info('Circuit of %s is closed again', host)
+        health.latencies = ','.join(map(str, samples))
+        if ((was_probing and failed)
+                or (not health.is_open()
+                    and (health.consecutive_failures >= config.circuit_failure_threshold or health.is_slow()))):
+            health.opened_at = datetime.utcnow()
+            logger.warning('Circuit of %s is open, %r', host, health)
+        _dirty.add(host)
+
+
+def flush():
+    start = time.time()
+    with _lock:
+        dirty = [_hosts[host] for host in _dirty]
+        _dirty.clear()
+    with session_scope() as session:
+        for health in dirty:
+            health.access = datetime.utcnow()
+            session.merge(health)
+    cost = (time.time() - start) * 1000
+    logger.info(f'saved {len(dirty)} host health records, cost(ms): {cost:.2f}')
+
+
+def expire():
+    start = time.time()
+    stmt = delete(HostHealth).where(
+        HostHealth.access < datetime.utcnow() - timedelta(seconds=config.summary_ttl))
+    with session_scope() as session:
+        result = session.execute(stmt)
+    cost = (time.time() - start) * 1000
+    logger.info(f'evicted {result.rowcount} host health records, cost(ms): {cost:.2f}')
+    return result.rowcount
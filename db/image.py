@@ -1,42 +1,177 @@
-# TODO: need a separate model?
 import logging
 import os
-import random
+import re
 import time
+from datetime import datetime, timedelta
 
-from sqlalchemy import String, column, Values, select
+from sqlalchemy import String, Integer, TIMESTAMP, select, update, delete
+from sqlalchemy.orm import mapped_column
 
 import config
 from db import Summary
-from db.engine import session_scope
+from db.engine import Base, session_scope
 
 logger = logging.getLogger(__name__)
+GC_GRACE = 1 * 24 * 60 * 60  # do not collect images saved by a round still in progress
+GC_BATCH = 1000
+LEGACY_MARK = 'legacy-adopted'  # a manifest row without file, not published with the images like a marker file
+DERIVATIVE_PATTERN = re.compile(r'-\d+w\.webp$')
 
-"""
-SELECT v.name 
-FROM (VALUES ('c189bad0066ddb74264e7e03fa8b2dda.jpg')) AS v (name) LEFT OUTER JOIN summary ON summary.image_name = v.name 
-WHERE summary.image_name IS NULL
-"""
+
+class StoredImage(Base):
+    """
+    Manifest of feature images in `config.image_dir`. Files are content addressed - named by the md5 of
+    their bytes, and sharded into sub directories by the first two hex chars, e.g. `c1/c1a1...f57f.webp`.
+    The same image from different articles is stored only once. Legacy flat files are adopted as they are.
+    """
+    __tablename__ = 'image'
+
+    name = mapped_column(String(255), primary_key=True)  # relative to config.image_dir, same as Summary.image_name
+    size = mapped_column(Integer, default=0)
+    source_url = mapped_column(String(4096), nullable=True)  # the image url where it was first seen
+    first_seen = mapped_column(TIMESTAMP, default=datetime.utcnow)
+    last_referenced = mapped_column(TIMESTAMP, default=datetime.utcnow)
+    checked_at = mapped_column(TIMESTAMP, nullable=True, index=True)  # last GC pass, None to be checked first
+
+    def __repr__(self):
+        return f'<{self.name} - {self.size} - {self.source_url} - {self.first_seen} - {self.last_referenced}>'
+
+
+def shard(fname):
+    return f'{fname[:2]}/{fname}'
+
+
+def path_of(name):
+    return os.path.join(config.image_dir, name)
+
+
+def exists(name) -> bool:
+    # Legacy images are stored flat, e.g. `c1a1...f57f.webp`, they are still readable
+    return bool(name) and os.path.exists(path_of(name))
+
+
+def save(img) -> str:
+    """Stores a `WebImage` unless the same content is already there, returns its name"""
+    name = shard(img.uniq_name())
+    now = datetime.utcnow()
+    with session_scope() as session:
+        stored = session.get(StoredImage, name)
+        if stored and exists(name):
+            logger.info(f'Dedup image {name}, first seen at {stored.source_url}')
+            stored.last_referenced = now
+            return name
+        os.makedirs(os.path.dirname(path_of(name)), exist_ok=True)
+        img.save(path_of(name))
+        session.merge(StoredImage(name=name, size=len(img.raw_data), source_url=img.url[:4096],
+                                  first_seen=stored.first_seen if stored else now, last_referenced=now))
+    return name
+
+
+def derivative_name(name, width):
+    return f'{os.path.splitext(name)[0]}-{width}w.webp'
+
+
+def save_derivatives(name, derivatives) -> dict[int, str]:
+    """
+    Stores smaller copies of the image `name`, next to it. They are not in the manifest,
+    but are removed together with it. Returns width -> derivative name.
+    """
+    names = {}
+    for width, data in sorted(derivatives.items()):
+        derived = derivative_name(name, width)
+        if not exists(derived):
+            with open(path_of(derived), 'wb') as fp:
+                fp.write(data)
+        names[width] = derived
+    return names
+
+
+def remove(name) -> int:
+    """Removes the image and its derivatives, returns bytes reclaimed"""
+    reclaimed = 0
+    path = path_of(name)
+    directory = os.path.dirname(path)
+    prefix = os.path.splitext(os.path.basename(path))[0] + '-'
+    derived = [os.path.join(directory, f) for f in os.listdir(directory)
+               if f.startswith(prefix) and DERIVATIVE_PATTERN.search(f)] if os.path.isdir(directory) else []
+    for path in [path] + derived:
+        try:
+            reclaimed += os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    return reclaimed
+
+
+def touch(name):
+    stmt = update(StoredImage).where(StoredImage.name == name).values(last_referenced=datetime.utcnow())
+    with session_scope() as session:
+        session.execute(stmt)
+
+
+def release(session, image_names):
+    """Images of summaries about to be deleted, they are re-checked first by the next `expire`"""
+    session.execute(update(StoredImage).where(StoredImage.name.in_(image_names)).values(checked_at=None))
 
 
 def expire():
+    """
+    Incrementally removes stored images no longer referenced by any summary. Each run checks a batch of
+    never checked or released (see `release`) images first, then the least recently checked ones,
+    so the whole set is covered every `len(set) / GC_BATCH` runs without listing the directory.
+    """
+    start = time.time()
+    adopt_legacy()
+    now = datetime.utcnow()
+    referenced = select(Summary.image_name).where(Summary.image_name == StoredImage.name).exists()
+    stmt = (select(StoredImage.name, StoredImage.last_referenced, referenced)
+            .where(StoredImage.name != LEGACY_MARK)
+            .order_by(StoredImage.checked_at.asc().nulls_first())
+            .limit(GC_BATCH))
+    with session_scope() as session:
+        rows = session.execute(stmt).all()
+        orphans, checked, reclaimed = [], [], 0
+        for name, last_referenced, is_referenced in rows:
+            if is_referenced:
+                checked.append(name)
+            elif last_referenced < now - timedelta(seconds=GC_GRACE):
+                orphans.append(name)
+            # else maybe saved by a round still in progress, check again next time
+        for name in orphans:
+            logger.debug(f'removing {name}')
+            reclaimed += remove(name)
+        for names in chunks(orphans, 500):
+            session.execute(delete(StoredImage).where(StoredImage.name.in_(names)))
+        for names in chunks(checked, 500):
+            session.execute(update(StoredImage).where(StoredImage.name.in_(names)).values(checked_at=now))
+    cost = (time.time() - start) * 1000
+    logger.info(f'checked {len(rows)} feature images, removed {len(orphans)}, '
+                f'reclaimed {reclaimed >> 10}KB, cost(ms): {cost:.2f}')
+    return len(orphans)
+
+
+def adopt_legacy():
+    """Flat images saved before the manifest are registered once, then collected like the others"""
+    if not os.path.isdir(config.image_dir):
+        return
     start = time.time()
-    removed = 0
-    all_files = list(os.listdir(config.image_dir))
-    random.shuffle(all_files) # avoid checking whole list everytime to reduce transfer cost to DB
-    candidates = all_files[:1000]
-    for img_files in chunks(candidates, 500):
-        values = Values(column('name', String), name='v').data(list(map(lambda x: (x,), img_files)))
-        stmt = select(values).join(Summary, Summary.image_name == values.c.name,
-                                   isouter=True  # Add this to implement left outer join
-                                   ).where(Summary.image_name.is_(None))
-        with session_scope() as session:
-            for image_name in session.execute(stmt):
-                logger.debug(f'removing {image_name[0]}')
-                os.remove(os.path.join(config.image_dir, image_name[0]))
-                removed += 1
+    with session_scope() as session:
+        if session.get(StoredImage, LEGACY_MARK) is not None:
+            return
+        adopted = 0
+        for entry in os.scandir(config.image_dir):
+            if not entry.is_file() or entry.name.startswith('.') or DERIVATIVE_PATTERN.search(entry.name):
+                continue
+            if entry.name == LEGACY_MARK:  # where it used to be recorded
+                os.remove(entry.path)
+                continue
+            stat = entry.stat()
+            mtime = datetime.utcfromtimestamp(stat.st_mtime)
+            session.merge(StoredImage(name=entry.name, size=stat.st_size, first_seen=mtime, last_referenced=mtime))
+            adopted += 1
+        session.add(StoredImage(name=LEGACY_MARK))
     cost = (time.time() - start) * 1000
-    logger.info(f'removed {removed}/{len(candidates)} feature images, cost(ms): {cost:.2f}')
+    logger.info(f'adopted {adopted} legacy feature images, cost(ms): {cost:.2f}')
 
 
 def chunks(lst, n):
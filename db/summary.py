@@ -2,8 +2,9 @@ import logging
 import time
 from datetime import datetime, timedelta
 from enum import Enum
+from hashlib import sha1
 
-from sqlalchemy import String, TIMESTAMP, select, delete
+from sqlalchemy import String, Integer, TIMESTAMP, select, delete
 from sqlalchemy.orm import mapped_column
 
 import config
@@ -57,6 +58,11 @@ class Summary(Base):
     image_name = mapped_column(String(65535), nullable=True, index=True)
     image_json = mapped_column(String(65535), nullable=True)
 
+    # Summaries not final yet are retried, but not with the same content on every round, see `record_attempt`
+    content_hash = mapped_column(String(40), nullable=True)  # fingerprint of the content summarized last time
+    retries = mapped_column(Integer, default=0)  # attempts on the same content, which were not final
+    next_retry = mapped_column(TIMESTAMP, nullable=True)
+
     def __init__(self, url, summary='', model=Model.FULL, **kw):
         super().__init__(**kw)
         self.url = url
@@ -72,12 +78,32 @@ class Summary(Base):
     def get_summary_model(self) -> Model:
         return Model.from_value(self.model)
 
+    def is_unchanged(self, content_hash) -> bool:
+        return bool(self.summary) and self.content_hash == content_hash
+
+    def is_retry_due(self) -> bool:
+        return self.next_retry is None or self.next_retry <= datetime.utcnow()
+
+    def record_attempt(self, content_hash, model: Model):
+        """Backs off exponentially while the same content is not summarized by a final model"""
+        if model.is_final():
+            self.retries, self.next_retry = 0, None
+        else:
+            self.retries = (self.retries or 0) + 1 if self.content_hash == content_hash else 1
+            backoff = min(config.summary_retry_backoff << (self.retries - 1), config.max_summary_retry_backoff)
+            self.next_retry = datetime.utcnow() + timedelta(seconds=backoff)
+        self.content_hash = content_hash
+
+
+def fingerprint(content) -> str:
+    return sha1(content.encode('utf-8', errors='replace')).hexdigest()
+
 
 def get(url) -> Summary:
     if config.disable_summary_cache:
         return Summary(url)
     with session_scope() as session:
-        summary = session.get(Summary, url)  # Try to leverage the identity map cache
+        summary = session.get(Summary, url)
     return summary or Summary(url)
 
 
@@ -96,26 +122,24 @@ def put(db_summary: Summary) -> Summary:
 
 
 def filter_url(url_list: list[str]) -> set[str]:
-    # use `all()` to populate the Identity Map so that following `get` can read from cache
     with session_scope() as session:
-        summaries = session.scalars(select(Summary).where(Summary.url.in_(url_list))).all()
-        assert len(session.identity_map) == len(summaries)
-    return set(s.url for s in summaries)
+        return set(session.scalars(select(Summary.url).where(Summary.url.in_(url_list))))
 
 
 def expire():
+    from db import image  # circular import
     start = time.time()
-    stmt = delete(Summary).where(
-        Summary.access < datetime.utcnow() - timedelta(seconds=config.summary_ttl))
+    expired = Summary.access < datetime.utcnow() - timedelta(seconds=config.summary_ttl)
     with session_scope() as session:
-        result = session.execute(stmt)
+        image.release(session, select(Summary.image_name).where(expired))
+        result = session.execute(delete(Summary).where(expired))
         deleted = result.rowcount
         logger.info(f'evicted {result.rowcount} summary items')
 
-        stmt = delete(Summary).where(
-            Summary.access < datetime.utcnow() - timedelta(seconds=CONTENT_TTL),
-            Summary.model.in_((Model.PREFIX.value, Model.FULL.value, Model.EMBED.value)))
-        result = session.execute(stmt)
+        expired = (Summary.access < datetime.utcnow() - timedelta(seconds=CONTENT_TTL),
+                   Summary.model.in_((Model.PREFIX.value, Model.FULL.value, Model.EMBED.value)))
+        image.release(session, select(Summary.image_name).where(*expired))
+        result = session.execute(delete(Summary).where(*expired))
         cost = (time.time() - start) * 1000
         logger.info(f'evicted {result.rowcount} full content items, cost(ms): {cost:.2f}')
 
@@ -0,0 +1,110 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import String, Integer, Boolean, TIMESTAMP, select, delete
+from sqlalchemy.orm import mapped_column
+
+import config
+from db.engine import Base, session_scope
+
+logger = logging.getLogger(__name__)
+
+
+class ImageVerdict(Base):
+    """
+    Whether an image url makes a feature image, remembered across runs so the same avatars, banners
+    and white images are not downloaded again and again
+    """
+    __tablename__ = 'image_verdict'
+
+    url = mapped_column(String(4096), primary_key=True)
+    is_candidate = mapped_column(Boolean, default=False)
+    width = mapped_column(Integer, default=0)
+    height = mapped_column(Integer, default=0)
+    byte_size = mapped_column(Integer, default=0)
+    reason = mapped_column(String(32), nullable=True)  # why it is rejected
+    birth = mapped_column(TIMESTAMP, default=datetime.utcnow)  # when it was checked
+
+    def __repr__(self):
+        return (f'<{self.url} - candidate {self.is_candidate} - {self.width}x{self.height} - {self.byte_size} bytes'
+                f' - {self.reason} - {self.birth}>')
+
+    def is_expired(self):
+        return self.birth < datetime.utcnow() - timedelta(seconds=config.image_verdict_ttl)
+
+
+_verdicts: dict[str, ImageVerdict] = {}  # None if not in db
+_dirty = set()
+_lock = threading.Lock()
+
+
+def load(urls):
+    """Loads verdicts of these urls with one query"""
+    with _lock:
+        missing = list({url for url in urls if url not in _verdicts})
+    if not missing or config.disable_summary_cache:
+        return
+    found = {}
+    with session_scope() as session:
+        for i in range(0, len(missing), 500):
+            stmt = select(ImageVerdict).where(ImageVerdict.url.in_(missing[i:i + 500]))
+            for verdict in session.scalars(stmt):
+                session.expunge(verdict)  # only written back on flush
+                found[verdict.url] = verdict
+    with _lock:
+        for url in missing:
+            _verdicts.setdefault(url, found.get(url))
+
+
+def get(url) -> ImageVerdict:
+    load([url])
+    with _lock:
+        verdict = _verdicts.get(url)
+    if verdict and verdict.is_expired():
+        return None
+    return verdict
+
+
+def put(url, is_candidate, width=0, height=0, byte_size=0, reason=None):
+    verdict = ImageVerdict(url=url[:ImageVerdict.url.type.length], is_candidate=is_candidate,
+                           width=int(width), height=int(height), byte_size=byte_size, reason=reason,
+                           birth=datetime.utcnow())
+    with _lock:
+        _verdicts[url] = verdict
+        _dirty.add(url)
+
+
+def forget(url):
+    """Drops the verdict of an image that cannot be downloaded any more, so it is checked afresh next time"""
+    with _lock:
+        _verdicts[url] = None
+        _dirty.add(url)
+
+
+def flush():
+    start = time.time()
+    with _lock:
+        dirty = [(url, _verdicts[url]) for url in _dirty]
+        _dirty.clear()
+    with session_scope() as session:
+        for url, verdict in dirty:
+            if verdict is None:  # see `forget`
+                session.execute(delete(ImageVerdict).where(ImageVerdict.url == url[:ImageVerdict.url.type.length]))
+                continue
+            verdict.access = datetime.utcnow()
+            session.merge(verdict)
+    cost = (time.time() - start) * 1000
+    logger.info(f'saved {len(dirty)} image verdicts, cost(ms): {cost:.2f}')
+
+
+def expire():
+    start = time.time()
+    stmt = delete(ImageVerdict).where(
+        ImageVerdict.birth < datetime.utcnow() - timedelta(seconds=config.image_verdict_ttl))
+    with session_scope() as session:
+        result = session.execute(stmt)
+    cost = (time.time() - start) * 1000
+    logger.info(f'evicted {result.rowcount} image verdicts, cost(ms): {cost:.2f}')
+    return result.rowcount
@@ -0,0 +1,138 @@
+# coding: utf-8
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()  # the stage running in this thread, see `Deadline.run`
+
+
+class StageTimeout(Exception):
+
+    def __init__(self, stage, budget):
+        super().__init__(f'{stage} stage exceeded its {budget:.1f}s budget')
+        self.stage = stage
+        self.budget = budget
+
+
+class Stage(object):
+    """
+    A stage running in its own thread. Time spent `waiting` for shared resources, e.g. the local llm
+    or the openai quota, is not counted against its budget.
+    """
+
+    def __init__(self, name, budget):
+        self.name = name
+        self.budget = budget
+        self.start = time.time()
+        self.waited = 0
+        self.waiting_since = None
+        self.cancelled = False  # set once the stage is abandoned
+
+    def elapsed(self):
+        now = time.time()
+        waited = self.waited + (now - self.waiting_since if self.waiting_since is not None else 0)
+        return now - self.start - waited
+
+    def check(self):
+        if self.cancelled:
+            raise StageTimeout(self.name, self.budget)
+
+
+def current_stage() -> Stage:
+    return getattr(_local, 'stage', None)
+
+
+def check_cancelled():
+    """Raises `StageTimeout` in an abandoned stage, called before side effects like db writes"""
+    stage = current_stage()
+    if stage is not None:
+        stage.check()
+
+
+@contextmanager
+def waiting():
+    """Time spent inside is not counted against the budget of the current stage"""
+    stage = current_stage()
+    if stage is None or stage.waiting_since is not None:
+        yield
+        return
+    stage.waiting_since = time.time()
+    try:
+        yield
+    finally:
+        stage.waited += time.time() - stage.waiting_since
+        stage.waiting_since = None
+
+
+class Deadline(object):
+    """
+    Time budget of a round. Every stage of `News.pull_content` (fetch, summarize, image)
+    gets a slice of `stage_budget`, capped by what is left of the whole round. Without budgets,
+    e.g. for the daily pages, stages just run in the calling thread.
+
+    A stage runs in a daemon thread; when its slice runs out the thread is abandoned (python threads
+    cannot be killed) and `StageTimeout` is raised, so the caller can fall back to the cached summary.
+    The abandoned stage is cancelled: it stops at the next `check_cancelled`, which guards shared
+    resources and db or image writes, so it has no side effects after its caller gave up on it.
+    """
+
+    def __init__(self, seconds=None, stage_budget=None):
+        self.start = time.time()
+        self.seconds = seconds
+        self.stage_budget = stage_budget or {}
+        self.lock = threading.Lock()
+        self.downgraded = []  # (news, stage)
+
+    def remaining(self):
+        if self.seconds is None:
+            return float('inf')
+        return self.seconds - (time.time() - self.start)
+
+    def slice(self, stage):
+        return max(min(self.stage_budget.get(stage, float('inf')), self.remaining()), 0)
+
+    def run(self, stage, func, *args):
+        budget = self.slice(stage)
+        if budget <= 0:
+            raise StageTimeout(stage, 0)
+        if budget == float('inf'):
+            return func(*args)
+        running = Stage(stage, budget)
+        result = {}
+
+        def target():
+            _local.stage = running
+            try:
+                result['value'] = func(*args)
+            except BaseException as e:
+                result['error'] = e
+
+        thread = threading.Thread(target=target, daemon=True, name=f'{threading.current_thread().name}-{stage}')
+        thread.start()
+        while True:
+            # The budget does not run while the stage is waiting, the round does
+            thread.join(max(min(budget - running.elapsed(), self.remaining()), 0))
+            if not thread.is_alive():
+                break
+            if running.elapsed() >= budget or self.remaining() <= 0:
+                running.cancelled = True
+                raise StageTimeout(stage, budget)
+        if 'error' in result:
+            raise result['error']
+        return result['value']
+
+    def downgrade(self, news, stage):
+        with self.lock:
+            self.downgraded.append((news, stage))
+
+    def report(self):
+        cost = time.time() - self.start
+        if not self.downgraded:
+            logger.info(f'round finished in {cost:.1f}s, no item downgraded')
+            return
+        logger.warning(f'round finished in {cost:.1f}s, {len(self.downgraded)} items downgraded to cache')
+        for news, stage in sorted(self.downgraded, key=lambda x: x[0].rank):
+            logger.warning(f'  #{news.rank} {stage} timed out: {news.url}')
@@ -0,0 +1,138 @@
+# coding: utf-8
+import heapq
+import itertools
+import logging
+import re
+import threading
+import time
+from collections import deque
+
+import openai
+
+import config
+from hacker_news.deadline import check_cancelled, current_stage, waiting
+
+logger = logging.getLogger(__name__)
+
+WINDOW = 60  # quotas are per minute
+MAX_RETRIES = 3  # of a request answered with 429
+POLL = 1  # seconds between checks whether a queued request is still wanted
+duration_patt = re.compile(r'([\d.]+)(ms|h|m|s)')
+
+
+def parse_duration(value) -> float:
+    """Seconds of a reset header, e.g. "20", "6.5s", "1m30s" or "120ms", 0 when it is not one"""
+    value = str(value or '').strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    return sum(float(number) * units[unit] for number, unit in duration_patt.findall(value))
+
+
+class Dispatcher(object):
+    """
+    Sends openai requests within the provider's quota, at most `rpm` requests and `tpm` tokens
+    in any minute, 0 for no limit. Items are pulled in threads, so several requests are in flight at once,
+    and those over the quota wait here, the highest priority (news score) first.
+
+    The limits come from config, and are lowered to the x-ratelimit-limit-* headers of 429 answers.
+    A 429 stops all requests until its retry-after or reset headers say so, then the request is queued again.
+    Requests of items given up by their `Deadline` leave the queue without being sent.
+    """
+
+    def __init__(self, rpm=0, tpm=0, clock=time.monotonic):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.clock = clock
+        self.cond = threading.Condition()
+        self.queue = []  # heap of (-priority, seq)
+        self.seq = itertools.count()
+        self.sent = deque()  # [time, tokens] of requests in the last minute
+        self.paused_until = 0
+
+    def call(self, func, tokens, priority=0):
+        """Call `func`, which sends a request of about `tokens` tokens, when the quota allows"""
+        for retry in range(MAX_RETRIES + 1):
+            usage = self.acquire(tokens, priority)
+            try:
+                resp = func()
+            except openai.error.RateLimitError as e:
+                self.back_off(e.headers)
+                if retry == MAX_RETRIES:
+                    raise
+                logger.info(f'rate limited, retry #{retry + 1} after {self.paused_until - self.clock():.1f}s, {e}')
+                continue
+            try:
+                usage[1] = resp['usage']['total_tokens']  # what is really used, instead of the guess
+            except (KeyError, TypeError):
+                pass
+            return resp
+
+    def acquire(self, tokens, priority):
+        start = self.clock()
+        stage = current_stage()
+        with self.cond, waiting():
+            ticket = (-priority, next(self.seq))
+            heapq.heappush(self.queue, ticket)
+            try:
+                while True:
+                    check_cancelled()  # the item is given up, leave the quota to others
+                    wait = self.wait_time(tokens) if self.queue[0] == ticket else None
+                    if wait is not None and wait <= 0:
+                        break
+                    if stage is not None:  # wake up to see if it is cancelled
+                        wait = POLL if wait is None else min(wait, POLL)
+                    self.cond.wait(wait)
+            finally:
+                self.queue.remove(ticket)
+                heapq.heapify(self.queue)
+                self.cond.notify_all()  # the next one in the queue
+            usage = [self.clock(), tokens]
+            self.sent.append(usage)
+        cost = self.clock() - start
+        if cost > 1:
+            logger.info(f'waited {cost:.1f}s for the quota, priority {priority}, {tokens} tokens')
+        return usage
+
+    def wait_time(self, tokens) -> float:
+        """Seconds until a request of `tokens` tokens is within the quota"""
+        now = self.clock()
+        if now < self.paused_until:
+            return self.paused_until - now
+        while self.sent and self.sent[0][0] <= now - WINDOW:
+            self.sent.popleft()
+        wait = 0
+        if self.rpm and len(self.sent) >= self.rpm:
+            wait = self.sent[len(self.sent) - self.rpm][0] + WINDOW - now
+        if self.tpm:
+            # A request over the whole quota goes alone, it would never fit otherwise
+            excess = sum(used for _, used in self.sent) + tokens - self.tpm
+            for sent_at, used in self.sent:
+                if excess <= 0:
+                    break
+                excess -= used
+                wait = max(wait, sent_at + WINDOW - now)
+        return wait
+
+    def back_off(self, headers):
+        headers = {name.lower(): value for name, value in (headers or {}).items()}
+        with self.cond:
+            for name, attr in (('x-ratelimit-limit-requests', 'rpm'), ('x-ratelimit-limit-tokens', 'tpm')):
+                try:
+                    limit = int(headers.get(name) or 0)
+                except ValueError:
+                    continue
+                if limit and (not getattr(self, attr) or limit < getattr(self, attr)):
+                    logger.info(f'{attr} limit is {limit} from now on')
+                    setattr(self, attr, limit)
+            wait = parse_duration(headers.get('retry-after'))
+            if not wait:
+                wait = max(parse_duration(headers.get('x-ratelimit-reset-requests')),
+                           parse_duration(headers.get('x-ratelimit-reset-tokens')))
+            self.paused_until = max(self.paused_until, self.clock() + (wait or WINDOW))
+            self.cond.notify_all()
+
+
+dispatcher = Dispatcher(config.openai_rpm, config.openai_tpm)
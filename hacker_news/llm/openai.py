@@ -8,11 +8,12 @@ import openai
 import tiktoken
 import config
 from db.summary import Model
+from hacker_news.llm.dispatcher import dispatcher
 
 logger = logging.getLogger(__name__)
 
 
-def context_limit():
+def model_context_limit():
     model = config.openai_model
     if 'cloudflare.com' in (openai.api_base or '').lower():
         return 32 * 1024
@@ -24,11 +25,17 @@ def context_limit():
         return 16 * 1024
     # if 'gemma' in model or 'llama' in model or '8192' in model:
     #     return 8 * 1024
-    if 'groq' in openai.api_base:
-        return 6000  # tokens per minute (TPM) limit: 6000
     return 8 * 1024
 
 
+def context_limit():
+    # A request over the tokens per minute quota never goes through, e.g. 6000 of groq
+    limit = model_context_limit()
+    if config.openai_tpm:
+        return min(limit, config.openai_tpm)
+    return limit
+
+
 def model_family() -> Model:
     if 'llama' in config.openai_model:
         return Model.LLAMA
@@ -41,6 +48,23 @@ def model_family() -> Model:
     return Model.OPENAI
 
 
+def encoding():
+    try:
+        return tiktoken.encoding_for_model(config.openai_model)  # We have openai compatible apis now
+    except KeyError:
+        return tiktoken.encoding_for_model('gpt-3.5-turbo')
+
+
+def count_tokens(text) -> int:
+    try:
+        return len(encoding().encode(text, disallowed_special=()))
+    except Exception as e:  # tiktoken downloads its encodings on first use
+        logger.warning(f'Failed to load tiktoken encoding, {e}')
+        # Not len / 4, non-ascii chars like Chinese are about a token each
+        ascii_chars = sum(char.isascii() for char in text)
+        return ascii_chars // 4 + len(text) - ascii_chars
+
+
 def sanitize_for_openai(text, overhead):
     text = text.replace('```', ' ').strip()  # in case of prompt injection
 
@@ -50,10 +74,7 @@ def sanitize_for_openai(text, overhead):
         if len(text) > (limit - overhead) * 4:
             text = text[:int((limit - overhead) * 4)]
     elif len(text) > limit * 2:
-        try:
-            enc = tiktoken.encoding_for_model(config.openai_model)  # We have openai compatible apis now
-        except KeyError:
-            enc = tiktoken.encoding_for_model('gpt-3.5-turbo')
+        enc = encoding()
         tokens = enc.encode(text)
         if len(tokens) > limit - overhead:  # 4096: model's context limit
             text = enc.decode(tokens[:limit - overhead])
@@ -64,7 +85,7 @@ def sanitize_title(title):
     return title.replace('"', "'").replace('\n', ' ').strip()
 
 
-def call_openai_family(content: str, sys_prompt: str) -> str:
+def call_openai_family(content: str, sys_prompt: str, priority=0) -> str:
     start_time = time.time()
 
     # 200: function + prompt tokens (to reduce hitting rate limit)
@@ -95,15 +116,17 @@ def call_openai_family(content: str, sys_prompt: str) -> str:
         kwargs['reasoning_format'] = 'hidden'
 
     logger.warning(f'content: {content}')  # for syslog
-    resp = openai.ChatCompletion.create(
-        messages=[
-            {
-                "role": "system",
-                "content": sys_prompt
-            },
-            {'role': 'user', 'content': content},
-        ],
-        **kwargs)
+    messages = [
+        {
+            "role": "system",
+            "content": sys_prompt
+        },
+        {'role': 'user', 'content': content},
+    ]
+    # plus the answer, ~4 characters a token
+    tokens = count_tokens(sys_prompt) + count_tokens(content) + int(config.summary_size / 4)
+    resp = dispatcher.call(lambda: openai.ChatCompletion.create(messages=messages, **kwargs),
+                           tokens, priority)
     logger.warning(f'took {time.time() - start_time}s to generate: '
                    # Default str(resp) prints \u516c
                    f'{json.dumps(resp.to_dict_recursive(), sort_keys=True, indent=2, ensure_ascii=False)}')
@@ -140,11 +163,12 @@ def call_openai_family(content: str, sys_prompt: str) -> str:
     return answer.strip()
 
 
-def summarize_by_openai_family(content: str) -> str:
+def summarize_by_openai_family(content: str, priority=0) -> str:
     return call_openai_family(content,
                               "You are a helpful summarizer. Please think step by step to summarize all user's input in 2 concise English sentences. Ensure the summary does not exceed 250 "
-                              "characters. Provide response in plain text format without any Markdown formatting.")
+                              "characters. Provide response in plain text format without any Markdown formatting.", priority)
 
 
-def translate_by_openai_family(content: str, lang: str) -> str:
-    return call_openai_family(content, f"You are a helpful translator. Translate user's input into {lang}.")
+def translate_by_openai_family(content: str, lang: str, priority=0) -> str:
+    return call_openai_family(content, f"You are a helpful translator. Translate user's input into {lang}.",
+                              priority)
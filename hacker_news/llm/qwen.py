@@ -1,11 +1,14 @@
 import logging
 import re
+import threading
 
 import config
+from hacker_news.deadline import check_cancelled, waiting
 
 logger = logging.getLogger(__name__)
 
 _llm = None  # lazy load
+_llm_lock = threading.Lock()  # llama.cpp contexts must not be shared by concurrent callers
 _SUMMARY_SYSTEM_PROMPT = (
     'You summarize Hacker News articles for a technical audience. '
     'Return exactly two concise English sentences, no more than 250 characters. '
@@ -62,6 +65,17 @@ def _clean_response(response):
 
 
 def summarize_by_local_qwen(content: str) -> str:
+    check_cancelled()
+    with waiting():
+        _llm_lock.acquire()
+    try:
+        check_cancelled()  # do not infer for an item given up while waiting for the lock
+        return _summarize(content)
+    finally:
+        _llm_lock.release()
+
+
+def _summarize(content):
     llm = _get_llm()
     content = _truncate_content(llm, content.strip())
     if not content:
@@ -1,4 +1,3 @@
-import json
 import logging
 import os
 import re
@@ -8,8 +7,10 @@ import openai
 from slugify import slugify
 
 import config
+import db.image
 import db.summary
 from db.summary import Model
+from hacker_news.deadline import Deadline, StageTimeout, check_cancelled
 from hacker_news.llm.openai import summarize_by_openai_family, model_family, translate_by_openai_family
 from page_content_extractor import parser_factory
 from page_content_extractor.webimage import WebImage
@@ -37,6 +38,7 @@ class News:
         self.image = None
         self.img_id = ''
         self.cache: db.Summary = db.Summary(url)
+        self.deadline = Deadline()
 
     def __repr__(self):
         return f'{self.rank} - {self.title} - {self.url} - {self.score} - {self.author}- {self.submit_time}'
@@ -46,7 +48,9 @@ class News:
             return self.image.url
         return ''
 
-    def pull_content(self):
+    def pull_content(self, deadline: Deadline = None):
+        if deadline:
+            self.deadline = deadline
         try:
             self.cache = db.summary.get(self.url)
             if not self.title and hasattr(self.parser, 'title'):
@@ -58,6 +62,11 @@ class News:
             self.summary, self.summarized_by = self.summarize()
             self.cache.summary, self.cache.model = self.summary, self.summarized_by.value
             self.fetch_feature_image()
+        except StageTimeout as e:
+            logger.warning('#%d downgraded to cache, %s: %s', self.rank, e, self.url)
+            self.deadline.downgrade(self, e.stage)
+            if not self.img_id:
+                self.load_cached_image()
         except Exception as e:
             logger.exception('Failed to fetch %s, %s', self.url, e)
         if not self.summary:  # last resort, in case remote server is down
@@ -68,7 +77,7 @@ class News:
     def parser(self):  # lazy load
         if not hasattr(self, '_parser'):
             logger.info("#%d, fetching %s", self.rank, self.url)
-            self._parser = parser_factory(self.url)
+            self._parser = self.deadline.run('fetch', parser_factory, self.url)
         return self._parser
 
     def get_score(self) -> int:
@@ -91,8 +100,9 @@ class News:
             logger.info(f"Cache hit for {self.url}, model {self.cache.model}")
             return self.cache.summary, self.cache.get_summary_model()
         if content is None:
+            content = self.parser.get_content(config.max_content_size)  # already extracted in the fetch stage
             # Replace consecutive spaces with a single space
-            content = re.sub(r'\s+', ' ', self.parser.get_content(config.max_content_size))
+            content = re.sub(r'\s+', ' ', content)
             # From arxiv or pdf
             content = re.sub(r'^(abstract|summary):\s*', '', content,
                              flags=re.IGNORECASE).strip()
@@ -105,7 +115,23 @@ class News:
             logger.info(
                 f'No need to summarize since we have a small text of size {len(content)}')
             return content, Model.FULL
+        content_hash = db.summary.fingerprint(content)
+        if self.cache.is_unchanged(content_hash) and not self.cache.is_retry_due():
+            logger.info(f'Content of {self.url} is unchanged, retry #{self.cache.retries + 1} after '
+                        f'{self.cache.next_retry}, use cached summary by {self.cache.model}')
+            return self.cache.summary, self.cache.get_summary_model()
+        try:
+            summary, summarized_by = self.deadline.run('summarize', self.summarize_by_llm, content)
+        except Exception:
+            # Timed out or failed, back off as if no llm answered, instead of resending the same content every round
+            self.cache.record_attempt(content_hash, Model.PREFIX)
+            if not self.cache.summary:  # so the unchanged content is recognized next round
+                self.cache.summary, self.cache.model = content, Model.PREFIX.value
+            raise
+        self.cache.record_attempt(content_hash, summarized_by)
+        return summary, summarized_by
 
+    def summarize_by_llm(self, content) -> (str, Model):
         summary = self.summarize_by_openai(content)
         if summary:
             return summary, model_family()
@@ -130,9 +156,11 @@ class News:
             return ''
 
         try:
-            sum = summarize_by_openai_family(content)
+            sum = summarize_by_openai_family(content, self.get_score())
             self.translate_summary(sum)
             return sum
+        except StageTimeout:
+            raise
         except Exception as e:
             logger.exception(f'Failed to summarize using openai, key #{config.openai_key_index}, {e}')  # Make this error explicit in the log
             return ''
@@ -143,14 +171,17 @@ class News:
         try:
             if db.translation.exists(summary, 'zh'):
                 return
-            trans = translate_by_openai_family(summary, 'simplified Chinese')
+            trans = translate_by_openai_family(summary, 'simplified Chinese', self.get_score())
             for char in trans:
                 if '\u4e00' <= char <= '\u9fff':
                     break
             else:
                 logger.info(f'No Chinese chars in translation: {trans}')
                 return
+            check_cancelled()
             db.translation.add(summary, trans, 'zh')
+        except StageTimeout:
+            raise
         except Exception as e:
             logger.exception(f'Failed to translate summary using openai, key #{config.openai_key_index}, {e}')
 
@@ -178,23 +209,41 @@ class News:
         if config.force_fetch_feature_image:
             logger.warning(f'Will force fetch feature image')
         elif self.cache.image_name is not None:
-            if os.path.exists(os.path.join(config.image_dir, self.cache.image_name)):
-                self.image = WebImage.from_json_str(self.cache.image_json)
-                self.img_id = self.cache.image_name
+            if self.load_cached_image():
                 logger.info(f"Cache hit image {self.img_id}")
                 return
             else:
                 logger.info(f'{self.cache.image_name} not exist in {config.image_dir}')
-        tm = self.parser.get_illustration()
+        tm, name = self.deadline.run('image', self.download_feature_image, self.parser)
         if tm:
-            tm.try_compress()
-            fname = tm.uniq_name()
-            tm.save(os.path.join(config.image_dir, fname))
             self.image = tm
             self.cache.image_json = tm.to_json_str()
-            self.img_id = fname
+            self.img_id = name
         self.cache.image_name = self.img_id  # tried but not found
 
+    @staticmethod
+    def download_feature_image(parser) -> (WebImage, str):
+        tm = parser.get_illustration()
+        if tm:
+            analysis = tm.analysis  # before compression replaces the raw data
+            check_cancelled()
+            derivatives = tm.try_compress()
+            check_cancelled()
+            name = db.image.save(tm)
+            if derivatives:
+                tm.srcset = db.image.save_derivatives(name, derivatives)
+                tm.srcset[analysis.width] = name
+            return tm, name
+        return None, ''
+
+    def load_cached_image(self) -> bool:
+        if db.image.exists(self.cache.image_name):
+            self.image = WebImage.from_json_str(self.cache.image_json)
+            self.img_id = self.cache.image_name
+            db.image.touch(self.img_id)
+            return True
+        return False
+
     def summarize_by_local_qwen(self, content):
         if config.disable_local_qwen:
             logger.info("Local Qwen is disabled by env DISABLE_LOCAL_QWEN=1")
@@ -210,6 +259,8 @@ class News:
         try:
             from hacker_news.llm.qwen import summarize_by_local_qwen
             summary = summarize_by_local_qwen(content)
+        except StageTimeout:
+            raise
         except Exception:
             logger.exception('Failed to summarize using local Qwen')
             return ''
@@ -0,0 +1,61 @@
+# coding: utf-8
+import logging
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+def host_of(news):
+    try:
+        return urlsplit(news.url).hostname or ''
+    except ValueError:
+        return ''
+
+
+def pull_contents(news_list, concurrency=None, per_host=None, deadline=None):
+    """
+    Call `pull_content` of every news item in a bounded worker pool,
+    with at most `concurrency` items in flight and at most `per_host` of them on the same host,
+    so one slow site cannot occupy the whole pool. Results are returned in rank (input) order.
+    When a `deadline.Deadline` is given, each item is pulled within its budget.
+    """
+    concurrency = max(concurrency or config.pull_concurrency, 1)
+    per_host = max(per_host or config.pull_concurrency_per_host, 1)
+    start = time.time()
+    results = [None] * len(news_list)
+    pending = list(enumerate(news_list))
+    in_flight = {}  # future -> (index, host)
+    host_load = defaultdict(int)
+    args = (deadline,) if deadline else ()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='pull') as executor:
+        while pending or in_flight:
+            # Always start from the top ranked item whose host still has a free slot
+            i = 0
+            while i < len(pending) and len(in_flight) < concurrency:
+                index, news = pending[i]
+                host = host_of(news)
+                if host_load[host] >= per_host:
+                    i += 1
+                    continue
+                del pending[i]
+                host_load[host] += 1
+                in_flight[executor.submit(news.pull_content, *args)] = (index, host)
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, host = in_flight.pop(future)
+                host_load[host] -= 1
+                try:
+                    results[index] = future.result()
+                except Exception as e:
+                    logger.exception('Failed to pull %s, %s', news_list[index].url, e)
+    cost = (time.time() - start) * 1000
+    logger.info(f'pulled {len(news_list)} items, concurrency {concurrency}, per host {per_host}, cost(ms): {cost:.2f}')
+    if deadline:
+        deadline.report()
+    return results
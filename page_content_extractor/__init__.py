@@ -1,13 +1,23 @@
 ﻿# coding: utf-8
 import logging
+from urllib.parse import urlsplit
 
 import humanize
+import requests
+from requests.structures import CaseInsensitiveDict
 
-from page_content_extractor.http import session
+import config
+import db.extraction
+import db.host
+from hacker_news.deadline import check_cancelled
+from page_content_extractor.http import session, read_body
+from . import workers
 from .embeddable import EmbeddableExtractor
 from .exceptions import ParseError
 from .html import HtmlContentExtractor
+from .html_lxml import LxmlContentExtractor
 from .pdf import PdfExtractor
+from .result import ExtractResult
 
 __all__ = ['ParseError', 'parser_factory']
 
@@ -19,14 +29,85 @@ jina_prefix = 'https://r.jina.ai/'
 def parser_factory(url, use_jina=False):
     """
         Returns the extracted object, which should have at least two
-        methods `get_content` and `get_illustration`
+        methods `get_content` and `get_illustration`.
+        Parsing is CPU bound, it runs in worker processes, see `extract_response`
     """
     if not url.startswith('http'):
         url = 'http://' + url
     headers = None
     if use_jina:
         headers = {'x-respond-with': 'html'}
-    resp = session.get(url, headers=headers)
+    if not use_jina and not db.host.allow(urlsplit(url).hostname):
+        logger.info('Circuit of %s is open, switch to jina', url)
+        return parser_factory(jina_prefix + url, use_jina=True)
+    resp = download(session.get(url, headers=headers, stream=True), url)
+    p = extract_response(resp, url, use_jina)
+    if not use_jina and p.is_empty():
+        logger.info('%s is empty? switch to jina', p.url)
+        try:
+            return parser_factory(jina_prefix + url, use_jina=True)
+        except Exception as e:
+            logger.warning('jina %s throws an error: %s', jina_prefix + url, e)
+    return p
+
+
+def content_kind(resp):
+    # if no content-type is provided, Chrome set as a html
+    ct = resp.headers.get('content-type', 'text').lower()
+    if ct.startswith('application/pdf'):  # Some pdfs even have charset indicator, eg. "application/pdf; charset=utf-8"
+        return 'pdf'
+    if ct.startswith('text/plain'):
+        return 'text'
+    if ct.startswith('text') or 'html' in ct or 'xml' in ct or 'charset' in ct:
+        return 'html'
+    return None
+
+
+def download(resp, url):
+    """Reads the streamed body, truncated at the download ceiling of its content type"""
+    kind = content_kind(resp)
+    if kind is None and EmbeddableExtractor.is_embeddable(url):
+        kind = 'html'
+    if kind is None:  # No need to download content we have no idea how to parse
+        resp.close()
+        raise TypeError(f'I have no idea how the {resp.headers.get("content-type")} is formatted')
+    max_bytes = config.max_download_bytes[kind]
+    if read_body(resp, max_bytes):
+        logger.warning('%s is truncated at %s', resp.url, humanize.naturalsize(max_bytes, binary=True))
+    return resp
+
+
+def extract_response(resp, url, use_jina=False):
+    """Extracts a downloaded response, or reuses what was extracted from the same body before"""
+    digest = db.extraction.digest_of(resp.url, resp.content)
+    cached = db.extraction.get(digest)
+    if cached:
+        logger.info('Reuse the content extracted from the same body of %s', resp.url)
+        return ExtractResult.from_json_str(cached)
+    if content_kind(resp) == 'pdf':  # its pages are spread over the worker processes instead, see `PdfExtractor`
+        p = extract(*pickled_response(resp), url, use_jina)
+    else:
+        p = workers.run(extract, *pickled_response(resp), url, use_jina)
+    check_cancelled()
+    db.extraction.put(digest, p.to_json_str())
+    return p
+
+
+def pickled_response(resp):
+    """What a worker process needs to rebuild the response, see `extract`"""
+    return resp.content, resp.encoding, dict(resp.headers), resp.status_code, resp.url
+
+
+def extract(content, encoding, headers, status_code, resp_url, url, use_jina=False) -> ExtractResult:
+    """
+    Parses a downloaded response in a worker process, or in place for pdfs. Only what `News` needs is sent back,
+    not the whole tree
+    """
+    resp = requests.Response()
+    resp._content, resp._content_consumed = content, True
+    resp.encoding = encoding  # decoded here, guessing it by content is CPU bound too
+    resp.headers = CaseInsensitiveDict(headers)
+    resp.status_code, resp.url = status_code, resp_url
     # Some sites like science.org forbid us by responding 403, but still have meta description tags, so donot raise here
     if use_jina:  # Switch to origin url
         resp.raise_for_status()
@@ -36,27 +117,20 @@ def parser_factory(url, use_jina=False):
     if EmbeddableExtractor.is_embeddable(url):
         logger.info('Get an embeddable to parse(%s)', resp.url)
         try:
-            return EmbeddableExtractor(resp.text, resp.url)
+            return ExtractResult.of(EmbeddableExtractor(resp.text, resp.url))
         except Exception as e:
             logger.info('%s is not an embeddable, try another(%s)', resp.url, e)
 
-    # if no content-type is provided, Chrome set as a html
-    ct = resp.headers.get('content-type', 'text').lower()
-    if ct.startswith('application/pdf'):  # Some pdfs even have charset indicator, eg. "application/pdf; charset=utf-8"
+    kind = content_kind(resp)
+    if kind == 'pdf':
         logger.info(f'Get a pdf to parse, {resp.url}, size: {humanize.naturalsize(resp.headers.get("content-length", "-1"), binary=True)}')
         try:
-            return PdfExtractor(resp.content, resp.url)
+            return ExtractResult.of(PdfExtractor(resp.content, resp.url))
         except ParseError:
             logger.exception('Failed to parse this pdf file, %s', resp.url)
-    elif ct.startswith('text') or 'html' in ct or 'xml' in ct or 'charset' in ct:
-        logger.info('Get an %s to parse', ct)
-        p = HtmlContentExtractor(resp.text, resp.url)
-        if not use_jina and p.is_empty():
-            logger.info('%s is empty? switch to jina', resp.url)
-            try:
-                return parser_factory(jina_prefix+url, use_jina=True)
-            except Exception as e:
-                logger.warning('jina %s throws an error: %s', jina_prefix+url, e)
-        return p
-
-    raise TypeError(f'I have no idea how the {ct} is formatted')
+    elif kind:
+        logger.info('Get an %s to parse', resp.headers.get('content-type', 'text').lower())
+        extractor = LxmlContentExtractor if config.html_engine == 'lxml' else HtmlContentExtractor
+        return ExtractResult.of(extractor(resp.text, resp.url))
+
+    raise TypeError(f'I have no idea how the {resp.headers.get("content-type")} is formatted')
@@ -1,2 +1,11 @@
 class ParseError(Exception):
     pass
+
+
+class CircuitOpenError(Exception):
+    """Requests to this host are short-circuited, see `db.host`"""
+    pass
+
+
+class DownloadCancelled(Exception):
+    pass
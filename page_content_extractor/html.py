@@ -1,7 +1,6 @@
 # coding: utf-8
 import logging
 import re
-from collections import defaultdict
 from functools import lru_cache
 from urllib.parse import urljoin
 
@@ -9,8 +8,8 @@ from bs4 import BeautifulSoup as BS, Tag, NavigableString
 from markupsafe import escape
 
 import config
-from .utils import tokenize, string_inclusion_ratio
-from .webimage import WebImage
+from .utils import tokenize, is_string_included, token_stats, merge_token_stats, token_count
+from .webimage import pick_illustration
 
 logger = logging.getLogger(__name__)
 
@@ -28,19 +27,74 @@ negative_patt = re.compile(r'comment|combx|disqus|foot|header|menu|rss|button|hi
                            'shoutbox|sidebar|sponsor|vote|meta|shar|ad-', re.IGNORECASE)
 positive_patt = re.compile(r'article|entry|post|abstract|main|content|toptext|'
                            'section|text|preview|view|story-body', re.IGNORECASE)
+# obvious hidden ones, the same as css selectors like [style~="display:none"]
+hidden_styles = ('display:none', 'visibility:hidden')
+css_whitespace = re.compile('[ \t\r\n\f]+')
+description_patt = re.compile('description', re.I)
+og_image_patt = re.compile('og:image$', re.I)
+twitter_image_patt = re.compile('twitter:image', re.I)
+icon_patt = re.compile('icon', re.I)
+start_tag_patt = re.compile('<[a-zA-Z]')
 
 
-def tag_equal(self, other):
-    return id(self) == id(other)
-
+class NodeStats(object):
+    """
+    Scores of a node. They are kept aside, as an unknown attribute of a bs4 Tag is looked up as
+    a descendant tag (`node.score` is `node.find('score')`), and lxml elements cannot hold state.
+    """
+    __slots__ = ('node', 'score', 'text_len', 'real_text_len', 'impact_factor',
+                 'tokens', 'stripped_len', 'link_len', 'has_newline')
+
+    def __init__(self, node):
+        self.node = node  # keep it alive, so its id is not reused
+        self.score = self.text_len = self.real_text_len = self.impact_factor = None
+        self.tokens = None  # see utils.token_stats
+        self.stripped_len = 0  # length of the text, with every string stripped
+        self.link_len = 0  # the same, of the text in <a> under it
+        self.has_newline = False
+
+
+class TextFrame(object):
+    """A node being walked by `HtmlContentExtractor.calc_text_stats`, with what its children add up to so far"""
+    __slots__ = ('stats', 'negative_factor', 'children', 'text_len', 'tokens', 'stripped_len', 'link_len',
+                 'has_newline')
+
+    def __init__(self, stats, negative_factor, children):
+        self.stats = stats
+        self.negative_factor = negative_factor
+        self.children = children
+        self.text_len = 0
+        self.tokens = None
+        self.stripped_len = self.link_len = 0
+        self.has_newline = False
+
+
+def unroll(generator_func, *args):
+    """
+    Runs a recursive generator function without recursion, so deep documents do not hit the recursion limit.
+    Instead of calling itself, it yields the arguments of the nested call, and is sent back its result.
+    """
+    stack = [generator_func(*args)]
+    result = None
+    while True:
+        try:
+            args = stack[-1].send(result)
+        except StopIteration as stop:
+            stack.pop()
+            if not stack:
+                return stop.value
+            result = stop.value
+        else:
+            stack.append(generator_func(*args))
+            result = None
 
-# Use tag as keys in dom scores,
-# two tags with the same content and attributes should not consider equal to each other.
-# Tag.__eq__ = tag_equal
 
 class HtmlContentExtractor(object):
     """
     see https://github.com/scyclops/Readable-Feeds/blob/master/readability/hn.py
+
+    The scoring works on a BeautifulSoup tree; everything touching the tree goes through the few
+    methods under "Tree primitives", which `LxmlContentExtractor` overrides to work on a plain lxml tree.
     """
 
     def __init__(self, html, url=''):
@@ -50,18 +104,13 @@ class HtmlContentExtractor(object):
 
         self.max_score = -1
         # dict uses __eq__ to identify key, while in BS two different nodes
-        # will also be considered equal, DO not use that
-        self.scores = defaultdict(int)
-        self.doc = BS(html, features="lxml")
+        # will also be considered equal, so nodes are keyed by id
+        self._stats: dict[int, NodeStats] = {}
+        self.url = url
+        self.doc = self.parse(self.cut_markup(html))
 
-        self.title = (self.doc.title.string if self.doc.title else '') or ''
         self.article = self.doc
-        self.url = url
-        # call it before purge
-        self.get_favicon_url()
-        self.get_meta_description()
-        self.get_meta_image()
-        self.purge()
+        self.harvest_and_purge()
         self.find_main_content()
 
         # clean ups
@@ -69,7 +118,91 @@ class HtmlContentExtractor(object):
         self.relative_path2_abs_url()
 
     def is_empty(self):
-        return not self.article.get_text(separator='', strip=True)
+        return not self.text(self.article).strip()
+
+    def cut_markup(self, html):
+        """
+        Cuts the tail of a huge page, at `config.max_parse_size` chars or before its `config.max_parse_nodes`th tag,
+        so parsing it takes bounded time and memory. The head, with the title and metadata, is kept.
+        """
+        if not isinstance(html, str):  # pages are decoded by requests, leave the rest to the parser
+            return html
+        end = len(html)
+        if end > config.max_parse_size:
+            end = html.rfind('<', 0, config.max_parse_size)  # not in the middle of a tag
+            end = config.max_parse_size if end < 0 else end
+        if end > config.max_parse_nodes:  # each tag takes 2 chars at least
+            for i, match in enumerate(start_tag_patt.finditer(html, 0, end)):
+                if i == config.max_parse_nodes:
+                    end = match.start()
+                    break
+        if end < len(html):
+            logger.info('%s is cut at %d of %d chars to parse', self.url, end, len(html))
+            return html[:end]
+        return html
+
+    # Tree primitives
+    def parse(self, html):
+        return BS(html, features="lxml")
+
+    def name(self, node) -> str:
+        return node.name
+
+    def children(self, node):
+        """Direct children, tags and text strings, comments and the like are left out"""
+        for child in node.children:
+            if isinstance(child, Tag) or type(child) is NavigableString:
+                yield child
+
+    def ancestors(self, node):
+        return node.parents
+
+    def descendants(self, node):
+        """Descendant tags, in document order"""
+        for child in node.descendants:
+            if isinstance(child, Tag):
+                yield child
+
+    def find_all(self, node, name=True, attrs=None) -> list:
+        """Descendant tags, in document order. Values of `attrs` are regular expressions, or True if only present"""
+        return node.find_all(name, attrs=attrs or {})
+
+    def match_attr(self, node, attr, expected):
+        value = self.get(node, attr)
+        if value is None:
+            return False
+        if expected is True:
+            return True
+        # Like bs4, a multi-valued attribute matches if any of its values, or all of them joined, matches
+        values = value + [' '.join(value)] if isinstance(value, list) else [value]
+        if isinstance(expected, re.Pattern):
+            return any(expected.search(v) for v in values)
+        return expected in values
+
+    def get(self, node, attr, default=None):
+        """Attributes like `class` are lists of values"""
+        return node.get(attr, default)
+
+    def attrs(self, node) -> dict:
+        return node.attrs
+
+    def set(self, node, attr, value):
+        node[attr] = value
+
+    def remove(self, node):
+        node.extract()  # decompose calls extract with some more steps
+
+    def text(self, node) -> str:
+        return node.get_text()
+
+    def string(self, node) -> str:
+        return node.string
+
+    def stats(self, node) -> NodeStats:
+        stats = self._stats.get(id(node))
+        if stats is None:
+            stats = self._stats[id(node)] = NodeStats(node)
+        return stats
 
     # def __del__(self):
     #     # TODO won't call
@@ -82,50 +215,55 @@ class HtmlContentExtractor(object):
         # First we give a high point to nodes who have
         # a descendant that is a header tag and matches title most
         def is_article_header(node):
-            if re.match(r'h\d+|td', node.name, re.I):
-                if string_inclusion_ratio(node.text, self.title) > .85:
+            if re.match(r'h\d+|td', self.name(node), re.I):
+                if is_string_included(self.text(node), self.title, .85):
                     return True
             return False
 
-        for node in doc.find_all(is_article_header):
+        for node in filter(is_article_header, self.descendants(doc)):
             # Give eligible node a high score
-            logger.info('Found an eligible title: %s', node.text.strip())
-            # self.scores[node] = 1000
-            for parent in node.parents:
-                if not parent or parent is doc:
+            logger.info('Found an eligible title: %s', self.text(node).strip())
+            for parent in self.ancestors(node):
+                if parent is None or parent is doc:
                     break
-                parent.score = (parent.score or 0) + self.calc_effective_text_len(parent) * 2
+                stats = self.stats(parent)
+                stats.score = (stats.score or 0) + self.calc_effective_text_len(parent) * 2
                 self.set_node_factor(parent, 'title', 2)
 
     def set_article_tag_point(self, doc):
-        for node in doc.find_all('article'):
+        for node in self.find_all(doc, 'article'):
             # Should be less than most titles but better than short ones
-            node.score = node.score or 0 + self.calc_effective_text_len(node) * 2
+            stats = self.stats(node)
+            stats.score = stats.score or 0 + self.calc_effective_text_len(node) * 2
             self.set_node_factor(node, 'article', 2)
 
     def calc_node_score(self, node, depth=.1):
         """
         The one with most text is the most likely article, naive and simple
         """
-        text_len = self.calc_effective_text_len(node)
-        # img_len = self.calc_img_area_len(cur_node)
-        # TODO take image as a factor
-        img_len = 0
-        impact_factor = 1
-        if self.has_positive_effect(node):
-            impact_factor = 2
-            self.set_node_factor(node, 'positive', impact_factor)
-        node.score = (node.score or (0 + text_len + img_len)) * impact_factor * (depth ** 1.5)
-        if node.score > self.max_score:
-            self.max_score = node.score
-            self.article = node
-
-        if logger.isEnabledFor(logging.DEBUG):
-            print(f"{' '*round(depth*10)}{' '.join(self.node_identify(node))}, text: {node.real_text_len:.2f}, eff_text: {node.text_len:.2f}, depth: {depth:.2f}, {self.describe_node_factor(node)}score: {node.score:.2f}")
-
-        for child in node.children:  # the direct children, not descendants
-            if isinstance(child, Tag):
-                self.calc_node_score(child, depth + 0.1)
+        stack = [(node, depth)]  # walked in pre-order, the first one of the same score wins
+        while stack:
+            node, depth = stack.pop()
+            text_len = self.calc_effective_text_len(node)
+            # img_len = self.calc_img_area_len(cur_node)
+            # TODO take image as a factor
+            img_len = 0
+            impact_factor = 1
+            if self.has_positive_effect(node):
+                impact_factor = 2
+                self.set_node_factor(node, 'positive', impact_factor)
+            stats = self.stats(node)
+            stats.score = (stats.score or (0 + text_len + img_len)) * impact_factor * (depth ** 1.5)
+            if stats.score > self.max_score:
+                self.max_score = stats.score
+                self.article = node
+
+            if logger.isEnabledFor(logging.DEBUG):
+                print(f"{' '*round(depth*10)}{' '.join(self.node_identify(node))}, text: {stats.real_text_len:.2f}, eff_text: {stats.text_len:.2f}, depth: {depth:.2f}, {self.describe_node_factor(node)}score: {stats.score:.2f}")
+
+            # the direct children, not descendants
+            children = [child for child in self.children(node) if not isinstance(child, str)]
+            stack.extend((child, depth + 0.1) for child in reversed(children))
 
     def find_main_content(self):
         self.calc_effective_text_len(self.doc)
@@ -133,50 +271,79 @@ class HtmlContentExtractor(object):
         self.set_article_tag_point(self.doc)
 
         self.calc_node_score(self.doc)
-        logger.info(f'Max score: {self.article.score or 0:.2f}, node: {" ".join(self.node_identify(self.article))}')
+        logger.info(f'Max score: {self.stats(self.article).score or 0:.2f}, node: {" ".join(self.node_identify(self.article))}')
+
+    def harvest_and_purge(self):
+        """
+        Gathers the title, favicon, meta description and meta images, and removes nodes that are never content,
+        in one walk of the document. Nodes are removed after the walk, so the metadata under <head> is seen.
+        """
+        title = favicon = None
+        descs, og_descs, og_images, twitter_images, doomed = [], [], [], [], []
+        for node in self.descendants(self.doc):
+            name = self.name(node)
+            if name == 'title':
+                title = node if title is None else title
+            elif name == 'meta':
+                # <meta name="twitter:description" content="..."/>
+                if self.match_attr(node, 'name', description_patt):
+                    descs.append(node)
+                # <meta property="og:description" content="..."/>
+                if self.match_attr(node, 'property', description_patt):
+                    og_descs.append(node)
+                # <meta property="og:image" content="..."/>
+                if self.match_attr(node, 'property', og_image_patt):
+                    og_images.append(node)
+                # <meta name="twitter:image:src" content="..."/>
+                if self.match_attr(node, 'name', twitter_image_patt):
+                    twitter_images.append(node)
+            elif name == 'link' and favicon is None and self.match_attr(node, 'rel', icon_patt):
+                favicon = node
+            if self.is_ignorable(node, name):
+                doomed.append(node)
+
+        self.title = (self.string(title) if title is not None else '') or ''
+        self._meta_desc = ''
+        for desc in descs + og_descs:
+            content = self.get(desc, 'content', '')
+            if len(content) > len(self._meta_desc):
+                # Reason to escape https://github.com/berthubert/trifecta/issues/38
+                self._meta_desc = escape(content)
+        self._meta_images = [self.get(img, 'content') for img in og_images + twitter_images
+                             if self.get(img, 'content', None)]
+        if favicon is not None:
+            favicon_path = self.get(favicon, 'href', '/favicon.ico')
+        elif 'archive.org' in self.url:
+            favicon_path = '/_static/images/archive.ico'
+        else:
+            favicon_path = '/favicon.ico'
+        self._favicon_url = urljoin(self.url, favicon_path)
+        for node in doomed:
+            self.remove(node)
 
     def get_meta_description(self):
-        if not hasattr(self, '_meta_desc'):
-            self._meta_desc = ''
-            # <meta name="twitter:description" content="..."/>
-            descs = self.doc.find_all('meta', attrs={'name': re.compile('description', re.I)})
-            # <meta property="og:description" content="..."/>
-            descs.extend(self.doc.find_all('meta', attrs={'property': re.compile('description', re.I)}))
-            for desc in descs:
-                content = desc.get('content', '')
-                if len(content) > len(self._meta_desc):
-                    # Reason to escape https://github.com/berthubert/trifecta/issues/38
-                    self._meta_desc = escape(content)
         return self._meta_desc
 
     def get_meta_image(self):
-        if not hasattr(self, '_meta_images'):
-            # <meta property="og:image" content="..."/>
-            meta_images = self.doc.find_all('meta', property=re.compile('og:image$', re.I))
-            # <meta name="twitter:image:src" content="..."/>
-            meta_images.extend(self.doc.find_all('meta', attrs={'name': re.compile('twitter:image', re.I)}))
-            image_src = []
-            for img in meta_images:
-                if img.get('content', None):
-                    image_src.append(img.get('content'))
-            self._meta_images = image_src
         return self._meta_images
 
     # debugging purpose
     def set_node_factor(self, node, factor, value):
-        if not node.impact_factor:
-            node.impact_factor = {}
-        node.impact_factor[factor] = value
+        stats = self.stats(node)
+        if not stats.impact_factor:
+            stats.impact_factor = {}
+        stats.impact_factor[factor] = value
 
     def describe_node_factor(self, node):
-        if not node.impact_factor:
+        stats = self.stats(node)
+        if not stats.impact_factor:
             return ''
-        return ', '.join(f"{k}: {v:.2f}" for k, v in node.impact_factor.items()) + ' '
+        return ', '.join(f"{k}: {v:.2f}" for k, v in stats.impact_factor.items()) + ' '
 
     def node_identify(self, node):
-        identifiers = [node.name] + node.get('class', [])
-        if node.get('id', ''):
-            identifiers.append(node.get('id'))
+        identifiers = [self.name(node)] + self.get(node, 'class', [])
+        if self.get(node, 'id', ''):
+            identifiers.append(self.get(node, 'id'))
         return identifiers
 
     def has_positive_effect(self, node):
@@ -196,26 +363,66 @@ class HtmlContentExtractor(object):
         Calc the total the length of text in a child, same as
         sum(len(s) for s in cur_node.stripped_strings)
         """
-        if node.text_len is not None:
-            return node.text_len
-        if self.has_negative_effect(node) or node.name == 'a':
+        return self.text_stats(node, negative_factor).text_len
+
+    def text_stats(self, node, negative_factor=1) -> NodeStats:
+        stats = self.stats(node)
+        if stats.text_len is None:
+            self.calc_text_stats(node, negative_factor)
+        return stats
+
+    def calc_text_stats(self, node, negative_factor=1):
+        """
+        Records the text length, token count, link text length and line breaks of every node under `node`,
+        in one post-order walk, so later decisions on a node do not walk its subtree again.
+        Nodes done by an earlier walk are taken as they are.
+        """
+        stack = [self.enter_text_frame(node, negative_factor)]
+        while stack:
+            frame = stack[-1]
+            for child in frame.children:
+                # Comments are left out by self.children
+                if isinstance(child, str):
+                    stripped_len = len(child.strip())
+                    frame.text_len += stripped_len + child.count(',') + \
+                                      child.count('，')  # Chinese comma
+                    frame.tokens = merge_token_stats(frame.tokens, token_stats(child))
+                    frame.stripped_len += stripped_len
+                    frame.has_newline = frame.has_newline or '\n' in child
+                    continue
+                child_stats = self.stats(child)
+                if child_stats.text_len is None:
+                    stack.append(self.enter_text_frame(child, frame.negative_factor))
+                    break  # back to the rest of the children after this one is done
+                self.add_child_text_stats(frame, child, child_stats)
+            else:
+                stack.pop()
+                stats = frame.stats
+                stats.real_text_len = frame.text_len
+                stats.text_len = frame.text_len * frame.negative_factor
+                stats.tokens = frame.tokens
+                stats.stripped_len = frame.stripped_len
+                stats.link_len = frame.link_len
+                stats.has_newline = frame.has_newline
+                if stack:
+                    self.add_child_text_stats(stack[-1], stats.node, stats)
+
+    def enter_text_frame(self, node, negative_factor):
+        if self.has_negative_effect(node) or self.name(node) == 'a':
             negative_factor *= 0.2
         if negative_factor != 1:
             self.set_node_factor(node, 'negative', negative_factor)
-        text_len = 0
-        for child in node.children:
-            if isinstance(child, Tag):
-                child_len = self.calc_effective_text_len(child, negative_factor)
-                # Restore original child_len, to avoid double punishment
-                text_len += child_len / negative_factor
-            # Comment is also an instance of NavigableString,
-            # so we should not use isinstance(child, NavigableString)
-            elif type(child) is NavigableString:
-                text_len += len(child.string.strip()) + child.string.count(',') + \
-                            child.string.count('，')  # Chinese comma
-        node.real_text_len = text_len
-        node.text_len = text_len * negative_factor
-        return node.text_len
+        return TextFrame(self.stats(node), negative_factor, self.children(node))
+
+    def add_child_text_stats(self, frame, child, child_stats):
+        # Restore original child_len, to avoid double punishment
+        frame.text_len += child_stats.text_len / frame.negative_factor
+        frame.tokens = merge_token_stats(frame.tokens, child_stats.tokens)
+        frame.stripped_len += child_stats.stripped_len
+        frame.link_len += child_stats.link_len
+        if self.name(child) == 'a':
+            frame.link_len += child_stats.stripped_len
+        frame.has_newline = frame.has_newline or child_stats.has_newline
 
     def calc_img_area_len(self, cur_node):
         return 0
@@ -227,17 +434,13 @@ class HtmlContentExtractor(object):
         #         img_len += self.calc_img_area_len(node)
         # return img_len
 
-    def purge(self):
-        for tname in ignored_tags:
-            for d in self.doc.find_all(tname):
-                d.extract()  # decompose calls extract with some more steps
-        # obvious hidden ones
-        hidden_styles = ('[style~="display:none"]', '[style~="display: none"]', '[style~="visibility:hidden"]', '[style~="visibility: hidden"]')
-        for style in hidden_styles:
-            for hidden in self.doc.select(style):
-                hidden.extract()
-        for style_links in self.doc.find_all('link', attrs={'type': 'text/css'}):
-            style_links.extract()
+    def is_ignorable(self, node, name):
+        if name in ignored_tags:
+            return True
+        if name == 'link' and self.get(node, 'type') == 'text/css':
+            return True
+        style = self.get(node, 'style')
+        return bool(style) and any(s in hidden_styles for s in css_whitespace.split(style))
 
     def clean_up_html(self):
         trashcan = []
@@ -255,22 +458,19 @@ class HtmlContentExtractor(object):
 
     def relative_path2_abs_url(self):
         def _rp2au(soup, tp):
-            d = {tp: True}
-            for tag in soup.find_all(**d):
-                tag[tp] = urljoin(self.url, tag[tp])
+            for tag in self.find_all(soup, attrs={tp: True}):
+                self.set(tag, tp, urljoin(self.url, self.get(tag, tp)))
 
         _rp2au(self.article, 'href')
         _rp2au(self.article, 'src')
         _rp2au(self.article, 'background')
 
-    @staticmethod
-    def is_link_intensive(node):
-        all_text = len(node.get_text(separator='', strip=True, types=(NavigableString,)))
+    def is_link_intensive(self, node):
+        stats = self.text_stats(node)
+        all_text = stats.stripped_len
         if not all_text:
             return False
-        link_text = 0
-        for a in node.find_all('a'):
-            link_text += len(a.get_text(separator='', strip=True, types=(NavigableString,)))
+        link_text = stats.link_len
         return float(link_text) / all_text >= .65
 
     @staticmethod
@@ -310,10 +510,11 @@ class HtmlContentExtractor(object):
             return False
 
         def summarize(node, max_length):
+            """A generator, run by `unroll`, which yields instead of calling itself"""
             partial_summaries = []
 
-            for child in node.children:
-                if isinstance(child, Tag):
+            for child in self.children(node):
+                if not isinstance(child, str):
                     # if self.summary_begun:  # http://v2ex.com/t/152930
                     if is_meta_tag(child) and \
                             1.0 * self.calc_effective_text_len(
@@ -321,15 +522,15 @@ class HtmlContentExtractor(object):
                         self.article) < .3 and \
                             self.calc_effective_text_len(child) < max_length:
                         continue
-                    if child.name in ('code',) and '\n' in child.text:
+                    if self.name(child) in ('code',) and self.text_stats(child).has_newline:
                         #  High possibility this is a code block, no need to summarize code to save OpenAI tokens
                         continue
-                    if child.name in block_tags:
+                    if self.name(child) in block_tags:
                         # Ignore too many links and too short paragraphs
-                        if (self.is_link_intensive(child) or len(tokenize(child.text)) < 15) \
+                        if (self.is_link_intensive(child) or token_count(self.text_stats(child).tokens) < 15) \
                                 and 1.0 * self.calc_effective_text_len(child) / self.calc_effective_text_len(self.article) < .3:
                             continue
-                        child_summary = summarize(child, max_length).strip()
+                        child_summary = (yield child, max_length).strip()
                         if len(tokenize(child_summary)) < 15 and \
                                 1.0 * self.calc_effective_text_len(
                             child) / self.calc_effective_text_len(
@@ -339,15 +540,15 @@ class HtmlContentExtractor(object):
                         partial_summaries.append(' ')  # http://paulgraham.com/know.html
                         partial_summaries.append(child_summary)
                     else:
-                        partial_summaries.append(summarize(child, max_length))
+                        partial_summaries.append((yield child, max_length))
                     max_length -= len(partial_summaries[-1])
                     if max_length < 0:
                         break
-                elif type(child) is NavigableString:
+                else:
                     # if not child.strip():
                     #     continue
-                    if re.match(r'h\d+|td', child.parent.name, re.I) and \
-                            string_inclusion_ratio(child, self.title) > .85:
+                    if re.match(r'h\d+|td', self.name(node), re.I) and \
+                            is_string_included(child, self.title, .85):
                         continue
                     self.summary_begun = True
                     child = re.sub('[ 　]{2,}', ' ', child)  # squeeze spaces
@@ -365,7 +566,7 @@ class HtmlContentExtractor(object):
         self.summary_begun = False  # miss the nonlocal feature
         smr = ''
         if self.calc_effective_text_len(self.article):
-            smr = summarize(self.article, max_length).strip()
+            smr = unroll(summarize, self.article, max_length).strip()
         if len(smr) <= len(self.get_meta_description()):
             logger.info('Calculated summary is shorter than meta description(%s)', self.url)
             smr = self.get_meta_description()
@@ -374,29 +575,11 @@ class HtmlContentExtractor(object):
         return smr
 
     def get_illustration(self):
-        for img_node in self.article.find_all('img') + self.doc.find_all('img'):
-            img = WebImage.from_node(self.url, img_node)
-            if img.is_candidate:
-                logger.info(f'Found a top image(width={img.width} height={img.height}) {img.url}')
-                return img
-        # Only as a fallback, github use user's avatar as their meta_images
-        if self.get_meta_image():
-            for img_src in self.get_meta_image():
-                img = WebImage.from_attrs(src=img_src, referrer=self.url)
-                if img.is_candidate:
-                    logger.info(f'Found a meta image(width={img.width} height={img.height}) {img.url}')
-                    return img
-        logger.info('No top image is found on %s', self.url)
-        return None
+        return pick_illustration(self.url, self.get_img_attrs(), self.get_meta_image())
+
+    def get_img_attrs(self):
+        """Attributes of <img>s, the ones in the article first"""
+        return [self.attrs(img_node) for img_node in self.find_all(self.article, 'img') + self.find_all(self.doc, 'img')]
 
     def get_favicon_url(self):
-        if not hasattr(self, '_favicon_url'):
-            fa = self.doc.find('link', rel=re.compile('icon', re.I))
-            if fa:
-                favicon_path = fa.get('href', '/favicon.ico')
-            elif 'archive.org' in self.url:
-                favicon_path = '/_static/images/archive.ico'
-            else:
-                favicon_path = '/favicon.ico'
-            self._favicon_url = urljoin(self.url, favicon_path)
         return self._favicon_url
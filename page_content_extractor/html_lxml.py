@@ -0,0 +1,162 @@
+# coding: utf-8
+import logging
+import re
+
+from bs4.builder import HTMLTreeBuilder
+from lxml import etree
+
+from .html import HtmlContentExtractor
+
+logger = logging.getLogger(__name__)
+
+# bs4 normalizes the tree while building it, here we do the same on the fly, so both engines give the same scores
+whitespace_only = re.compile('[\x20\x0a\x09\x0c\x0d]+')  # bs4 only squeezes ascii spaces
+nonwhitespace = re.compile(r'\S+')
+# Attributes bs4 splits into lists, e.g. class
+multi_valued_attrs = HTMLTreeBuilder.DEFAULT_CDATA_LIST_ATTRIBUTES
+# Whitespaces inside them are kept as is
+preserve_whitespace_tags = tuple(HTMLTreeBuilder.DEFAULT_PRESERVE_WHITESPACE_TAGS)
+# Strings inside them are not text, e.g. <rt>, bs4 gives them special string classes
+string_container_tags = tuple(HTMLTreeBuilder.DEFAULT_STRING_CONTAINERS)
+
+
+class LxmlContentExtractor(HtmlContentExtractor):
+    """
+    Same as `HtmlContentExtractor`, but on a plain lxml tree, which saves the cost of building a BeautifulSoup
+    tree out of lxml's events, and of walking it in pure python.
+
+    The document is an `etree._ElementTree`, standing for the BeautifulSoup object above <html>.
+    Text strings are `str`, made on the fly from `.text` and `.tail` the way bs4 makes its NavigableStrings.
+    """
+
+    def parse(self, html):
+        if isinstance(html, str) and html.startswith('\N{BYTE ORDER MARK}'):
+            html = html[1:]
+        try:
+            root = self.feed(html)
+        except (UnicodeDecodeError, LookupError, etree.ParserError):
+            if not isinstance(html, str):
+                raise
+            # Same as bs4, let lxml decode it when it cannot take unicode
+            root = self.feed(html.encode('utf8'), 'utf8')
+        self._preserved = set()  # elements whose text keeps whitespaces
+        self._contained = set()  # elements whose text is not text
+        if root is not None:
+            for tag in root.iter(*preserve_whitespace_tags):
+                self._preserved.update(tag.iter())
+            for tag in root.iter(*string_container_tags):
+                self._contained.update(tag.iter())
+        return etree.ElementTree(root)
+
+    @staticmethod
+    def feed(markup, encoding=None):
+        # The same parser bs4 drives, so the trees have the same shape. bs4 gets events instead of a tree,
+        # which are not limited to 256 levels deep, so neither is this.
+        parser = etree.HTMLParser(recover=True, strip_cdata=False, huge_tree=True, encoding=encoding)
+        parser.feed(markup)
+        try:
+            return parser.close()
+        except etree.XMLSyntaxError:  # no element at all
+            return None
+
+    def name(self, node) -> str:
+        if isinstance(node, etree._ElementTree):
+            return '[document]'
+        return node.tag
+
+    def children(self, node):
+        if isinstance(node, etree._ElementTree):
+            root = node.getroot()
+            if root is not None:
+                yield root
+            return
+        is_text = node not in self._contained
+        preserve = node in self._preserved
+        if node.text and is_text:
+            yield self.normalize(node.text, preserve)
+        for child in node:
+            if isinstance(child.tag, str):  # comments and processing instructions are left out, but not their tails
+                yield child
+            if child.tail and is_text:
+                yield self.normalize(child.tail, preserve)
+
+    @staticmethod
+    def normalize(text, preserve):
+        if not preserve and whitespace_only.fullmatch(text):
+            return '\n' if '\n' in text else ' '
+        return text
+
+    def ancestors(self, node):
+        return node.iterancestors()
+
+    def descendants(self, node):
+        return self.iter_matches(node)
+
+    def iter_matches(self, node, name=True, attrs=None):
+        if isinstance(node, etree._ElementTree):
+            root = node.getroot()
+            descendants = () if root is None else root.iter(etree.Element if name is True else name)
+        else:
+            descendants = node.iterdescendants(etree.Element if name is True else name)
+        for tag in descendants:
+            if not attrs or all(self.match_attr(tag, attr, expected) for attr, expected in attrs.items()):
+                yield tag
+
+    def find_all(self, node, name=True, attrs=None) -> list:
+        return list(self.iter_matches(node, name, attrs))
+
+    def get(self, node, attr, default=None):
+        if isinstance(node, etree._ElementTree):
+            return default
+        value = node.get(attr)
+        if value is None:
+            return default
+        if attr in multi_valued_attrs['*'] or attr in multi_valued_attrs.get(node.tag, ()):
+            return nonwhitespace.findall(value)
+        return value
+
+    def attrs(self, node) -> dict:
+        return {attr: self.get(node, attr) for attr in node.attrib}
+
+    def set(self, node, attr, value):
+        node.set(attr, value)
+
+    def remove(self, node):
+        parent = node.getparent()
+        if parent is None:
+            if node is self.doc.getroot():  # the root cannot be detached, empty it instead
+                node.clear()
+            return  # already detached with an ancestor
+        # Keep the tail as a string of its own, instead of joining it to the text before, as bs4 does.
+        # The placeholder is left out like other comments.
+        placeholder = etree.Comment('')
+        placeholder.tail = node.tail
+        node.tail = None
+        parent.replace(node, placeholder)
+
+    def strings(self, node):
+        """All text strings under the node, in document order"""
+        stack = [self.children(node)]
+        while stack:
+            for child in stack[-1]:
+                if isinstance(child, str):
+                    yield child
+                else:
+                    stack.append(self.children(child))
+                    break
+            else:
+                stack.pop()
+
+    def text(self, node) -> str:
+        return ''.join(self.strings(node))
+
+    def string(self, node) -> str:
+        # The only child, if it is a string, or the string of the only child
+        if len(node) == 0:
+            return self.normalize(node.text, node in self._preserved) if node.text else None
+        if node.text or len(node) > 1 or node[0].tail:
+            return None
+        child = node[0]
+        if isinstance(child.tag, str):
+            return self.string(child)
+        return child.text  # a comment
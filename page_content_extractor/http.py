@@ -1,4 +1,6 @@
 import logging
+import time
+from urllib.parse import urlsplit
 
 import requests
 import requests.utils
@@ -8,9 +10,51 @@ from requests.adapters import HTTPAdapter
 from urllib3.util import timeout
 from urllib3.util.ssl_ import create_urllib3_context
 
+import config
+import db.host
+from hacker_news.deadline import StageTimeout, check_cancelled
+from .http_cache import http_cache
+
 logger = logging.getLogger(__name__)
 
 
+def fix_encoding(response):
+    """Get encoding from html content instead of setting it blindly to ISO-8859-1"""
+    if response.encoding == 'ISO-8859-1':
+        response.encoding = (requests.utils.get_encodings_from_content(str(response.content))
+                             or ['ISO-8859-1'])[-1]  # the last one overwrites the first one
+    # If response.encoding is None, encoding will be guessed using `chardet` by `requests`
+    return response
+
+
+def read_body(response, max_bytes):
+    """
+    Reads a streamed response into `response.content`, but no more than `max_bytes`,
+    so a huge or never-ending body is not held fully in memory. Returns True if the body is truncated.
+    """
+    chunks = []
+    read_bytes = 0
+    for chunk in response.iter_content(64 << 10):
+        chunks.append(chunk)
+        read_bytes += len(chunk)
+        if read_bytes > max_bytes:
+            break
+    response._content = b''.join(chunks)[:max_bytes]
+    response._content_consumed = True
+    response.truncated = read_bytes > max_bytes
+    response.close()  # release the connection, the rest is never read
+    fix_encoding(response)
+    if not response.truncated:
+        cache_streamed(response, response.content)
+    return response.truncated
+
+
+def cache_streamed(response, body):
+    """Stores a streamed response, whose `body` is read in full by its caller, in the http cache"""
+    if http_cache is not None:
+        http_cache.store_streamed(response, body)
+
+
 class CustomHTTPAdapter(HTTPAdapter):
     timeout = timeout.Timeout(connect=10, read=30)
 
@@ -33,15 +77,43 @@ class CustomHTTPAdapter(HTTPAdapter):
         user_time = kwargs.get("timeout")
         if user_time is None:
             kwargs["timeout"] = self.timeout
-        return super().send(request, **kwargs)
-
-    def build_response(self, req, resp):
-        """Get encoding from html content instead of setting it blindly to ISO-8859-1"""
-        response = super().build_response(req, resp)
-        if response.encoding == 'ISO-8859-1':
-            response.encoding = (requests.utils.get_encodings_from_content(str(response.content))
-                                 or ['ISO-8859-1'])[-1]  # the last one overwrites the first one
-        # If response.encoding is None, encoding will be guessed using `chardet` by `requests`
+        meta = http_cache.prepare(request) if http_cache else None
+        response = self.send_and_record(request, **kwargs)
+        if http_cache is not None:
+            response = http_cache.handle(request, response, meta, kwargs.get('stream'))
+            if meta and response.status_code == 304:  # its stored body is evicted meanwhile
+                response.close()
+                http_cache.forget_validators(request)
+                response = http_cache.handle(request, self.send_and_record(request, **kwargs), None,
+                                             kwargs.get('stream'))
+        if not kwargs.get('stream') or getattr(response, 'from_cache', False):
+            # A streamed body is not read yet, fix it after reading, see `read_body`
+            fix_encoding(response)
+        return response
+
+    def send_and_record(self, request, **kwargs):
+        """
+        Feeds the per-host circuit breaker in `db.host`, unless the stage sending it is given up meanwhile,
+        see `hacker_news.deadline.check_cancelled`
+        """
+        host = urlsplit(request.url).hostname
+        start = time.time()
+        try:
+            response = super().send(request, **kwargs)
+        except requests.Timeout:
+            check_cancelled()
+            db.host.record(host, (time.time() - start) * 1000, timeout=True)
+            raise
+        except requests.ConnectionError:
+            check_cancelled()
+            db.host.record(host, (time.time() - start) * 1000, error=True)
+            raise
+        try:
+            check_cancelled()
+        except StageTimeout:
+            response.close()
+            raise
+        db.host.record(host, (time.time() - start) * 1000, response.status_code)
         return response
 
     def init_poolmanager(self, *args, **kwargs):
@@ -57,10 +129,19 @@ ua = UserAgent(browsers=['Chrome'], platforms=['desktop'], min_percentage=10.0)
 ua_str = ua.random
 logger.info(f'Use user-agent {ua_str}')
 
-session = requests.Session()
 
-session.mount('http://', CustomHTTPAdapter())
-session.mount('https://', CustomHTTPAdapter())
+def new_session():
+    """
+    One session is shared by all pulling threads, so connections are kept alive across short-lived threads.
+    Its pools are sized for them: every item pulled may check a few images at the same time
+    """
+    pool_size = config.pull_concurrency * max(config.illustration_fan_out, 1)
+    s = requests.Session()
+    s.mount('http://', CustomHTTPAdapter(pool_maxsize=pool_size))
+    s.mount('https://', CustomHTTPAdapter(pool_maxsize=pool_size))
+    s.headers.update({"User-Agent": ua_str})
+    s.verify = False
+    return s
+
 
-session.headers.update({"User-Agent": ua_str})
-session.verify = False
+session = new_session()
@@ -0,0 +1,195 @@
+# coding: utf-8
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from hashlib import sha1
+
+from requests.utils import get_encoding_from_headers
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class HttpCache(object):
+    """
+    An on-disk cache of GET responses that carry validators (ETag or Last-Modified).
+    Cached urls are revalidated with If-None-Match/If-Modified-Since, and a 304 is answered
+    with the stored body. Entries are evicted in least-recently-used order once `max_size` is exceeded.
+    """
+
+    def __init__(self, directory, max_size, max_entry_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        self.hits = self.misses = self.stores = self.evictions = 0
+        self.lock = threading.Lock()
+        self._index = None  # key -> body size, least recently used first
+        self._size = 0
+
+    @property
+    def index(self):
+        if self._index is None:
+            os.makedirs(self.directory, exist_ok=True)
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.body'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name.removesuffix('.body'), stat.st_size))
+            entries.sort()
+            self._index = OrderedDict((key, size) for _, key, size in entries)
+            self._size = sum(self._index.values())
+        return self._index
+
+    @staticmethod
+    def key(url):
+        return sha1(url.encode('utf-8')).hexdigest()
+
+    def path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    @staticmethod
+    def is_cacheable(request):
+        return request.method == 'GET' and 'Range' not in request.headers
+
+    def prepare(self, request):
+        """Adds validators to the request, returns the cached meta if there is one"""
+        if not self.is_cacheable(request):
+            return None
+        key = self.key(request.url)
+        with self.lock:
+            if key not in self.index:
+                return None
+        try:
+            with open(self.path(key, '.meta')) as fp:
+                meta = json.load(fp)
+        except (OSError, ValueError) as e:
+            logger.warning('Failed to load http cache of %s, %s', request.url, e)
+            return None
+        if meta.get('etag'):
+            request.headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            request.headers['If-Modified-Since'] = meta['last_modified']
+        return meta
+
+    @staticmethod
+    def forget_validators(request):
+        """For asking again in full, when the stored body is gone after `prepare`"""
+        request.headers.pop('If-None-Match', None)
+        request.headers.pop('If-Modified-Since', None)
+
+    def handle(self, request, response, meta, stream=False):
+        """
+        Serves a 304 from the stored body, or stores a fresh 200. A streamed 200 is left to its caller,
+        which stores it once its body is read, see `store_streamed`.
+        A 304 whose body is evicted meanwhile is returned as it is, see `http.CustomHTTPAdapter.send`
+        """
+        if not self.is_cacheable(request):
+            return response
+        if meta and response.status_code == 304:
+            key = self.key(request.url)
+            try:
+                with open(self.path(key, '.body'), 'rb') as fp:
+                    body = fp.read()
+            except OSError as e:
+                logger.warning('Failed to load http cache of %s, %s', request.url, e)
+                return response
+            self.touch(key)
+            with self.lock:
+                self.hits += 1
+            return self.from_cache(response, meta, body)
+        with self.lock:
+            self.misses += 1
+        if response.status_code == 200 and not stream:
+            self.store(request.url, response, response.content)
+        return response
+
+    def store_streamed(self, response, body):
+        """
+        Stores a streamed 200 after its caller has read `body` in full. The adapter does not read it,
+        as that would download more than the caller's size cap, or an image the caller gives up on
+        """
+        if (response.status_code == 200 and not getattr(response, 'from_cache', False)
+                and response.request is not None and self.is_cacheable(response.request)):
+            self.store(response.request.url, response, body)
+
+    @staticmethod
+    def from_cache(response, meta, body):
+        headers = dict(meta['headers'])
+        headers.update(response.headers)  # a 304 may carry updated headers
+        response.status_code = 200
+        response.reason = 'OK'
+        response.headers.clear()
+        response.headers.update(headers)
+        response.headers['Content-Length'] = str(len(body))
+        response._content = body
+        # Streamed callers read `content` instead of the raw 304, which has no body,
+        # so its connection goes back to the pool now
+        response._content_consumed = True
+        response.close()
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.from_cache = True
+        return response
+
+    def store(self, url, response, body):
+        etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+        if not (etag or last_modified) or 'no-store' in response.headers.get('Cache-Control', ''):
+            return
+        if len(body) > self.max_entry_size:
+            return
+        headers = {k: v for k, v in response.headers.items()
+                   if k.lower() not in ('content-encoding', 'transfer-encoding', 'content-length')}
+        meta = {'url': url, 'etag': etag, 'last_modified': last_modified, 'headers': headers}
+        key = self.key(url)
+        with self.lock:
+            index = self.index  # load existing entries before adding a new one
+        try:
+            for suffix, data, mode in (('.meta', json.dumps(meta), 'w'), ('.body', body, 'wb')):
+                tmp = self.path(key, suffix + '.tmp')
+                with open(tmp, mode) as fp:
+                    fp.write(data)
+                os.replace(tmp, self.path(key, suffix))
+        except OSError as e:
+            logger.warning('Failed to store http cache of %s, %s', url, e)
+            return
+        with self.lock:
+            self._size -= index.pop(key, 0)
+            index[key] = len(body)
+            self._size += len(body)
+            self.stores += 1
+        self.evict()
+
+    def touch(self, key):
+        with self.lock:
+            if key in self.index:
+                self.index.move_to_end(key)
+        try:
+            os.utime(self.path(key, '.body'))  # so LRU order survives restarts
+        except OSError:
+            pass
+
+    def evict(self):
+        while True:
+            with self.lock:
+                if self._size <= self.max_size or not self.index:
+                    return
+                key, size = self.index.popitem(last=False)
+                self._size -= size
+                self.evictions += 1
+            for suffix in ('.meta', '.body'):
+                try:
+                    os.remove(self.path(key, suffix))
+                except OSError:
+                    pass
+
+    def stats(self):
+        total = self.hits + self.misses
+        return (f'http cache hits {self.hits}/{total} ({self.hits / (total or 1):.0%}), stores {self.stores}, '
+                f'evictions {self.evictions}, size {self._size >> 20}MB')
+
+
+http_cache = None
+if not config.disable_http_cache:
+    http_cache = HttpCache(config.http_cache_dir, config.http_cache_size, config.http_cache_max_entry_size)
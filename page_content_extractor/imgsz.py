@@ -336,6 +336,32 @@ def _svgsize(stream):
     raise ValueError('Unable to determine size of SVG data')
 
 
+def _webpsize(stream):
+    '''gets the width and height (in pixels) of a WebP file, from its header only'''
+    stream.read(12)  # RIFF....WEBP
+    chunk = stream.read(4)
+    stream.read(4)  # chunk size
+    if chunk == b'VP8X':  # extended, 24-bit canvas size minus one
+        data = stream.read(10)
+        x = int.from_bytes(data[4:7], 'little') + 1
+        y = int.from_bytes(data[7:10], 'little') + 1
+    elif chunk == b'VP8 ':  # lossy, after the frame tag and start code
+        data = stream.read(10)
+        if data[3:6] != b'\x9d\x01\x2a':
+            raise ValueError('VP8 start code not found')
+        (x, y) = unpack('<HH', data[6:10])
+        x, y = x & 0x3fff, y & 0x3fff
+    elif chunk == b'VP8L':  # lossless, 14 bits each minus one
+        data = stream.read(5)
+        if data[0] != 0x2f:
+            raise ValueError('VP8L signature not found')
+        bits = int.from_bytes(data[1:5], 'little')
+        x, y = (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    else:
+        raise ValueError('Unknown WebP chunk %r' % chunk)
+    return 'WEBP', x, y
+
+
 # type_map used in function type_map_match
 TYPE_MAP = {re.compile(rb'^\xFF\xD8'): ('JPEG', _jpegsize),
             re.compile(rb'^BM'): ('BMP', _bmpsize),
@@ -354,6 +380,7 @@ TYPE_MAP = {re.compile(rb'^\xFF\xD8'): ('JPEG', _jpegsize),
             re.compile(rb'^\x01\xDA[\x01\x00]'): ('RGB', _rgbsize),
             re.compile(rb'^\x59\xA6\x6A\x95'): ('RAS', _rassize),
             re.compile(rb'^\x0A.\x01'): ('PCX', _pcxsize),
+            re.compile(rb'^RIFF....WEBP', re.S): ('WEBP', _webpsize),
             re.compile(rb'<svg\s'): ('SVG', _svgsize)}
 
 
@@ -1,18 +1,27 @@
 # coding: utf-8
 import logging
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import TimeoutError
 from io import BytesIO, StringIO
 from urllib.parse import urljoin
 
 from markupsafe import escape
 from pdfminer.converter import TextConverter
 from pdfminer.layout import LAParams
+from pdfminer.pdfdocument import PDFDocument
 from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
 from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfparser import PDFParser
+from pdfminer.pdftypes import resolve1
 
 import config
+from . import workers
 from .utils import tokenize
 
 logger = logging.getLogger(__name__)
+PAGES_PER_JOB = 4  # small enough not to interpret much more than what get_content reads
 
 
 class PdfExtractor(object):
@@ -24,22 +33,88 @@ class PdfExtractor(object):
         self.raw_data = raw_data
 
     def load(self, raw_data):
-        pdf_fp = BytesIO(raw_data)
+        texts, length = [], 0
+        for text in self.get_page_texts(raw_data):
+            texts.append(text)
+            length += len(text)
+            if length > config.max_content_size:
+                logger.warning("%s too long, truncate to %d", self.url, length)
+                break
+        self.article = ''.join(texts)
+
+    def iter_page_texts(self):
+        """
+        Text of each page, in order, up to `config.max_pdf_pages` pages and `config.pdf_timeout` seconds.
+        Pages are spread over the worker processes when there are some, the texts are the same either way.
+        """
+        deadline = time.time() + config.pdf_timeout
+        if config.worker_processes > 1 and not workers.in_worker():
+            pages = self.get_page_texts_in_parallel(self.raw_data, deadline)
+        else:
+            pages = self.get_page_texts(self.raw_data, 0, config.max_pdf_pages)
+        for page in pages:
+            yield page
+            if time.time() > deadline:
+                logger.warning('%s takes more than %ds, the rest pages are skipped', self.url, config.pdf_timeout)
+                return
+
+    def get_page_texts_in_parallel(self, raw_data, deadline):
+        """
+        The pdf is written to a temp file once, for the workers to read, instead of being sent with every job.
+        Jobs are submitted as the reader goes, at most one per worker ahead of it.
+        """
+        page_count = min(self.page_count(raw_data), config.max_pdf_pages)
+        ranges = ((start, min(start + PAGES_PER_JOB, page_count)) for start in range(0, page_count, PAGES_PER_JOB))
+        futures = deque()
+        with tempfile.NamedTemporaryFile(suffix='.pdf') as fp:
+            fp.write(raw_data)
+            fp.flush()
+            try:
+                while True:
+                    for start, stop in ranges:
+                        futures.append(workers.submit(extract_page_texts, fp.name, start, stop))
+                        if len(futures) >= config.worker_processes:
+                            break
+                    if not futures:
+                        return
+                    yield from futures.popleft().result(timeout=max(deadline - time.time(), 0))
+            except TimeoutError:
+                logger.warning('%s takes more than %ds, the rest pages are skipped', self.url, config.pdf_timeout)
+            finally:  # when the reader stops early
+                for future in futures:
+                    future.cancel()
+
+    @staticmethod
+    def page_count(raw_data) -> int:
+        """From the page tree of the document catalog, instead of walking all pages"""
+        try:
+            return int(resolve1(PDFDocument(PDFParser(BytesIO(raw_data))).catalog['Pages'])['Count'])
+        except Exception as e:
+            logger.info('No page count in the catalog, count the pages instead, %s', e)
+            return sum(1 for _ in PDFPage.get_pages(BytesIO(raw_data)))
+
+    @staticmethod
+    def get_page_texts(raw_data, start=0, stop=None):
+        """
+        Text of each page in [start, stop), one page at a time. Pages are interpreted only as far as they are read,
+        so a reader stopping early saves interpreting the rest. `raw_data` is the bytes or an opened file.
+        """
+        if start == stop:
+            return
         output_fp = StringIO()
-        laparams = LAParams()
         rsrcmgr = PDFResourceManager()
-        device = TextConverter(rsrcmgr, output_fp, laparams=laparams)
+        device = TextConverter(rsrcmgr, output_fp, laparams=LAParams())
         # Create a PDF interpreter object.
         interpreter = PDFPageInterpreter(rsrcmgr, device)
 
         # Process each page contained in the document.
-        for page in PDFPage.get_pages(pdf_fp):
+        pagenos = range(start, stop) if stop is not None else None
+        fp = BytesIO(raw_data) if isinstance(raw_data, bytes) else raw_data
+        for page in PDFPage.get_pages(fp, pagenos=pagenos, maxpages=stop or 0):
             interpreter.process_page(page)
-            if len(output_fp.getvalue()) > config.max_content_size:
-                logger.warning("%s too long, truncate to %d", self.url, len(output_fp.getvalue()))
-                break
-
-        self.article = output_fp.getvalue()
+            yield output_fp.getvalue()
+            output_fp.seek(0)
+            output_fp.truncate()  # only the text of the next page is left in it
 
     def get_content(self, max_length=config.max_content_size):
         partial_summaries = []
@@ -61,19 +136,9 @@ class PdfExtractor(object):
     def get_paragraphs(self):
         p = []
         has_began = False
-
-        pdf_fp = BytesIO(self.raw_data)
-        output_fp = StringIO()
-        laparams = LAParams()
-        rsrcmgr = PDFResourceManager()
-        device = TextConverter(rsrcmgr, output_fp, laparams=laparams)
-        # Create a PDF interpreter object.
-        interpreter = PDFPageInterpreter(rsrcmgr, device)
-
-        # Process each page contained in the document.
-        for page in PDFPage.get_pages(pdf_fp):
-            interpreter.process_page(page)
-            for line in output_fp.getvalue().split('\n'):
+        # A paragraph may go on in the next page
+        for text in self.iter_page_texts():
+            for line in text.split('\n'):
                 line = line.strip()
                 if line and line.isprintable() and line.lower() != 'abstract':  # avoid handling \x01\x02...
                     has_began = True
@@ -82,7 +147,6 @@ class PdfExtractor(object):
                     yield '\n'.join(p)
                     has_began = False
                     p = []
-            output_fp.seek(0)
         if p:
             yield ' '.join(p)
 
@@ -104,3 +168,9 @@ class PdfExtractor(object):
 
     def get_favicon_url(self):
         return urljoin(self.url, '/favicon.ico')
+
+
+def extract_page_texts(path, start, stop) -> list[str]:
+    """Texts of the pages in [start, stop) of the pdf file, in a worker process"""
+    with open(path, 'rb') as fp:
+        return list(PdfExtractor.get_page_texts(fp, start, stop))
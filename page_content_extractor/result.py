@@ -0,0 +1,66 @@
+# coding: utf-8
+import json
+
+import config
+from .html import HtmlContentExtractor
+from .webimage import pick_illustration
+
+
+class ExtractResult(object):
+    """
+    What `News` needs from an extractor, made in a worker process and sent back instead of the whole tree.
+    It answers the same calls as the extractors do.
+    """
+
+    def __init__(self, url='', title='', content='', favicon_url='', meta_description='',
+                 img_attrs=(), meta_images=(), empty=False):
+        self.url = url
+        self.title = title
+        self.content = content
+        self.favicon_url = favicon_url
+        self.meta_description = meta_description
+        self.img_attrs = list(img_attrs)  # attributes of <img>s, see `HtmlContentExtractor.get_img_attrs`
+        self.meta_images = list(meta_images)
+        self.empty = empty
+
+    def __repr__(self):
+        return f'<{self.url} - {self.title} - {len(self.content)} chars - {len(self.img_attrs)} images>'
+
+    @classmethod
+    def of(cls, extractor):
+        if isinstance(extractor, HtmlContentExtractor):
+            return cls(url=extractor.url, title=extractor.title,
+                       content=extractor.get_content(config.max_content_size),
+                       favicon_url=extractor.get_favicon_url(),
+                       meta_description=extractor.get_meta_description(),
+                       img_attrs=extractor.get_img_attrs(), meta_images=extractor.get_meta_image(),
+                       empty=extractor.is_empty())
+        # pdf and embeddables, they have no title or images
+        return cls(url=extractor.url, content=extractor.get_content(config.max_content_size),
+                   favicon_url=extractor.get_favicon_url())
+
+    @classmethod
+    def from_json_str(cls, json_str):
+        return cls(**json.loads(json_str))
+
+    def to_json_str(self):
+        return json.dumps(vars(self), ensure_ascii=False, separators=(',', ':'))
+
+    def get_content(self, max_length=config.max_content_size):
+        # It is extracted at `config.max_content_size`, the only length `News` asks for
+        return self.content
+
+    def get_favicon_url(self):
+        return self.favicon_url
+
+    def get_meta_description(self):
+        return self.meta_description
+
+    def get_meta_image(self):
+        return self.meta_images
+
+    def get_illustration(self):
+        return pick_illustration(self.url, self.img_attrs, self.meta_images)
+
+    def is_empty(self):
+        return self.empty
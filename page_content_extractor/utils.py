@@ -22,19 +22,81 @@ def tokenize(s):  # not using yield just for cache
     return tuple(tokens)  # sorry but list is unhashable
 
 
+# What tokenize counts: a run of latin non-spaces, or any other single char
+token_patt = re.compile(r'[^\s\u0100-\U0010FFFF]+|[\u0100-\U0010FFFF]')
+
+
+def token_stats(s):
+    """
+    Partial result of `len(tokenize(s))`, which merges with the one of the next string into the one of both,
+    so the token count of a node comes from those of its children, without joining and tokenizing its text again.
+
+    (tokens, starts in a word, ends in a word, all spaces, non latin spaces at the start, and at the end),
+    the last two are counted as tokens, unless stripped at the ends of the whole text.
+
+    >>> token_count(merge_token_stats(token_stats(u'ab我 c'), token_stats(u'd　')))  # ab 我 cd
+    3
+    """
+    if not s:
+        return None
+    blank = not s.strip()
+    lead = s[:len(s) - len(s.lstrip())]
+    trail = s[len(s.rstrip()):]
+    return (len(token_patt.findall(s)),
+            not blank and not lead and s[0] <= '\u00FF',
+            not blank and not trail and s[-1] <= '\u00FF',
+            blank,
+            sum(c > '\u00FF' for c in lead),
+            sum(c > '\u00FF' for c in trail))
+
+
+def merge_token_stats(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return (a[0] + b[0] - (a[2] and b[1]),  # a word across the two
+            a[1], b[2], a[3] and b[3],
+            a[4] + b[4] if a[3] else a[4],
+            a[5] + b[5] if b[3] else b[5])
+
+
+def token_count(stats):
+    if stats is None or stats[3]:
+        return 0
+    return stats[0] - stats[4] - stats[5]
+
+
 @lru_cache(maxsize=128)
 def LCS_length(x, y):
     """
     Return length of the longest common subsequence of *iterable* x and y
     """
-    len_x, len_y = len(x) + 1, len(y) + 1
-    lcs = [[0] for i in range(len_x)]
-    lcs[0] = [0 for j in range(len_y)]
-    for i in range(1, len_x):
-        for j in range(1, len_y):
-            lcs[i].append(lcs[i - 1][j - 1] + 1 if x[i - 1] == y[j - 1] else
-                          max(lcs[i - 1][j], lcs[i][j - 1]))
-    return lcs[len_x - 1][len_y - 1]
+    return bit_parallel_LCS_length(x, y)
+
+
+def bit_parallel_LCS_length(x, y, at_least=0):
+    """
+    The bit-parallel algorithm of Allison-Dix / Hyyrö, each item of the shorter sequence takes a few big int
+    operations on a bit vector of the longer one, instead of a row of the O(n*m) table.
+    Gives up and returns -1 as soon as the length is known to be less than `at_least`.
+    """
+    if len(x) < len(y):
+        x, y = y, x
+    if len(y) < at_least:
+        return -1
+    positions = {}  # token -> bits of where it is in x
+    for i, item in enumerate(x):
+        positions[item] = positions.get(item, 0) | 1 << i
+    full = (1 << len(x)) - 1
+    v = full  # zero bits count the common subsequence so far
+    for k, item in enumerate(y, 1):
+        u = v & positions.get(item, 0)
+        v = ((v + u) | (v - u)) & full
+        # Every item left adds one at most
+        if at_least and len(x) - v.bit_count() + len(y) - k < at_least:
+            return -1
+    return len(x) - v.bit_count()
 
 
 @lru_cache(maxsize=128)
@@ -43,3 +105,22 @@ def string_inclusion_ratio(needle, haystack):
     if not needle.strip() or not haystack.strip():
         return 0
     return LCS_length(tokenize(needle), tokenize(haystack)) / float(len(tokenize(needle)))
+
+
+@lru_cache(maxsize=128)
+def is_string_included(needle, haystack, threshold):
+    """
+    Same as `string_inclusion_ratio(needle, haystack) > threshold`, but gives up as soon as it cannot be,
+    e.g. a long table cell is never included in a short title
+    """
+    if not needle.strip() or not haystack.strip():
+        return 0 > threshold
+    needle_tokens, haystack_tokens = tokenize(needle), tokenize(haystack)
+    n = float(len(needle_tokens))
+    # The least common subsequence length making it, compared the same way as the ratio
+    at_least = max(int(threshold * n), 0)
+    while at_least > 0 and (at_least - 1) / n > threshold:
+        at_least -= 1
+    while at_least / n <= threshold:
+        at_least += 1
+    return bit_parallel_LCS_length(needle_tokens, haystack_tokens, at_least) >= at_least
@@ -5,26 +5,108 @@ import logging
 import math
 import mimetypes
 import pathlib
+import re
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
 from hashlib import md5
 from urllib.parse import urlparse, urljoin, unquote
 
 from PIL import Image
 
-from page_content_extractor.http import session
-from . import imgsz
+import config
+import db.host
+import db.verdict
+from page_content_extractor.http import session, cache_streamed
+from . import imgsz, workers
+from .exceptions import CircuitOpenError, DownloadCancelled
 
 logger = logging.getLogger(__name__)
 
 
+class ImageAnalysis(object):
+    """
+    What we need to know about a candidate image, derived from decoding it once: format, size and dominant color.
+    Small enough to be sent back from a worker process. Encoding is left to `encode`, only the chosen image pays for it.
+    """
+    THUMBNAIL_PX = 128
+    UNCOMPRESSED_FORMATS = ('GIF', 'WEBP')  # maybe animated, or already compressed
+
+    def __init__(self, format, width, height, dominant_pct, dominant_color):
+        self.format = format
+        self.width = width
+        self.height = height
+        self.dominant_pct = dominant_pct
+        self.dominant_color = dominant_color
+
+    @classmethod
+    def from_bytes(cls, data):
+        """CPU bound, runs in `workers`"""
+        with Image.open(io.BytesIO(data)) as img:
+            img.load()
+            dominant_pct, dominant_color = cls.get_dominant_color(img)
+            return cls(img.format, img.width, img.height, dominant_pct, dominant_color)
+
+    @classmethod
+    def encode(cls, data, compress=True, derivative_widths=()):
+        """
+        Returns the compressed webp, or None, and smaller webp copies (derivatives) of fixed widths, width -> bytes.
+        CPU bound, runs in `workers`
+        """
+        with Image.open(io.BytesIO(data)) as img:
+            img.load()
+            webp = None
+            if compress and img.format not in cls.UNCOMPRESSED_FORMATS:
+                webp = cls.to_webp(img)
+            derivatives = {}
+            if not getattr(img, 'is_animated', False):  # keep animations as they are
+                for width in derivative_widths:
+                    if width < img.width:
+                        height = max(round(img.height * width / img.width), 1)
+                        derivatives[width] = cls.to_webp(cls.to_rgb(img).resize((width, height), Image.LANCZOS))
+            return webp, derivatives
+
+    @staticmethod
+    def to_webp(img):
+        out = io.BytesIO()
+        img.save(out, format='webp', optimize=True, quality=50)
+        return out.getvalue()
+
+    @staticmethod
+    def to_rgb(img):
+        if img.mode in ('RGB', 'RGBA'):
+            return img
+        has_alpha = img.mode in ('LA', 'PA') or 'transparency' in img.info
+        return img.convert('RGBA' if has_alpha else 'RGB')
+
+    @classmethod
+    def get_dominant_color(cls, img):
+        """Returns (percentage, RGB) of the most used color, counted on a thumbnail instead of every pixel"""
+        ratio = min(cls.THUMBNAIL_PX / max(img.width, img.height), 1)
+        size = (max(round(img.width * ratio), 1), max(round(img.height * ratio), 1))
+        # Nearest neighbour keeps real colors, a filter would blend them
+        thumbnail = img.resize(size, Image.NEAREST).convert('RGB')
+        total_count = size[0] * size[1]
+        count, color = max(thumbnail.getcolors(maxcolors=total_count))
+        return count / total_count, color
+
+    def is_predominantly_white(self, predominance, white_distance):
+        return (self.dominant_pct > predominance
+                and all(255 - white_distance <= value <= 255 for value in self.dominant_color))
+
+
 class WebImage(object):
     MIN_PX = 100
     MIN_BYTES_SIZE = 4000
     MAX_BYTES_SIZE = 10 * 1024 * 1024  # we have compression now
+    MAX_DOWNLOAD_BYTES = 17 << 20
+    PROBE_BYTES = 64 << 10  # enough for imgsz to tell the size of most images
     SCALE_FROM_IMG_TO_TEXT = 22 * 22
     content_type = ''
     width = 0
     height = 0
+    total_bytes = 0  # size of the whole image, told by the probing response
+    srcset = {}  # width -> name of the stored image and its smaller copies, see `db.image.save_derivatives`
+    cancelled = False  # set by `first_candidate` to abort an outstanding download
 
     def __init__(self, src='', referrer='', **attrs):
         # e.g. http://www.washingtonpost.com/sf/investigative/2014/09/06/stop-and-seize/
@@ -40,7 +122,12 @@ class WebImage(object):
     def is_candidate(self):
         if hasattr(self, '_is_candidate'):
             return self._is_candidate
-        self._is_candidate = False
+        is_candidate = self.check_candidate()
+        if not self.cancelled:  # a cancelled check is not the final verdict
+            self._is_candidate = is_candidate
+        return is_candidate
+
+    def check_candidate(self):
         # see https://bitbucket.org/raphaelzhang/novel-reader/src/d5f1e60c5387bfbc375e89cada55b3b05370cb01/extractor.py#cl-717
         if self.url.startswith('data:image/'):
             logger.info('Image is encoded in base64, too short')
@@ -51,24 +138,65 @@ class WebImage(object):
         if 'avatar' in attr_str or 'spinner' in attr_str:
             logger.info('Maybe this is an avatar/spinner(%s)', self.url)
             return False
+        url = self.url  # may be redirected
+        verdict = None if self.has_size_attrs() else db.verdict.get(url)
+        if verdict:
+            if not verdict.is_candidate:
+                logger.info('Known as not a candidate (%s), %s', verdict.reason, url)
+                return False
+            try:
+                self.raw_data  # the image may be gone since, and is needed anyway if it wins
+            except Exception as e:
+                logger.info('Failed to download %s, remembered as a candidate, %s', self.url, e)
+                if not self.cancelled:
+                    db.verdict.forget(url)
+                return False
+            self.width, self.height, self.total_bytes = verdict.width, verdict.height, verdict.byte_size
+            return True
         width, height = self.get_size()
         # self.img_area_px = self.equivalent_text_len()
         if not (width and height):
             logger.info('Failed on determining the image size of %s', self.url)
+            if hasattr(self, '_probe_data') or hasattr(self, '_raw_data'):  # not a network failure
+                self.remember(url, False, 'size')
             return False
         if not self.check_dimension(width, height):
             logger.info('Failed on dimension check(width=%s height=%s) %s', width, height, self.url)
+            self.remember(url, False, 'dimension', width, height)
             return False
         if not self.check_image_bytesize():
-            logger.info('Failed on image bytesize check, size is %s, %s', len(self.raw_data),
+            logger.info('Failed on image bytesize check, size is %s, %s', self.byte_size(),
                         self.url)
+            self.remember(url, False, 'bytesize', width, height)
+            return False
+        try:
+            self.raw_data  # only candidates passing the checks above are downloaded in full
+        except Exception as e:
+            logger.info('Failed to download %s, %s', self.url, e)
             return False
         if self.is_predominantly_white_color():
+            self.remember(url, False, 'white', width, height)
             return False
-        self._is_candidate = True
         self.width, self.height = width, height
+        self.remember(url, True, None, width, height)
         return True
 
+    def is_known_loser(self):
+        if not hasattr(self, 'url') or self.has_size_attrs():
+            return False
+        verdict = db.verdict.get(self.url)
+        return verdict is not None and not verdict.is_candidate
+
+    def has_size_attrs(self):
+        # Sizes scaled by attributes of this very tag are not remembered for the url
+        return bool(self.attrs.get('width') or self.attrs.get('height'))
+
+    def remember(self, url, is_candidate, reason, width=0, height=0):
+        if self.cancelled or self.has_size_attrs():
+            return
+        byte_size = self.total_bytes or len(getattr(self, '_raw_data', b''))
+        db.verdict.put(url, is_candidate, width, height, byte_size, reason)
+
     def get_size(self):
         height_attr = self.attrs.get('height', '').strip().rstrip('px')
         width_attr = self.attrs.get('width', '').strip().rstrip('px')
@@ -77,7 +205,14 @@ class WebImage(object):
             return int(width_attr), int(height_attr)
 
         try:
-            w, h = imgsz.frombytes(self.raw_data)[1:]
+            try:
+                w, h = imgsz.frombytes(self.probe_data)[1:]
+            except Exception as e:
+                if hasattr(self, '_raw_data'):
+                    raise
+                # e.g. a jpeg with a large exif before its SOF segment
+                logger.info('Failed to size %s from the first %d bytes, %s', self.url, len(self.probe_data), e)
+                w, h = imgsz.frombytes(self.raw_data)[1:]
             # Scale according to size attr
             if height_attr.isdigit():
                 return w / (h / int(height_attr)), int(height_attr)
@@ -92,45 +227,118 @@ class WebImage(object):
     def raw_data(self):
         if hasattr(self, '_raw_data'):
             return self._raw_data
+        self.check_circuit()
         resp = session.get(self.url, headers={'Referer': self.referrer}, stream=True)
         # meta info
         self.url = resp.url
         resp.raise_for_status()
         bytes = []
         read_bytes = 0
-        for content in resp.iter_content(1 << 20):
+        for content in resp.iter_content(64 << 10):
             if not content:
                 break
+            if self.cancelled:
+                resp.close()
+                raise DownloadCancelled(f'cancelled after {read_bytes} bytes, {self.url}')
             bytes.append(content)
             read_bytes += len(content)
-            if read_bytes > (17 << 20):
+            if read_bytes > self.MAX_DOWNLOAD_BYTES:
                 # To avoid infinite chunk response like - https://hookrace.net/time.gif
                 raise OverflowError(
                     f'too much or infinite content - already read {read_bytes} bytes')
         # if anything goes wrong, do not set self._raw_data so it will try again the next time.
         self._raw_data = b''.join(bytes)
+        cache_streamed(resp, self._raw_data)
         if 'Content-Type' in resp.headers:
             self.content_type = resp.headers['Content-Type']
         return self._raw_data
 
+    @property
+    def probe_data(self):
+        """
+        The first `PROBE_BYTES` of the image, fetched with a Range request (or closed early if the
+        server ignores it), so images rejected by their size are never downloaded in full.
+        Small images are complete in the probe and become `raw_data` directly.
+        """
+        if hasattr(self, '_raw_data'):
+            return self._raw_data
+        if hasattr(self, '_probe_data'):
+            return self._probe_data
+        self.check_circuit()
+        resp = session.get(self.url, headers={'Referer': self.referrer, 'Range': f'bytes=0-{self.PROBE_BYTES - 1}'},
+                           stream=True)
+        try:
+            self.url = resp.url
+            resp.raise_for_status()
+            data = b''
+            for content in resp.iter_content(self.PROBE_BYTES):
+                if self.cancelled:
+                    raise DownloadCancelled(f'cancelled while probing {self.url}')
+                data += content
+                if len(data) >= self.PROBE_BYTES:
+                    break
+        finally:
+            resp.close()
+        data = data[:self.PROBE_BYTES]
+        self.total_bytes = self.parse_total_bytes(resp)
+        if 'Content-Type' in resp.headers:
+            self.content_type = resp.headers['Content-Type']
+        if len(data) < self.PROBE_BYTES or self.total_bytes == len(data):
+            self._raw_data = data
+        else:
+            self._probe_data = data
+        return data
+
+    @staticmethod
+    def parse_total_bytes(resp):
+        if resp.status_code == 206:
+            # e.g. Content-Range: bytes 0-65535/1048576
+            match = re.match(r'bytes \d+-\d+/(\d+)$', resp.headers.get('Content-Range', ''))
+            return int(match.group(1)) if match else 0
+        if resp.status_code == 200:
+            length = resp.headers.get('Content-Length', '')
+            return int(length) if length.isdigit() else 0
+        return 0
+
+    def check_circuit(self):
+        if self.cancelled:
+            raise DownloadCancelled(f'cancelled before fetching {self.url}')
+        host = urlparse(self.url).hostname
+        if not db.host.allow(host):
+            raise CircuitOpenError(f'circuit of {host} is open, skip {self.url}')
+
     @raw_data.setter
     def raw_data(self, value):
         self._raw_data = value
+        self.release_analysis()
+
+    @property
+    def analysis(self) -> ImageAnalysis:
+        """Analysis of the decoded image, None if PIL cannot decode it (e.g. svg)"""
+        if not hasattr(self, '_analysis'):
+            data = self.raw_data
+            try:
+                # Decoding is CPU bound, leave it to other cores
+                self._analysis = workers.run(ImageAnalysis.from_bytes, data)
+            except Exception as e:
+                logger.info('Failed to decode image %s, %s', self.url, e)
+                self._analysis = None
+        return self._analysis
+
+    def release_analysis(self):
+        """Forgets the analysis, which no longer holds once the data is replaced"""
+        self.__dict__.pop('_analysis', None)
 
     def is_predominantly_white_color(self, predominance=.99, white_distance=10):
         try:
-            maxpixels = 1024
-            with Image.open(io.BytesIO(self.raw_data)) as img:
-                img = img.convert('RGB')
-                # img.show()
-                if img.width and img.height:
-                    maxpixels = img.width * img.height
-                colors = img.getcolors(maxcolors=maxpixels)
-                total_count = sum(count for count, color in colors)
-                for count, color in colors:
-                    if count / total_count > predominance and all(255 - white_distance <= value <= 255 for value in color):
-                        logger.info('Maybe a solid color image(%s), dominant_pct=%f, RGB=%s', self.url, count / total_count, color)
-                        return True
+            analysis = self.analysis
+            if not analysis:
+                return False
+            if analysis.is_predominantly_white(predominance, white_distance):
+                logger.info('Maybe a solid color image(%s), dominant_pct=%f, RGB=%s', self.url,
+                            analysis.dominant_pct, analysis.dominant_color)
+                self.release_analysis()  # never used
+                return True
         except Exception as e:
             logger.warning('Failed on image colors check, %s, url=%s', e, self.url)
         return False
@@ -161,23 +369,35 @@ class WebImage(object):
         # To ignore high images like https://reddit-image.s3.amazonaws.com/W3ichcYAUappVkzQXWLNbvriCZepRXi90OmGPD75tho.jpg
         return 0.67 < dimension < 3
 
+    def byte_size(self):
+        if hasattr(self, '_raw_data') or not self.total_bytes:
+            return len(self.raw_data)
+        return self.total_bytes
+
     def check_image_bytesize(self):
-        return self.MIN_BYTES_SIZE < len(self.raw_data) < self.MAX_BYTES_SIZE
+        return self.MIN_BYTES_SIZE < self.byte_size() < self.MAX_BYTES_SIZE
 
-    def try_compress(self):
-        if self.suffix.lower() in ('.svg', '.webp', '.gif'):  # PIL doesnot recognize svg
-            return
-        out = io.BytesIO()
+    def try_compress(self) -> dict:
+        """
+        Encodes the chosen image: replaces it with its webp if that is smaller,
+        and returns its derivatives, width -> webp bytes, made from the same decoding
+        """
+        if not self.analysis:  # PIL doesnot recognize svg
+            return {}
+        compress = self.suffix.lower() not in ('.svg', '.webp', '.gif')
         try:
-            img = Image.open(io.BytesIO(self.raw_data))
-            img.save(out, format='webp', optimize=True, quality=50)
-            if len(self.raw_data) <= len(out.getbuffer()):
-                logger.info(f'got a bigger webp, src: {self.url}')
-                return
-            self.raw_data = out.getbuffer()
-            self.suffix = '.webp'
+            webp, derivatives = workers.run(ImageAnalysis.encode, self.raw_data, compress,
+                                            config.image_derivative_widths)
         except Exception as e:
-            logger.warning(f'{self.url}, {e}')
+            logger.info('Failed to encode image %s, %s', self.url, e)
+            return {}
+        if webp:
+            if len(self.raw_data) <= len(webp):
+                logger.info(f'got a bigger webp, src: {self.url}')
+            else:
+                self.raw_data = webp
+                self.suffix = '.webp'
+        return derivatives
 
     def uniq_name(self):
         fname = md5(self.raw_data).hexdigest()
@@ -189,13 +409,8 @@ class WebImage(object):
             suffix = pathlib.Path(urlparse(unquote(self.url)).path).suffix
             if not suffix:
                 suffix = self.guess_suffix()
-            if not suffix:
-                try:
-                    img = Image.open(io.BytesIO(self.raw_data))
-                    if img.format:
-                        suffix = '.' + img.format.lower()
-                except:
-                    pass
+            if not suffix and self.analysis and self.analysis.format:
+                suffix = '.' + self.analysis.format.lower()
             self._suffix = suffix
         return self._suffix
 
@@ -219,8 +434,12 @@ class WebImage(object):
 
     @classmethod
     def from_node(cls, referrer, node):
+        return cls.from_node_attrs(referrer, node.attrs)
+
+    @classmethod
+    def from_node_attrs(cls, referrer, node_attrs):
         attrs = {'referrer': referrer}
-        for key, value in list(node.attrs.items()):
+        for key, value in list(node_attrs.items()):
             # convert SRC to src, and list to tuple because list is unhashable
             attrs[key.lower()] = tuple(value) if isinstance(value, list) else value
         return cls.from_attrs(**attrs)
@@ -232,8 +451,71 @@ class WebImage(object):
         attrs = json.loads(json_str)
         img = cls(src=attrs['url'])
         img.width, img.height = attrs.get('width', 0), attrs.get('height', 0)
+        img.srcset = {int(width): name for width, name in attrs.get('srcset', {}).items()}
         return img
 
     def to_json_str(self):
         attrs = {'url': self.url, 'width': self.width, 'height': self.height}
+        if self.srcset:
+            attrs['srcset'] = self.srcset
         return json.dumps(attrs, separators=(',', ':'))
+
+
+def first_candidate(images, fan_out=None) -> WebImage:
+    """
+    Returns the first image, in the given order, which `is_candidate`. Images are checked speculatively
+    in parallel with at most `fan_out` downloads at a time, each url only once, and the outstanding
+    checks are cancelled as soon as the winner is known.
+    """
+    unique = {}
+    for img in images:
+        url = getattr(img, 'url', None)  # no url if no src
+        if url and url not in unique:
+            unique[url] = img
+    images = list(unique.values())
+    if not images:
+        return None
+    for img in images:
+        img.cancelled = False
+    fan_out = min(fan_out or config.illustration_fan_out, len(images))
+    if fan_out <= 1:
+        return next((img for img in images if img.is_candidate), None)
+
+    executor = ThreadPoolExecutor(max_workers=fan_out, thread_name_prefix='illustration')
+    futures = []
+    winner = None
+    try:
+        for img in images:
+            futures.append(executor.submit(lambda i=img: i.is_candidate))
+        for img, future in zip(images, futures):
+            if future.result():
+                winner = img
+                return img
+        return None
+    finally:
+        for img, future in zip(images, futures):
+            if not future.done():
+                img.cancelled = True
+            elif img is not winner:
+                img.release_analysis()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def pick_illustration(referrer, img_attrs, meta_images) -> WebImage:
+    """
+    Picks the feature image of a page, out of the attributes of its <img>s, in the order of preference,
+    and the urls of its meta images
+    """
+    images = [WebImage.from_node_attrs(referrer, attrs) for attrs in img_attrs]
+    # Only as a fallback, github use user's avatar as their meta_images
+    meta_images = [WebImage.from_attrs(src=img_src, referrer=referrer) for img_src in meta_images]
+    candidates = images + meta_images
+    # Skip known losers entirely, verdicts of all of them are loaded with one query
+    db.verdict.load(img.url for img in candidates if hasattr(img, 'url'))
+    img = first_candidate([img for img in candidates if not img.is_known_loser()])
+    if img:
+        kind = 'top' if img in images else 'meta'
+        logger.info(f'Found a {kind} image(width={img.width} height={img.height}) {img.url}')
+        return img
+    logger.info('No top image is found on %s', referrer)
+    return None
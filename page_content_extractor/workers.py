@@ -0,0 +1,76 @@
+# coding: utf-8
+import atexit
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import config
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_lock = threading.Lock()
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _lock:
+        if _pool is None:
+            # Spawn, as forking a process full of threads (the pulling pool) may inherit locks held by them
+            _pool = ProcessPoolExecutor(config.worker_processes, mp_context=multiprocessing.get_context('spawn'))
+            logger.info('Started a pool of %d worker processes', config.worker_processes)
+        return _pool
+
+
+def reset_pool(broken):
+    global _pool
+    with _lock:
+        if _pool is broken:  # maybe already replaced by another thread
+            logger.warning('Worker pool is broken, e.g. a worker was killed by OOM, starting a new one')
+            _pool = None
+
+
+def submit(fn, *args) -> Future:
+    """
+    Runs the CPU bound `fn` in a shared process pool, so it does not hold the GIL of the main process.
+    `fn` must be a module level function, and `args` and the result must be picklable.
+    Runs inline when `config.worker_processes` is 0, or in a worker process, pools are not nested.
+    """
+    if config.worker_processes <= 0 or in_worker():
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+    pool = get_pool()
+    try:
+        return pool.submit(fn, *args)
+    except BrokenProcessPool:
+        reset_pool(pool)
+        return get_pool().submit(fn, *args)
+
+
+def in_worker() -> bool:
+    return multiprocessing.parent_process() is not None
+
+
+def run(fn, *args):
+    """Same as `submit`, but waits for the result"""
+    future = submit(fn, *args)
+    try:
+        return future.result()
+    except BrokenProcessPool:
+        reset_pool(_pool)
+        raise
+
+
+@atexit.register
+def shutdown():
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.shutdown(cancel_futures=True)
+            _pool = None
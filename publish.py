@@ -9,10 +9,16 @@ from feedwerk.atom import AtomFeed
 from jinja2 import Environment, FileSystemLoader, filters
 
 import config
+import db.extraction
+import db.host
 import db.translation
+import db.verdict
 from db import image
 from hacker_news.algolia_api import get_daily_news
+from hacker_news.deadline import Deadline
 from hacker_news.parser import HackerNewsParser
+from hacker_news.pipeline import pull_contents
+from page_content_extractor.http_cache import http_cache
 
 logger = logging.getLogger(__name__)
 
@@ -41,8 +47,7 @@ environment.globals["config"] = config
 def gen_frontpage():
     hn = HackerNewsParser()
     news_list = hn.parse_news_list()
-    for news in news_list:
-        news.pull_content()
+    pull_contents(news_list, deadline=Deadline(config.round_timeout, config.stage_budget))
     gen_page(news_list, 'index.html', 'en')
     gen_page(news_list, 'zh.html', 'zh')
     gen_feed(news_list)
@@ -63,7 +68,9 @@ def gen_daily():
     for date, items in daily_items.items():
         for i, item in enumerate(items):
             item.rank = i
-            item.pull_content()
+    # Pull all days in one pool, so the pool never drains at day boundaries
+    pull_contents([item for items in daily_items.values() for item in items])
+    for date, items in daily_items.items():
         gen_page(items, f'daily/{date.strftime("%Y-%m-%d")}/index.html')
 
 
@@ -119,7 +126,10 @@ def gen_feed(news_list):
             continue
         img_tag = ''
         if news.image:
-            img_tag = f'<img src="{news.image.url}" style="{news.image.get_size_style(220)}" /><br />'
+            src = news.image.url
+            if 220 in news.image.srcset:
+                src = f'{config.site}/image/{news.image.srcset[220]}'
+            img_tag = f'<img src="{src}" style="{news.image.get_size_style(220)}" /><br />'
         feed.add(news.title,
                  content='%s%s%s%s' % (
                      img_tag,
@@ -151,3 +161,10 @@ if __name__ == '__main__':
         db.translation.expire()
         db.summary.expire()
         db.image.expire()
+        db.host.expire()
+        db.verdict.expire()
+        db.extraction.expire()
+    db.host.flush()
+    db.verdict.flush()
+    if http_cache:
+        logger.info(http_cache.stats())
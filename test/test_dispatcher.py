@@ -0,0 +1,110 @@
+# coding: utf-8
+import threading
+import time
+from unittest import TestCase, mock
+
+import openai
+
+from hacker_news.deadline import Deadline, StageTimeout
+from hacker_news.llm import openai as llm_openai
+from hacker_news.llm.dispatcher import Dispatcher, parse_duration
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class DispatcherTestCase(TestCase):
+
+    def test_parse_duration(self):
+        self.assertEqual(20, parse_duration('20'))
+        self.assertEqual(6.5, parse_duration('6.5s'))
+        self.assertEqual(90, parse_duration('1m30s'))
+        self.assertAlmostEqual(0.12, parse_duration('120ms'))
+        self.assertEqual(0, parse_duration(None))
+
+    def test_requests_per_minute(self):
+        clock = FakeClock()
+        dispatcher = Dispatcher(rpm=2, clock=clock)
+        dispatcher.acquire(10, 0)
+        clock.now += 10
+        dispatcher.acquire(10, 0)
+        self.assertEqual(50, dispatcher.wait_time(10))  # until the first one is a minute old
+        clock.now += 50
+        self.assertEqual(0, dispatcher.wait_time(10))
+
+    def test_tokens_per_minute(self):
+        clock = FakeClock()
+        dispatcher = Dispatcher(tpm=1000, clock=clock)
+        dispatcher.acquire(600, 0)
+        clock.now += 10
+        dispatcher.acquire(300, 0)
+        self.assertEqual(0, dispatcher.wait_time(100))
+        self.assertEqual(50, dispatcher.wait_time(200))
+        self.assertEqual(60, dispatcher.wait_time(800))
+        clock.now += 60
+        self.assertEqual(0, dispatcher.wait_time(5000))  # too big for the quota, but alone
+
+    def test_higher_priority_first(self):
+        dispatcher = Dispatcher()
+        dispatcher.paused_until = time.monotonic() + 0.5
+        called = []
+
+        def call(priority):
+            dispatcher.call(lambda: called.append(priority), 10, priority)
+
+        threads = [threading.Thread(target=call, args=(priority,)) for priority in (3, 100, 0, 42)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([100, 42, 3, 0], called)
+
+    def test_back_off_on_429(self):
+        dispatcher = Dispatcher()
+        answers = [openai.error.RateLimitError('slow down', headers={'Retry-After': '0.3',
+                                                                     'x-ratelimit-limit-tokens': '6000'}),
+                   {'usage': {'total_tokens': 42}}]
+
+        def create():
+            answer = answers.pop(0)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+
+        start = time.monotonic()
+        self.assertEqual({'usage': {'total_tokens': 42}}, dispatcher.call(create, 100))
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+        self.assertEqual(6000, dispatcher.tpm)
+        self.assertEqual([100, 42], [used for _, used in dispatcher.sent])
+
+    def test_give_up_after_retries(self):
+        dispatcher = Dispatcher()
+
+        def create():
+            raise openai.error.RateLimitError('slow down', headers={'retry-after': '0.01'})
+
+        with self.assertRaises(openai.error.RateLimitError):
+            dispatcher.call(create, 100)
+        self.assertEqual(4, len(dispatcher.sent))
+
+    def test_drop_abandoned_requests(self):
+        dispatcher = Dispatcher()
+        dispatcher.paused_until = time.monotonic() + 10  # rate limited
+        called = []
+        deadline = Deadline(0.3, stage_budget={'summarize': 0.1})
+        self.assertRaises(StageTimeout, deadline.run, 'summarize', dispatcher.call, lambda: called.append(1), 100)
+        time.sleep(1.5)  # wakes up within a poll
+        self.assertEqual([], dispatcher.queue)
+        self.assertEqual([], called)
+        self.assertEqual(0, len(dispatcher.sent))
+
+    def test_count_tokens_without_tiktoken(self):
+        with mock.patch.object(llm_openai, 'encoding', side_effect=OSError('offline')):
+            self.assertEqual(100, llm_openai.count_tokens('你好' * 50))
+            self.assertEqual(25, llm_openai.count_tokens('abcd' * 25))
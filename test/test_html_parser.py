@@ -1,11 +1,18 @@
 # coding: utf-8
+import io
 import os.path
+import pickle
+import random
 import unittest
-from unittest import TestCase
+from unittest import TestCase, mock
 
+import requests
+
+import config
 from hacker_news.news import News
-from page_content_extractor import parser_factory
+from page_content_extractor import parser_factory, extract, extract_response, workers
 from page_content_extractor.html import *
+from page_content_extractor.utils import *
 
 
 class PageContentExtractorTestCase(TestCase):
@@ -16,7 +23,7 @@ class PageContentExtractorTestCase(TestCase):
         <html>good<script>whatever</script></html>
         """
         e = HtmlContentExtractor(html_doc)
-        e.purge()
+        e.harvest_and_purge()
         self.assertIsNone(e.doc.find('script'))
 
     def test_text_len_with_comma(self):
@@ -224,6 +231,62 @@ and supported by community <em>donations</em>.</p></article>
         a = HtmlContentExtractor(html_doc).get_content()
         self.assertTrue(a.endswith('by community donations.'), msg=f'actual content: {a!r}')
 
+    @mock.patch('page_content_extractor.session')
+    def test_truncate_large_download(self, mock_session):
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.url = 'http://local.host/endless.txt'
+        resp.headers['content-type'] = 'text/plain; charset=utf-8'
+        resp.raw = io.BytesIO(b'endless ' * config.max_content_size)
+        mock_session.get.return_value = resp
+        parser = parser_factory(resp.url)
+        self.assertTrue(resp.truncated)
+        self.assertEqual(config.max_download_bytes['text'], len(resp.content))
+        self.assertTrue(parser.get_content().startswith('endless endless'))
+
+    @mock.patch('page_content_extractor.session')
+    def test_reject_unknown_download(self, mock_session):
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.url = 'http://local.host/a.bin'
+        resp.headers['content-type'] = 'application/octet-stream'
+        resp.raw = io.BytesIO(b'binary ' * 100)
+        mock_session.get.return_value = resp
+        with self.assertRaisesRegex(TypeError, 'application/octet-stream'):
+            parser_factory(resp.url)
+        self.assertFalse(resp._content_consumed)  # closed without reading the body
+        self.assertTrue(resp.raw.closed)
+
+    def test_extract_in_worker(self):
+        html_doc = ('<html><head><title>The title</title><meta name="description" content="desc">'
+                    '<meta property="og:image" content="/meta.png"></head><body><article>'
+                    '<img src="/a.png" class="a b"><p>' + 'word ' * 100 + '</p></article></body></html>')
+        url = 'https://local.host/a/b.html'
+        result = extract(html_doc.encode('gbk'), 'gbk', {'content-type': 'text/html'}, 200, url, url)
+        result = pickle.loads(pickle.dumps(result))
+        parser = HtmlContentExtractor(html_doc, url)
+        self.assertEqual(parser.title, result.title)
+        self.assertEqual(parser.get_content(), result.get_content())
+        self.assertEqual(parser.get_favicon_url(), result.get_favicon_url())
+        self.assertEqual('desc', result.get_meta_description())
+        self.assertEqual(['/meta.png'], result.get_meta_image())
+        self.assertEqual([{'src': 'https://local.host/a.png', 'class': ['a', 'b']}] * 2, result.img_attrs)
+        self.assertFalse(result.is_empty())
+        self.assertTrue(extract(b'<html></html>', 'utf8', {'content-type': 'text/html'}, 200, url, url).is_empty())
+
+    def test_extracted_once(self):
+        resp = requests.Response()
+        resp.status_code, resp.encoding = 200, 'utf8'
+        resp.url = f'https://local.host/{random.random()}.html'
+        resp.headers['content-type'] = 'text/html'
+        resp._content = ('<title>Once</title><p>' + 'word ' * 100 + '</p>').encode()
+        with mock.patch('page_content_extractor.workers.run', wraps=workers.run) as run:
+            first = extract_response(resp, resp.url)
+            second = extract_response(resp, resp.url)
+        self.assertEqual(1, run.call_count)
+        self.assertEqual(vars(first), vars(second))
+        self.assertEqual('Once', second.title)
+
     def test_ask_hn_include_content(self):
         parser = parser_factory('https://news.ycombinator.com/item?id=36317509')
         content = parser.get_content()
@@ -285,6 +348,39 @@ and supported by community <em>donations</em>.</p></article>
         parser = HtmlContentExtractor(html_doc)
         self.assertEqual([src, src, src], parser.get_meta_image())
 
+    def test_harvest_before_purge(self):
+        html_doc = """
+        <html><head><title>the title</title>
+        <meta name="description" content="desc"><link rel="icon" href="/a.ico">
+        <meta property="og:image" content="/a.png"></head>
+        <body><noscript><meta name="twitter:image" content="/b.png"></noscript>
+        <div style="color:red; display:none">hidden</div><p>text</p></body></html>
+        """
+        parser = HtmlContentExtractor(html_doc, 'https://local.host/a/b.html')
+        self.assertEqual('the title', parser.title)
+        self.assertEqual('desc', parser.get_meta_description())
+        self.assertEqual(['/a.png', '/b.png'], parser.get_meta_image())
+        self.assertEqual('https://local.host/a.ico', parser.get_favicon_url())
+        for name in ('head', 'noscript', 'meta'):
+            self.assertEqual([], parser.find_all(parser.doc, name))
+        self.assertEqual('text', parser.text(parser.doc).strip())
+
+    def test_cut_huge_page(self):
+        html_doc = ('<html><head><title>the title</title><meta name="description" content="desc"></head><body>'
+                    + '<p>line</p>' * 1000 + '<p>tail</p></body></html>')
+        with mock.patch.object(config, 'max_parse_nodes', 100):
+            parser = HtmlContentExtractor(html_doc)
+            self.assertEqual(95, len(parser.find_all(parser.doc, 'p')))  # html, head, title, meta and body count
+            self.assertNotIn('tail', parser.text(parser.doc))
+            self.assertEqual('the title', parser.title)
+            self.assertEqual('desc', parser.get_meta_description())
+        with mock.patch.object(config, 'max_parse_size', 1000):
+            parser = HtmlContentExtractor(html_doc)
+            self.assertLess(len(parser.find_all(parser.doc, 'p')), 100)
+            self.assertEqual('desc', parser.get_meta_description())
+        parser = HtmlContentExtractor(html_doc)
+        self.assertEqual(1001, len(parser.find_all(parser.doc, 'p')))
+
     def test_no_double_punish_on_negative_node(self):
         html_doc = f"""
         <div>
@@ -298,6 +394,54 @@ and supported by community <em>donations</em>.</p></article>
         self.assertEqual(2, parser.calc_effective_text_len(parser.doc.find('foot')))  # negative
         self.assertEqual(2, parser.calc_effective_text_len(parser.doc.find('div')))  # positive
 
+    def test_deep_document(self):
+        html_doc = '<div>' * 3000 + 'deep text, ' * 30 + '</div>' * 3000
+        parser = HtmlContentExtractor(html_doc)
+        self.assertEqual(('deep text, ' * 30).strip(), parser.get_content())
+
+    def test_text_stats(self):
+        html_doc = '<div><p>Re<b>d</b> 我的　<a href="/">link text</a></p><p><code>a\nb</code></p></div>'
+        parser = HtmlContentExtractor(html_doc)
+        div = parser.find_all(parser.doc, 'div')[0]
+        stats = parser.text_stats(div)
+        self.assertEqual(len(tokenize(parser.text(div))), token_count(stats.tokens))
+        self.assertEqual(len('Red我的link texta\nb'), stats.stripped_len)
+        self.assertEqual(len('link text'), stats.link_len)
+        self.assertTrue(stats.has_newline)
+        self.assertFalse(parser.text_stats(parser.find_all(parser.doc, 'p')[0]).has_newline)
+
+    def test_merged_token_stats(self):
+        text = ' ab我 c\xa0d,e　 f　'
+        for i in range(len(text) + 1):
+            for j in range(i, len(text) + 1):
+                stats = merge_token_stats(merge_token_stats(token_stats(text[:i]), token_stats(text[i:j])),
+                                          token_stats(text[j:]))
+                self.assertEqual(len(tokenize(text)), token_count(stats), msg=f'{text[:i]!r} {text[i:j]!r}')
+
+    def test_bit_parallel_LCS(self):
+        def reference_LCS_length(x, y):  # the textbook O(n*m) one
+            lcs = [[0] * (len(y) + 1) for _ in range(len(x) + 1)]
+            for i in range(1, len(x) + 1):
+                for j in range(1, len(y) + 1):
+                    lcs[i][j] = lcs[i - 1][j - 1] + 1 if x[i - 1] == y[j - 1] else max(lcs[i - 1][j], lcs[i][j - 1])
+            return lcs[-1][-1]
+
+        rand = random.Random(42)
+        for _ in range(500):
+            x = tuple(rand.choices('abcd', k=rand.randint(0, 90)))
+            y = tuple(rand.choices('abcde', k=rand.randint(0, 40)))
+            self.assertEqual(reference_LCS_length(x, y), LCS_length(x, y), msg=f'{x} {y}')
+
+    def test_string_included(self):
+        rand = random.Random(42)
+        words = ['a', 'b', 'c', '我', 'the']
+        for _ in range(500):
+            needle = ' '.join(rand.choices(words, k=rand.randint(0, 20)))
+            haystack = ' '.join(rand.choices(words, k=rand.randint(0, 20)))
+            for threshold in (0, .5, .85, 1):
+                self.assertEqual(string_inclusion_ratio(needle, haystack) > threshold,
+                                 is_string_included(needle, haystack, threshold), msg=f'{needle!r} {haystack!r}')
+
     @unittest.skip('Only for debug purpose')
     def test_for_debug(self):
         news = News(
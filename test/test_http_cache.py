@@ -0,0 +1,175 @@
+# coding: utf-8
+import os
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest import TestCase, mock
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import db.host
+from hacker_news.deadline import Deadline, StageTimeout
+from page_content_extractor import http
+from page_content_extractor.http_cache import HttpCache
+
+
+def make_response(status, body=b'', headers=None):
+    resp = requests.Response()
+    resp.status_code = status
+    resp.headers = CaseInsensitiveDict(headers or {})
+    resp._content = body
+    return resp
+
+
+def make_request(url):
+    return requests.Request('GET', url).prepare()
+
+
+class ETagHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, so a 304 must leave the connection reusable
+    body = b'<html><body>hello</body></html>'
+
+    def do_GET(self):
+        self.server.clients.add(self.client_address)
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.send_header('ETag', '"v1"')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class SlowHandler(ETagHandler):
+
+    def do_GET(self):
+        time.sleep(0.3)
+        super().do_GET()
+
+
+class HttpCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache = HttpCache(self.dir.name, max_size=100, max_entry_size=80)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_revalidate(self):
+        headers = {'ETag': '"v1"', 'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT',
+                   'Content-Type': 'text/html; charset=utf-8', 'Content-Length': '5'}
+        req = make_request('http://a.com/')
+        self.assertIsNone(self.cache.prepare(req))
+        self.cache.handle(req, make_response(200, b'hello', headers), None)
+
+        req = make_request('http://a.com/')
+        meta = self.cache.prepare(req)
+        self.assertEqual('"v1"', req.headers['If-None-Match'])
+        self.assertEqual('Wed, 21 Oct 2015 07:28:00 GMT', req.headers['If-Modified-Since'])
+        resp = self.cache.handle(req, make_response(304), meta)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('hello', resp.text)
+        self.assertEqual('text/html; charset=utf-8', resp.headers['Content-Type'])
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+
+    def test_no_validators(self):
+        req = make_request('http://a.com/')
+        self.cache.handle(req, make_response(200, b'hello', {'Content-Length': '5'}), None)
+        self.assertIsNone(self.cache.prepare(make_request('http://a.com/')))
+        req = make_request('http://a.com/')
+        req.headers['Range'] = 'bytes=0-10'
+        self.cache.handle(req, make_response(200, b'hello', {'ETag': 'x', 'Content-Length': '5'}), None)
+        self.assertIsNone(self.cache.prepare(make_request('http://a.com/')))
+
+    def test_lru_eviction(self):
+        for name in ('a', 'b', 'c'):
+            self.cache.handle(make_request(f'http://{name}.com/'),
+                              make_response(200, b'x' * 40, {'ETag': name, 'Content-Length': '40'}), None)
+            if name == 'b':
+                self.cache.touch(self.cache.key('http://a.com/'))
+        self.assertEqual(1, self.cache.evictions)
+        self.assertIsNotNone(self.cache.prepare(make_request('http://a.com/')))
+        self.assertIsNone(self.cache.prepare(make_request('http://b.com/')))
+        self.assertFalse(os.path.exists(self.cache.path(self.cache.key('http://b.com/'), '.body')))
+        # reload from disk
+        cache = HttpCache(self.dir.name, max_size=100, max_entry_size=80)
+        self.assertEqual(2, len(cache.index))
+
+    def serve(self, handler=ETagHandler):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        server.daemon_threads = True
+        server.clients = set()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.server = server
+        patcher = mock.patch.object(http, 'http_cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        session = http.new_session()
+        self.addCleanup(session.close)
+        return f'http://127.0.0.1:{server.server_port}/', session
+
+    def test_keep_alive_across_threads(self):
+        url, session = self.serve()
+        for _ in range(3):  # e.g. stage threads, which only live for one request
+            thread = threading.Thread(target=lambda: session.get(url, timeout=5))
+            thread.start()
+            thread.join()
+        self.assertEqual(1, len(self.server.clients))  # one connection
+
+    def test_streamed_revalidate(self):
+        url, session = self.serve()
+        for _ in range(2):
+            resp = session.get(url, stream=True, timeout=5)
+            self.assertEqual(200, resp.status_code)
+            self.assertFalse(http.read_body(resp, 1 << 20))
+            self.assertEqual(ETagHandler.body, resp.content)
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+
+    @mock.patch.object(db.host, 'record')
+    def test_no_record_of_abandoned_stage(self, mock_record):
+        url, session = self.serve(SlowHandler)
+        deadline = Deadline(stage_budget={'fetch': 0.1})
+        self.assertRaises(StageTimeout, deadline.run, 'fetch', lambda: session.get(url, timeout=5))
+        time.sleep(0.5)  # the response arrives after the stage is given up
+        self.assertFalse(mock_record.called)
+        session.get(url, timeout=5)
+        self.assertTrue(mock_record.called)
+
+    def test_streamed_stored_after_read(self):
+        url, session = self.serve()
+        resp = session.get(url, stream=True, timeout=5)
+        self.assertEqual(0, self.cache.stores)  # left to the caller
+        self.assertTrue(http.read_body(resp, 10))
+        self.assertEqual(0, self.cache.stores)  # a truncated body is not stored
+        resp = session.get(url, stream=True, timeout=5)
+        self.assertFalse(http.read_body(resp, 1 << 20))
+        self.assertEqual(1, self.cache.stores)
+
+    def test_body_evicted_after_prepare(self):
+        url, session = self.serve()
+        session.get(url, timeout=5)
+        key = self.cache.key(url)
+        original_prepare = self.cache.prepare
+
+        def prepare_then_evict(request):
+            meta = original_prepare(request)
+            os.remove(self.cache.path(key, '.body'))
+            return meta
+
+        with mock.patch.object(self.cache, 'prepare', prepare_then_evict):
+            resp = session.get(url, timeout=5)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(ETagHandler.body, resp.content)
+        self.assertEqual(0, self.cache.hits)
@@ -1,11 +1,36 @@
 # coding: utf-8
+import io
 import os
+import time
 from unittest import TestCase
 
 import mock
+import requests
+from PIL import Image
 
+import config
+import db.verdict
 from page_content_extractor.imgsz import *
-from page_content_extractor.webimage import WebImage
+from page_content_extractor.imgsz import frombytes as size_of
+from page_content_extractor.webimage import ImageAnalysis, WebImage, first_candidate
+
+
+class FakeImage(WebImage):
+
+    def __init__(self, src, delay, is_candidate, checked):
+        super().__init__(src=src)
+        self.delay = delay
+        self.candidate = is_candidate
+        self.checked = checked
+
+    def check_candidate(self):
+        self.checked.append(self.url)
+        deadline = time.time() + self.delay
+        while time.time() < deadline:
+            if self.cancelled:
+                return False
+            time.sleep(0.01)
+        return self.candidate
 
 
 class SvgSizeTestCase(TestCase):
@@ -25,6 +50,14 @@ class SvgSizeTestCase(TestCase):
 
 class WebImageTestCase(TestCase):
 
+    def setUp(self):
+        # Verdicts are remembered across runs, keep them out of the way
+        patcher = mock.patch.object(config, 'disable_summary_cache', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        db.verdict._verdicts.clear()
+        self.addCleanup(db.verdict._dirty.clear)
+
     @mock.patch('page_content_extractor.webimage.session')
     def test_fetched_only_once(self, mock_requests):
         mock_requests.get.return_value.content = ''
@@ -53,6 +86,89 @@ class WebImageTestCase(TestCase):
         img = WebImage.from_node('', node)
         self.assertEqual(img.uniq_name(), 'd41d8cd98f00b204e9800998ecf8427e.svg')
 
+    @staticmethod
+    def fake_get(data, support_range=True):
+        def get(url, headers=None, stream=False):
+            resp = requests.Response()
+            resp.url = url
+            resp.status_code = 200
+            body = data
+            if support_range and 'Range' in headers:
+                end = int(headers['Range'].rpartition('-')[2])
+                body = data[:end + 1]
+                resp.status_code = 206
+                resp.headers['Content-Range'] = f'bytes 0-{len(body) - 1}/{len(data)}'
+            resp.headers['Content-Length'] = str(len(body))
+            resp.raw = io.BytesIO(body)
+            return resp
+        return get
+
+    @mock.patch.object(WebImage, 'PROBE_BYTES', 1024)
+    @mock.patch('page_content_extractor.webimage.session')
+    def test_probe_before_download(self, mock_session):
+        fpath = os.path.join(os.path.dirname(__file__), 'fixtures/medium_Comment_f406ff2a89.png')
+        with open(fpath, 'rb') as stream:
+            data = stream.read()
+        for support_range in (True, False):
+            mock_session.reset_mock()
+            mock_session.get.side_effect = self.fake_get(data, support_range)
+            img = WebImage(src='https://example.com/big.png', width='50')  # too narrow
+            self.assertFalse(img.is_candidate)
+            self.assertEqual(1, mock_session.get.call_count)  # never downloaded in full
+
+            img = WebImage(src='https://example.com/big.png')
+            self.assertEqual((1300, 787), img.get_size())
+            self.assertEqual(len(data), img.byte_size())
+            self.assertEqual(1, mock_session.get.call_count - 1)
+            self.assertEqual(data, img.raw_data)
+            self.assertEqual(3, mock_session.get.call_count)
+
+    @mock.patch('page_content_extractor.webimage.session')
+    def test_remembered_verdict(self, mock_session):
+        fpath = os.path.join(os.path.dirname(__file__), 'fixtures/home.png')  # 128x128 but too small in bytes
+        with open(fpath, 'rb') as stream:
+            mock_session.get.side_effect = self.fake_get(stream.read())
+        url = 'https://example.com/remembered.png'
+        self.assertFalse(WebImage(src=url, referrer='https://a.com/').is_candidate)
+        self.assertEqual('bytesize', db.verdict.get(url).reason)
+        self.assertEqual(1, mock_session.get.call_count)
+        img = WebImage(src=url, referrer='https://b.com/')
+        self.assertTrue(img.is_known_loser())
+        self.assertFalse(img.is_candidate)
+        self.assertEqual(1, mock_session.get.call_count)  # no network io for a known loser
+
+    @mock.patch('page_content_extractor.webimage.session')
+    def test_remembered_winner_gone(self, mock_session):
+        fpath = os.path.join(os.path.dirname(__file__), 'fixtures/medium_Comment_f406ff2a89.png')
+        with open(fpath, 'rb') as stream:
+            data = stream.read()
+        gone, alive = 'https://example.com/gone.png', 'https://example.com/alive.png'
+        for url in (gone, alive):
+            db.verdict.put(url, True, 1300, 787, len(data))
+
+        def get(url, headers=None, stream=False):
+            if url == gone:
+                raise requests.HTTPError('404 Client Error')
+            return self.fake_get(data)(url, headers, stream)
+
+        mock_session.get.side_effect = get
+        images = [WebImage(src=gone), WebImage(src=alive)]
+        self.assertIs(images[1], first_candidate(images, fan_out=1))
+        self.assertIsNone(db.verdict.get(gone))  # checked afresh next time
+        self.assertEqual(data, images[1].raw_data)
+        self.assertEqual(2, mock_session.get.call_count)
+
+    @mock.patch('page_content_extractor.webimage.session')
+    def test_small_image_complete_in_probe(self, mock_session):
+        fpath = os.path.join(os.path.dirname(__file__), 'fixtures/home.png')
+        with open(fpath, 'rb') as stream:
+            data = stream.read()
+        mock_session.get.side_effect = self.fake_get(data)
+        img = WebImage(src='https://example.com/home.png')
+        self.assertEqual((128, 128), img.get_size())
+        self.assertEqual(data, img.raw_data)
+        self.assertEqual(1, mock_session.get.call_count)
+
     def test_webp_compression(self):
         img = WebImage.from_json_str('{"url":"aaa"}')
         fpath = os.path.join(os.path.dirname(__file__), 'fixtures/home.png')
@@ -63,6 +179,37 @@ class WebImageTestCase(TestCase):
         self.assertEqual('.webp', img.suffix)
         self.assertEqual('c1a11593331f7678c7addb3c0001f57f.webp', img.uniq_name())
 
+    def test_only_chosen_image_encoded(self):
+        img = WebImage.from_json_str('{"url":"aaa"}')
+        fpath = os.path.join(os.path.dirname(__file__), 'fixtures/home.png')
+        with open(fpath, 'rb') as stream:
+            img.raw_data = stream.read()
+        with mock.patch.object(config, 'worker_processes', 0), \
+                mock.patch('page_content_extractor.webimage.Image.open', wraps=Image.open) as mock_open, \
+                mock.patch.object(ImageAnalysis, 'to_webp', wraps=ImageAnalysis.to_webp) as mock_to_webp:
+            # Checking a candidate decodes it once, and encodes nothing
+            self.assertFalse(img.is_predominantly_white_color())
+            self.assertEqual('.png', img.suffix)
+            self.assertEqual(1, mock_open.call_count)
+            self.assertFalse(mock_to_webp.called)
+            img.try_compress()
+        self.assertEqual(2, mock_open.call_count)
+        self.assertEqual(1, mock_to_webp.call_count)
+        self.assertEqual('c1a11593331f7678c7addb3c0001f57f.webp', img.uniq_name())
+
+    def test_derivatives(self):
+        for fname, widths in (('home.png', []), ('medium_Comment_f406ff2a89.png', [220, 440])):
+            img = WebImage.from_json_str('{"url":"%s"}' % fname)
+            with open(os.path.join(os.path.dirname(__file__), 'fixtures', fname), 'rb') as stream:
+                img.raw_data = stream.read()
+            derivatives = img.try_compress()
+            self.assertEqual(widths, sorted(derivatives))
+            for width, data in derivatives.items():
+                self.assertEqual(('WEBP', width), size_of(data)[:2])
+
+        img.srcset = {220: 'c1/c1-220w.webp', 1300: 'c1/c1.webp'}
+        self.assertEqual(img.srcset, WebImage.from_json_str(img.to_json_str()).srcset)
+
     def test_predominantly_white_color(self):
         for fname, is_white_color in (
                 ('home.png', False),
@@ -74,3 +221,33 @@ class WebImageTestCase(TestCase):
             with open(fpath, 'rb') as stream:
                 img.raw_data = stream.read()
             self.assertEqual(is_white_color, img.is_predominantly_white_color())
+
+
+class FirstCandidateTestCase(TestCase):
+
+    def test_first_in_document_order(self):
+        checked = []
+        images = [FakeImage('https://a.com/0.png', 0.2, False, checked),
+                  FakeImage('https://a.com/1.png', 0.3, True, checked),
+                  FakeImage('https://a.com/2.png', 0, True, checked)]
+        self.assertIs(images[1], first_candidate(images, fan_out=3))
+        self.assertFalse(images[1].cancelled)
+        self.assertTrue(images[2].is_candidate)  # the verdict of a finished check is kept
+
+    def test_each_url_checked_once(self):
+        checked = []
+        images = [FakeImage('https://a.com/0.png', 0, False, checked),
+                  FakeImage('https://a.com/0.png', 0, True, checked)]
+        self.assertIsNone(first_candidate(images, fan_out=2))
+        self.assertEqual(['https://a.com/0.png'], checked)
+
+    def test_cancel_outstanding(self):
+        checked = []
+        images = [FakeImage('https://a.com/0.png', 0.05, True, checked),
+                  FakeImage('https://a.com/1.png', 10, True, checked)]
+        start = time.time()
+        self.assertIs(images[0], first_candidate(images, fan_out=2))
+        self.assertLess(time.time() - start, 1)
+        self.assertTrue(images[1].cancelled)
+        time.sleep(0.1)
+        self.assertFalse(hasattr(images[1], '_is_candidate'))  # to be checked again next time
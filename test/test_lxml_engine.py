@@ -0,0 +1,121 @@
+# coding: utf-8
+import os
+import unittest
+from unittest import TestCase, mock
+
+import config
+from page_content_extractor.html import HtmlContentExtractor
+from page_content_extractor.html_lxml import LxmlContentExtractor
+from test import test_html_parser
+
+
+class LxmlEngineTestCase(test_html_parser.PageContentExtractorTestCase):
+    """The same tests as HtmlContentExtractor's, on LxmlContentExtractor"""
+
+    def setUp(self):
+        for patcher in (mock.patch.object(test_html_parser, 'HtmlContentExtractor', LxmlContentExtractor),
+                        mock.patch.object(config, 'html_engine', 'lxml')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    # The ones below take bs4 nodes, feed them lxml ones instead
+
+    def test_purge(self):
+        e = LxmlContentExtractor('<html>good<script>whatever</script></html>')
+        e.harvest_and_purge()
+        self.assertEqual([], e.find_all(e.doc, 'script'))
+
+    def test_text_len_with_comma(self):
+        e = LxmlContentExtractor('<html>good,，</html>')
+        self.assertEqual(e.calc_effective_text_len(e.doc), 8)
+
+    def test_parsing_empty_response(self):
+        e = LxmlContentExtractor("""
+        """)
+        self.assertEqual(e.text(e.article), '')
+
+    def test_semantic_affect(self):
+        def check(effect, html_doc, name='p'):
+            e = LxmlContentExtractor(html_doc)
+            return getattr(e, effect)(e.find_all(e.doc, name)[0])
+
+        self.assertTrue(check('has_positive_effect', '<article>good</article>', 'article'))
+        self.assertFalse(check('has_negative_effect', '<p>good</p>'))
+        self.assertFalse(check('has_positive_effect', '<p>good</p>'))
+        self.assertTrue(check('has_positive_effect', '<p class="conteNt">good</p>'))
+        self.assertTrue(check('has_negative_effect', '<p class="comment">good</p>'))
+
+    def test_get_content_with_link_intensive(self):
+        html_doc = '<div><p><a href="whatever">' + '1 ' * 500 + '</a></p>' + \
+                   '<p>' + '2 ' * 500 + '</p></div>'
+        pp = LxmlContentExtractor(html_doc)
+        pp.article = pp.find_all(pp.doc, 'div')[0]
+        summary = pp.get_content(300)
+        self.assertTrue(summary.startswith('2 ' * 10), msg=f'actual summary: {summary!r}')
+
+    def test_no_double_punish_on_negative_node(self):
+        parser = LxmlContentExtractor(f"<div><foot><h1>{'a'*10}</h1></foot></div>")
+        for name in ('h1', 'foot', 'div'):
+            self.assertEqual(2, parser.calc_effective_text_len(parser.find_all(parser.doc, name)[0]))
+
+    @unittest.skip('Same as the bs4 one, save the network')
+    def test_ask_hn_include_content(self):
+        pass
+
+    @unittest.skip('Same as the bs4 one, save the network')
+    def test_arxiv_content(self):
+        pass
+
+    @unittest.skip('Same as the bs4 one, save the network')
+    def test_link_intensive_wikipedia(self):
+        pass
+
+
+class EngineParityTestCase(TestCase):
+    """Both engines give the same results, down to the whitespaces"""
+
+    def assertSameResults(self, html_doc, url='https://local.host/a/b.html'):
+        results = []
+        for engine in (HtmlContentExtractor, LxmlContentExtractor):
+            e = engine(html_doc, url)
+            results.append((e.title, e.get_content(), e.get_content(200), e.get_favicon_url(), e.get_meta_description(),
+                            e.get_meta_image(), e.is_empty(), e.node_identify(e.article), e.max_score,
+                            [e.attrs(img) for img in e.find_all(e.article, 'img')]))
+        self.assertEqual(*results)
+
+    def test_fixture(self):
+        with open(os.path.join(os.path.dirname(__file__), 'fixtures/kim.com.html')) as fp:
+            self.assertSameResults(fp.read())
+
+    def test_whitespaces(self):
+        self.assertSameResults('<div><p>hello   world</p><pre>\n  a  \n <b>  </b>\n</pre>  \n'
+                               '  <textarea>   </textarea> tail, and more </div>')
+        self.assertSameResults('<p>\xa0 \xa0</p><p>  </p><div>\t\n</div><p>' + 'word\xa0 ' * 50 + '</p>')
+
+    def test_removed_and_left_out_nodes(self):
+        self.assertSameResults('<div>a <!-- c --> b<script>x</script> c <style>y</style>  d<?php echo 1 ?> e</div>' * 5)
+        self.assertSameResults('<body><div style="display:none">' + 'x ' * 300 + '</div>'
+                               '<div style="color:red; display:none">' + 'y ' * 200 + '</div>'
+                               '<div style="display: none">' + 'kept ' * 200 + '</div>'
+                               '<link type="text/css" href="a.css"><p>' + 'text ' * 100 + '</p></body>')
+        self.assertSameResults('<html><body style="display:none"><p>' + 'w ' * 100 + '</p></body></html>')
+
+    def test_ruby_and_template(self):
+        self.assertSameResults('<article><p>漢<ruby>字<rp>(</rp><rt>kan</rt><rp>)</rp></ruby> more text, and more</p>'
+                               '<template><p>not shown , ,</p></template></article>')
+
+    def test_title_and_meta(self):
+        self.assertSameResults('<title> <!--x--> </title><h1>My great title here</h1><div class="post">'
+                               '<h1>My great title here</h1><p>' + 'body text, ' * 80 + '</p></div>')
+        self.assertSameResults('<svg><title>svg</title></svg><title><b>real</b></title>')
+        self.assertSameResults('<meta name="Description" content="d1"><meta property="og:description" content="d2 &lt;b&gt;">'
+                               '<meta property="og:image" content="/i.png"><meta name="twitter:image:src" content="/b.png">'
+                               '<link rel="Shortcut Icon" href="/fav.png"><img src="x.png" class="a  b" width=300>'
+                               '<p>' + 'x ' * 30 + '</p>')
+
+    def test_malformed(self):
+        self.assertSameResults('<p>a</span>b<div><p>c<table><td>cell ' + 'z ' * 40 + '<p>in cell</table></div>x</i>y<b><i>z</b></i>')
+        self.assertSameResults('<div>' * 300 + 'deep text ' * 30 + '</div>' * 300)
+        self.assertSameResults('<meta charset="gbk"><title>我的</title><p>' + '中文，内容 ' * 100)
+        self.assertSameResults('')
+        self.assertSameResults('  \n  ')
@@ -1,7 +1,9 @@
 # coding: utf-8
 import os
 import pathlib
+import time
 import unittest
+from datetime import datetime, timedelta
 from unittest import TestCase, mock
 
 import openai
@@ -9,6 +11,7 @@ import config
 import db
 from db.engine import session_scope
 from db.summary import Model
+from hacker_news.deadline import Deadline, StageTimeout
 from hacker_news.llm.openai import summarize_by_openai_family
 from hacker_news.llm import qwen
 from hacker_news.news import News
@@ -116,3 +119,73 @@ class NewsSummaryTestCase(TestCase):
             with session_scope() as session:
                 session.delete(news.cache)
                 pathlib.Path(os.path.join(config.image_dir, db_summary.image_name)).unlink()
+
+    @mock.patch('hacker_news.news.parser_factory')
+    def test_downgrade_to_cache_when_fetch_times_out(self, mock_parser_factory):
+        mock_parser_factory.side_effect = lambda url: time.sleep(1)
+        news = News(title='Slow site', url='slow_url')
+        db.summary.put(db.Summary(news.url, 'cached summary', Model.PREFIX))
+        deadline = Deadline(stage_budget={'fetch': 0.1, 'summarize': 0.1, 'image': 0.1})
+        try:
+            news.pull_content(deadline)
+            self.assertEqual('cached summary', news.summary)
+            self.assertEqual(Model.PREFIX, news.summarized_by)
+            self.assertEqual([(news, 'fetch')], deadline.downgraded)
+        finally:
+            with session_scope() as session:
+                session.delete(news.cache)
+
+    @mock.patch.object(qwen, '_summarize')
+    def test_no_inference_for_abandoned_items(self, mock_summarize):
+        mock_summarize.return_value = 'summary'
+        deadline = Deadline(0.3, stage_budget={'summarize': 0.1})
+        with qwen._llm_lock:  # busy with another item
+            start = time.time()
+            # Waiting for the lock is not counted against the stage, but the round runs out
+            self.assertRaises(StageTimeout, deadline.run, 'summarize', qwen.summarize_by_local_qwen, 'content')
+            self.assertGreater(time.time() - start, 0.25)
+        time.sleep(0.1)
+        self.assertFalse(mock_summarize.called)
+        self.assertFalse(qwen._llm_lock.locked())
+
+    @mock.patch.object(News, 'summarize_by_llm')
+    def test_backoff_on_unchanged_content(self, mock_summarize_by_llm):
+        mock_summarize_by_llm.return_value = ('prefix summary', Model.PREFIX)
+        news = News(url='unchanged_url')
+        content = 'unchanged content ' * 100
+        self.assertEqual(('prefix summary', Model.PREFIX), news.summarize(content))
+        news.cache.summary, news.cache.model = 'prefix summary', Model.PREFIX.value
+        self.assertEqual(1, news.cache.retries)
+
+        self.assertEqual(('prefix summary', Model.PREFIX), news.summarize(content))
+        self.assertEqual(1, mock_summarize_by_llm.call_count)  # not retried yet
+
+        news.cache.next_retry = datetime.utcnow() - timedelta(seconds=1)
+        news.summarize(content)
+        self.assertEqual(2, mock_summarize_by_llm.call_count)
+        self.assertEqual(2, news.cache.retries)
+        self.assertGreater(news.cache.next_retry,
+                           datetime.utcnow() + timedelta(seconds=config.summary_retry_backoff * 1.5))
+
+        news.summarize('changed content ' * 100)  # retried at once
+        self.assertEqual(3, mock_summarize_by_llm.call_count)
+        self.assertEqual(1, news.cache.retries)
+
+        mock_summarize_by_llm.return_value = ('final summary', Model.OPENAI)
+        news.cache.next_retry = None
+        news.summarize(content)
+        self.assertEqual((0, None), (news.cache.retries, news.cache.next_retry))
+
+    @mock.patch.object(News, 'summarize_by_llm')
+    def test_backoff_when_summarize_times_out(self, mock_summarize_by_llm):
+        mock_summarize_by_llm.side_effect = lambda content: time.sleep(1)
+        news = News(url='slow_llm_url')
+        news.deadline = Deadline(stage_budget={'summarize': 0.1})
+        content = 'slow content ' * 100
+        self.assertRaises(StageTimeout, news.summarize, content)
+        self.assertEqual(1, news.cache.retries)
+        self.assertGreater(news.cache.next_retry, datetime.utcnow())
+        self.assertEqual((content, Model.PREFIX.value), (news.cache.summary, news.cache.model))
+
+        self.assertEqual((content, Model.PREFIX), news.summarize(content))
+        self.assertEqual(1, mock_summarize_by_llm.call_count)  # not resent until the backoff passes
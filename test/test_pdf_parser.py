@@ -1,7 +1,10 @@
 # coding: utf-8
 import os
-from unittest import TestCase
+from concurrent.futures import Future
+from unittest import TestCase, mock
 
+import config
+from page_content_extractor import pdf
 from page_content_extractor.pdf import *
 
 
@@ -32,6 +35,72 @@ class PdfParserTestCase(TestCase):
                 '^We show that synthesizing recursive functional programs using ',
                 msg=f'actual content ({len(content)} chars): {content[:500]!r}')  # No title or authors
 
+    def test_pages_read_one_at_a_time(self):
+        fpath = os.path.join(os.path.dirname(__file__), 'fixtures/cpi.pdf')
+        with open(fpath, 'rb') as fp:
+            parser = PdfExtractor(fp.read())
+        with mock.patch.object(config, 'worker_processes', 0), \
+                mock.patch.object(PDFPageInterpreter, 'process_page', autospec=True,
+                                  side_effect=PDFPageInterpreter.process_page) as process_page:
+            content = parser.get_content(1000)
+        self.assertTrue(content.startswith('Systems code is often written in low-level languages'))
+        self.assertLess(process_page.call_count, 3)  # the rest is never interpreted
+        content = parser.get_content()
+        # Nothing is left over from the page before
+        self.assertIn('(there are a few rare exceptions, like unloading', content)
+
+    def test_same_pages_in_parallel(self):
+        for fname, max_pages in (('cpi.pdf', 5), ('pldi24.pdf', 7)):  # cut in the middle of a job
+            fpath = os.path.join(os.path.dirname(__file__), 'fixtures', fname)
+            with open(fpath, 'rb') as fp:
+                parser = PdfExtractor(fp.read())
+            texts, contents = {}, {}
+            for processes in (0, 2):
+                with mock.patch.object(config, 'worker_processes', processes), \
+                        mock.patch.object(config, 'max_pdf_pages', max_pages), \
+                        mock.patch.object(pdf, 'PAGES_PER_JOB', 2):
+                    texts[processes] = list(parser.iter_page_texts())
+                    contents[processes] = parser.get_content(1 << 20)  # beyond the cut of max_pdf_pages
+            self.assertEqual(max_pages, len(texts[0]), fname)
+            self.assertEqual(texts[0], texts[2], fname)
+            self.assertEqual(contents[0], contents[2], fname)
+
+    def test_page_count(self):
+        for fname, page_count in (('cpi.pdf', 17), ('pldi24.pdf', 24)):
+            with open(os.path.join(os.path.dirname(__file__), 'fixtures', fname), 'rb') as fp:
+                self.assertEqual(page_count, PdfExtractor.page_count(fp.read()))
+
+    def test_pages_submitted_as_read(self):
+        fpath = os.path.join(os.path.dirname(__file__), 'fixtures/cpi.pdf')
+        with open(fpath, 'rb') as fp:
+            parser = PdfExtractor(fp.read())
+        submitted = []
+
+        def submit(fn, *args):
+            submitted.append(args)
+            future = Future()
+            future.set_result(fn(*args))
+            return future
+
+        with mock.patch.object(config, 'worker_processes', 2), mock.patch.object(pdf, 'PAGES_PER_JOB', 1), \
+                mock.patch.object(pdf.workers, 'submit', side_effect=submit):
+            pages = parser.iter_page_texts()
+            next(pages)
+            self.assertEqual(2, len(submitted))  # one job ahead per worker
+            next(pages)
+            self.assertEqual(3, len(submitted))
+            path = submitted[0][0]
+            self.assertIsInstance(path, str)  # the pdf is not sent with every job
+            pages.close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_pdf_timeout(self):
+        fpath = os.path.join(os.path.dirname(__file__), 'fixtures/cpi.pdf')
+        with open(fpath, 'rb') as fp:
+            parser = PdfExtractor(fp.read())
+        with mock.patch.object(config, 'worker_processes', 0), mock.patch.object(config, 'pdf_timeout', 0):
+            self.assertEqual(1, len(list(parser.iter_page_texts())))
+
     # def test_text_order(self):
     #     parser = PdfExtractor(open('/tmp/fm_21-76_us_army_survival_manual_2006.pdf', 'rb').read())
     #     self.assertIsNone(parser.get_illustration())
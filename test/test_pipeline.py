@@ -0,0 +1,107 @@
+# coding: utf-8
+import threading
+import time
+from collections import defaultdict
+from unittest import TestCase
+
+from hacker_news.deadline import Deadline, StageTimeout, check_cancelled, waiting
+from hacker_news.pipeline import pull_contents, host_of
+
+
+class FakeNews(object):
+    lock = threading.Lock()
+
+    def __init__(self, rank, url, load):
+        self.rank = rank
+        self.url = url
+        self.load = load
+
+    def pull_content(self):
+        host = host_of(self)
+        with self.lock:
+            self.load['all'] += 1
+            self.load[host] += 1
+            self.load['max_all'] = max(self.load['max_all'], self.load['all'])
+            self.load['max_' + host] = max(self.load['max_' + host], self.load[host])
+        time.sleep(0.01)
+        with self.lock:
+            self.load['all'] -= 1
+            self.load[host] -= 1
+        return self.rank
+
+
+class PipelineTestCase(TestCase):
+
+    def test_results_in_rank_order(self):
+        load = defaultdict(int)
+        news_list = [FakeNews(i, f'https://site{i % 5}.com/{i}', load) for i in range(30)]
+        self.assertEqual(list(range(30)), pull_contents(news_list, concurrency=6, per_host=2))
+        self.assertLessEqual(load['max_all'], 6)
+        self.assertGreater(load['max_all'], 1)
+
+    def test_per_host_limit(self):
+        load = defaultdict(int)
+        news_list = [FakeNews(i, f'https://same.host.com/{i}', load) for i in range(10)]
+        news_list.append(FakeNews(10, 'https://other.host.com/', load))
+        self.assertEqual(list(range(11)), pull_contents(news_list, concurrency=8, per_host=2))
+        self.assertEqual(2, load['max_same.host.com'])
+
+    def test_failed_item(self):
+        load = defaultdict(int)
+        news_list = [FakeNews(0, 'https://a.com/', load), FakeNews(1, 'https://b.com/', load)]
+        news_list[0].pull_content = lambda: 1 / 0
+        self.assertEqual([None, 1], pull_contents(news_list))
+
+
+class DeadlineTestCase(TestCase):
+    stage_budget = {'fetch': 0.1, 'summarize': 0.1, 'image': 0.1}
+
+    def test_run_within_budget(self):
+        deadline = Deadline(stage_budget=self.stage_budget)
+        self.assertEqual(3, deadline.run('fetch', lambda a, b: a + b, 1, 2))
+        self.assertRaises(ZeroDivisionError, deadline.run, 'image', lambda: 1 / 0)
+
+    def test_stage_timeout(self):
+        deadline = Deadline(stage_budget=self.stage_budget)
+        start = time.time()
+        with self.assertRaises(StageTimeout) as cm:
+            deadline.run('summarize', time.sleep, 1)
+        self.assertEqual('summarize', cm.exception.stage)
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_round_expired(self):
+        deadline = Deadline(0, stage_budget=self.stage_budget)
+        called = []
+        self.assertRaises(StageTimeout, deadline.run, 'image', called.append, 1)
+        self.assertEqual([], called)
+
+    def test_no_budget(self):
+        deadline = Deadline()  # e.g. the daily pages
+        self.assertIs(threading.current_thread(), deadline.run('summarize', threading.current_thread))
+
+    def test_waiting_not_counted(self):
+        deadline = Deadline(stage_budget=self.stage_budget)
+
+        def wait_in_queue():
+            with waiting():
+                time.sleep(0.3)
+            return 'done'
+
+        self.assertEqual('done', deadline.run('summarize', wait_in_queue))
+
+    def test_cancelled_stage(self):
+        deadline = Deadline(stage_budget=self.stage_budget)
+        written = []
+        finished = threading.Event()
+
+        def slow_write():
+            time.sleep(0.3)
+            try:
+                check_cancelled()
+                written.append(1)
+            finally:
+                finished.set()
+
+        self.assertRaises(StageTimeout, deadline.run, 'image', slow_write)
+        self.assertTrue(finished.wait(1))
+        self.assertEqual([], written)
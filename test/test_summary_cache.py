@@ -1,10 +1,21 @@
+import os
+import tempfile
+import time
 import unittest
 from datetime import datetime, timedelta
+from unittest import mock
+
+from sqlalchemy import create_engine, delete, inspect, text
 
 import config
+import db.extraction
+import db.host
+import db.image
 import db.summary
-from db import translation, Translation, summary
+import db.verdict
+from db import translation, Translation, summary, HostHealth, StoredImage, ImageVerdict, Extraction
 from db.engine import session_scope
+from page_content_extractor.webimage import WebImage
 
 
 class TranslationCacheTestCase(unittest.TestCase):
@@ -38,3 +49,238 @@ class TranslationCacheTestCase(unittest.TestCase):
         text = 'w' * summary.Summary.summary.type.length * 2
         summary.put(db.Summary('hello', text, db.summary.Model.OPENAI))
         self.assertEqual('w' * summary.Summary.summary.type.length, summary.get('hello').summary)
+
+
+class HostHealthTestCase(unittest.TestCase):
+
+    def setUp(self):
+        db.host._hosts.clear()
+        db.host._probing.clear()
+        db.host._dirty.clear()
+
+    def test_circuit_breaker(self):
+        host = 'circuit.example.com'
+        for _ in range(config.circuit_failure_threshold - 1):
+            db.host.record(host, 100, timeout=True)
+        self.assertTrue(db.host.allow(host))
+        db.host.record(host, 100, status_code=503)
+        self.assertFalse(db.host.allow(host))
+
+        # half-open after the cool-down, only one probe is let through
+        health = db.host.get(host)
+        health.opened_at = datetime.utcnow() - timedelta(seconds=config.circuit_cooldown + 1)
+        self.assertTrue(db.host.allow(host))
+        self.assertFalse(db.host.allow(host))
+        db.host.record(host, 100, status_code=200)
+        self.assertTrue(db.host.allow(host))
+        self.assertEqual(0, health.consecutive_failures)
+
+    def test_forbidden_host(self):
+        host = 'forbidden.example.com'
+        for _ in range(config.circuit_failure_threshold * 2):
+            db.host.record(host, 100, status_code=403)
+        self.assertTrue(db.host.allow(host))
+        self.assertEqual(config.circuit_failure_threshold * 2, db.host.get(host).client_errors)
+        for _ in range(config.circuit_failure_threshold):
+            db.host.record(host, 100, status_code=429)
+        self.assertFalse(db.host.allow(host))
+
+    def test_slow_host(self):
+        host = 'slow.example.com'
+        for _ in range(5):
+            db.host.record(host, config.slow_host_ms + 1, status_code=200)
+        self.assertFalse(db.host.allow(host))
+        self.assertTrue(db.host.allow('fast.example.com'))
+
+    def test_flush_and_expire(self):
+        host = 'flush.example.com'
+        db.host.record(host, 100, status_code=404)
+        db.host.flush()
+        db.host._hosts.clear()
+        health = db.host.get(host)
+        self.assertEqual(1, health.requests)
+        self.assertEqual(1, health.client_errors)
+        self.assertEqual([100], health.latency_samples())
+        with session_scope() as session:
+            session.get(HostHealth, host).access = datetime.utcnow() - timedelta(seconds=config.summary_ttl + 1)
+        self.assertEqual(1, db.host.expire())
+
+
+class ImageVerdictTestCase(unittest.TestCase):
+
+    def test_flush_and_expire(self):
+        url = 'https://verdict.example.com/banner.png'
+        db.verdict.put(url, False, 1200, 100, 20000, 'dimension')
+        db.verdict.flush()
+        db.verdict._verdicts.clear()
+        verdict = db.verdict.get(url)
+        self.assertEqual((False, 1200, 100, 'dimension'),
+                         (verdict.is_candidate, verdict.width, verdict.height, verdict.reason))
+
+        verdict.birth = datetime.utcnow() - timedelta(seconds=config.image_verdict_ttl + 1)
+        self.assertIsNone(db.verdict.get(url))
+        with session_scope() as session:
+            session.get(ImageVerdict, url).birth = verdict.birth
+        self.assertEqual(1, db.verdict.expire())
+
+    def test_forget(self):
+        url = 'https://verdict.example.com/gone.png'
+        db.verdict.put(url, True, 1200, 800, 20000)
+        db.verdict.flush()
+        db.verdict.forget(url)
+        self.assertIsNone(db.verdict.get(url))
+        db.verdict.flush()
+        db.verdict._verdicts.clear()
+        self.assertIsNone(db.verdict.get(url))
+
+
+class MigrationTestCase(unittest.TestCase):
+
+    def test_add_missing_columns(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            engine = create_engine(f'sqlite:///{tmpdir}/old.db')
+            with engine.begin() as conn:  # as created before retries and the image GC
+                conn.execute(text('CREATE TABLE summary (url VARCHAR(4096) PRIMARY KEY, summary VARCHAR(65535))'))
+                conn.execute(text('CREATE TABLE image (name VARCHAR(255) PRIMARY KEY)'))
+            db.add_missing_columns(engine)
+            db.add_missing_columns(engine)  # nothing left to add
+            inspector = inspect(engine)
+            self.assertTrue({'content_hash', 'retries', 'next_retry', 'access'}
+                            <= {column['name'] for column in inspector.get_columns('summary')})
+            self.assertIn('checked_at', {column['name'] for column in inspector.get_columns('image')})
+            self.assertIn('ix_image_checked_at', {index['name'] for index in inspector.get_indexes('image')})
+            self.assertFalse(inspector.has_table('extraction'))  # left to create_all
+            engine.dispose()
+
+    def test_images_stored_before_gc(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            engine = create_engine(f'sqlite:///{tmpdir}/old.db')
+            with engine.begin() as conn:
+                conn.execute(text('CREATE TABLE image (name VARCHAR(255) PRIMARY KEY, last_referenced TIMESTAMP)'))
+                conn.execute(text("INSERT INTO image VALUES ('old.webp', '2023-01-01 00:00:00')"))
+            db.add_missing_columns(engine)
+            with engine.connect() as conn:  # never checked, so the first GC pass checks them
+                self.assertEqual([('old.webp', None)], conn.execute(text('SELECT name, checked_at FROM image')).all())
+            engine.dispose()
+
+
+class ExtractionCacheTestCase(unittest.TestCase):
+
+    def test_put_and_expire(self):
+        digest = db.extraction.digest_of('https://extraction.example.com/', b'<p>body</p>')
+        self.assertNotEqual(digest, db.extraction.digest_of('https://extraction.example.com/other', b'<p>body</p>'))
+        db.extraction.put(digest, '{"content":"中文"}')
+        self.assertEqual('{"content":"中文"}', db.extraction.get(digest))
+
+        with session_scope() as session:
+            session.get(Extraction, digest).birth = datetime.utcnow() - timedelta(seconds=config.extraction_ttl + 1)
+        self.assertIsNone(db.extraction.get(digest))
+        self.assertEqual(1, db.extraction.expire())
+
+
+class ImageStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(config, 'image_dir', self.tmpdir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def make_image(self, url, data):
+        img = WebImage(src=url)
+        img.raw_data = data
+        img.suffix = '.png'
+        return img
+
+    def test_sharded_and_dedup(self):
+        name = db.image.save(self.make_image('https://a.com/1.png', b'same bytes'))
+        self.assertEqual(name, db.image.save(self.make_image('https://b.com/2.png', b'same bytes')))
+        self.assertEqual(name[:2] + '/' + name[:2], name[:5])
+        self.assertTrue(db.image.exists(name))
+        with session_scope() as session:
+            stored = session.get(StoredImage, name)
+            self.assertEqual('https://a.com/1.png', stored.source_url)
+            self.assertEqual(len(b'same bytes'), stored.size)
+            session.delete(stored)
+
+    def test_derivatives_removed_together(self):
+        name = db.image.save(self.make_image('https://a.com/1.png', b'with derivatives'))
+        srcset = db.image.save_derivatives(name, {220: b'small', 440: b'medium'})
+        self.assertEqual(name.replace('.png', '-220w.webp'), srcset[220])
+        self.assertTrue(all(db.image.exists(derived) for derived in srcset.values()))
+        self.assertEqual(len(b'with derivatives' + b'small' + b'medium'), db.image.remove(name))
+        self.assertFalse(any(db.image.exists(derived) for derived in [name] + list(srcset.values())))
+        with session_scope() as session:
+            session.delete(session.get(StoredImage, name))
+
+    def test_expire_unreferenced(self):
+        referenced = db.image.save(self.make_image('https://a.com/1.png', b'referenced'))
+        orphan = db.image.save(self.make_image('https://a.com/2.png', b'orphan'))
+        fresh = db.image.save(self.make_image('https://a.com/3.png', b'fresh orphan'))
+        summ = db.Summary('https://a.com/', 'summary')
+        summ.image_name = referenced
+        summary.put(summ)
+        long_ago = datetime.utcnow() - timedelta(seconds=db.image.GC_GRACE + 1)
+        with session_scope() as session:
+            for name in (referenced, orphan):
+                session.get(StoredImage, name).last_referenced = long_ago
+        try:
+            self.assertEqual(1, db.image.expire())
+            self.assertTrue(db.image.exists(referenced))
+            self.assertFalse(db.image.exists(orphan))
+            self.assertTrue(db.image.exists(fresh))
+        finally:
+            with session_scope() as session:
+                session.delete(session.get(db.Summary, summ.url))
+                for name in (referenced, fresh):
+                    session.delete(session.get(StoredImage, name))
+
+    def test_incremental_and_released_first(self):
+        names = [db.image.save(self.make_image(f'https://a.com/{i}.png', b'image %d' % i)) for i in range(3)]
+        summaries = []
+        for name in names:
+            summ = db.Summary('https://a.com/' + name, 'summary')
+            summ.image_name = name
+            summaries.append(summary.put(summ))
+        try:
+            with mock.patch.object(db.image, 'GC_BATCH', 1):
+                for _ in names:  # the whole set is checked in len(names) runs
+                    self.assertEqual(0, db.image.expire())
+            with session_scope() as session:
+                self.assertTrue(all(session.get(StoredImage, name).checked_at for name in names))
+                # the summary of the last checked image expires
+                summ = session.get(db.Summary, summaries[-1].url)
+                summ.access = datetime.utcnow() - timedelta(seconds=config.summary_ttl + 1)
+                session.get(StoredImage, names[-1]).last_referenced = summ.access
+            summary.expire()
+            with mock.patch.object(db.image, 'GC_BATCH', 1):
+                self.assertEqual(1, db.image.expire())  # released images are checked first
+            self.assertFalse(db.image.exists(names[-1]))
+        finally:
+            with session_scope() as session:
+                for summ, name in zip(summaries[:-1], names):
+                    session.delete(session.get(db.Summary, summ.url))
+                    session.delete(session.get(StoredImage, name))
+
+    def test_adopt_legacy(self):
+        def forget_adoption():
+            with session_scope() as session:
+                session.execute(delete(StoredImage).where(StoredImage.name == db.image.LEGACY_MARK))
+
+        forget_adoption()
+        self.addCleanup(forget_adoption)
+        legacy = 'c189bad0066ddb74264e7e03fa8b2dda.jpg'
+        with open(os.path.join(config.image_dir, legacy), 'wb') as fp:
+            fp.write(b'legacy')
+        long_ago = time.time() - db.image.GC_GRACE - 1
+        os.utime(os.path.join(config.image_dir, legacy), (long_ago, long_ago))
+        self.assertEqual(1, db.image.expire())
+        self.assertFalse(db.image.exists(legacy))
+        self.assertEqual([], os.listdir(config.image_dir))  # nothing left to publish
+        with open(os.path.join(config.image_dir, legacy), 'wb') as fp:
+            fp.write(b'legacy')
+        os.utime(os.path.join(config.image_dir, legacy), (long_ago, long_ago))
+        self.assertEqual(0, db.image.expire())  # adopted only once
+        with session_scope() as session:
+            self.assertIsNotNone(session.get(StoredImage, db.image.LEGACY_MARK))